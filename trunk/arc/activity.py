@@ -0,0 +1,105 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+REGION_SIZE = 16 # Regions are cubes this many blocks across
+SETTLE_PASSES = 10 # Physics passes a region has to go without a change to fall asleep
+WAKE_MARGIN = 2 # Physics looks this far from a block, so changes this close to a region's edge wake its neighbour too
+
+class RegionActivity(object):
+    """
+    Which parts of a world physics may still have work in. The world is cut
+    into REGION_SIZE cubes; a change in or near one wakes it, and it falls
+    asleep again once SETTLE_PASSES physics passes go by without another.
+    Everything in a sleeping region has settled, so when physics starts up
+    it only needs to look over the regions that are awake.
+    """
+
+    def __init__(self, blockstore):
+        self.x, self.y, self.z = blockstore.x, blockstore.y, blockstore.z
+        self.rx, self.ry, self.rz = [(size + REGION_SIZE - 1) // REGION_SIZE for size in (self.x, self.y, self.z)]
+        self.passes = 0
+        # The pass each region last had a change in; they all start awake, as we know nothing yet
+        if numpy is not None:
+            self.last_change = numpy.zeros(self.rx * self.ry * self.rz, numpy.int64)
+        else:
+            self.last_change = array('l', [0]) * (self.rx * self.ry * self.rz)
+
+    def region(self, offset):
+        "Returns the number of the region the block at offset is in."
+        x = offset % self.x
+        z = (offset // self.x) % self.z
+        y = offset // (self.x * self.z)
+        return ((y // REGION_SIZE) * self.rz + z // REGION_SIZE) * self.rx + x // REGION_SIZE
+
+    def regions(self, offsets):
+        "Like region, for a NumPy array of offsets."
+        xs, zs, ys = offsets % self.x, (offsets // self.x) % self.z, offsets // (self.x * self.z)
+        return ((ys // REGION_SIZE) * self.rz + zs // REGION_SIZE) * self.rx + xs // REGION_SIZE
+
+    def touch(self, offset):
+        "Wakes the region the block at offset is in, and any neighbour it's near the edge of."
+        x = offset % self.x
+        z = (offset // self.x) % self.z
+        y = offset // (self.x * self.z)
+        rxs = range(max(x - WAKE_MARGIN, 0) // REGION_SIZE, min(x + WAKE_MARGIN, self.x - 1) // REGION_SIZE + 1)
+        rzs = range(max(z - WAKE_MARGIN, 0) // REGION_SIZE, min(z + WAKE_MARGIN, self.z - 1) // REGION_SIZE + 1)
+        for ry in range(max(y - WAKE_MARGIN, 0) // REGION_SIZE, min(y + WAKE_MARGIN, self.y - 1) // REGION_SIZE + 1):
+            for rz in rzs:
+                for rx in rxs:
+                    self.last_change[(ry * self.rz + rz) * self.rx + rx] = self.passes
+
+    def touch_many(self, offsets):
+        "Like touch, for a batch of offsets."
+        if isinstance(self.last_change, array):
+            if len(offsets) <= len(self.last_change):
+                for offset in offsets:
+                    self.touch(offset)
+                return
+            # Too many to look at one by one; wake every region in the layers they span
+            layer = self.x * self.z
+            ry1 = max(min(offsets) // layer - WAKE_MARGIN, 0) // REGION_SIZE
+            ry2 = min(max(offsets) // layer + WAKE_MARGIN, self.y - 1) // REGION_SIZE
+            for region in xrange(ry1 * self.rx * self.rz, (ry2 + 1) * self.rx * self.rz):
+                self.last_change[region] = self.passes
+            return
+        if isinstance(offsets, array):
+            offsets = numpy.frombuffer(offsets, "u%d" % offsets.itemsize)
+        offsets = numpy.asarray(offsets, numpy.int64)
+        if not len(offsets):
+            return
+        xs, zs, ys = offsets % self.x, (offsets // self.x) % self.z, offsets // (self.x * self.z)
+        # The margin's smaller than a region, so its corners land in every region it reaches
+        for dy in (-WAKE_MARGIN, WAKE_MARGIN):
+            ry = numpy.clip(ys + dy, 0, self.y - 1) // REGION_SIZE
+            for dz in (-WAKE_MARGIN, WAKE_MARGIN):
+                rz = numpy.clip(zs + dz, 0, self.z - 1) // REGION_SIZE
+                for dx in (-WAKE_MARGIN, WAKE_MARGIN):
+                    rx = numpy.clip(xs + dx, 0, self.x - 1) // REGION_SIZE
+                    self.last_change[(ry * self.rz + rz) * self.rx + rx] = self.passes
+
+    def wake_all(self):
+        "Wakes every region, for when the rules physics plays by change."
+        for region in xrange(len(self.last_change)):
+            self.last_change[region] = self.passes
+
+    def settle(self):
+        "Counts a physics pass, letting regions that have been quiet long enough fall asleep."
+        self.passes += 1
+
+    def awake(self):
+        "Returns a flag per region (a NumPy array if we have it), saying which are awake."
+        if isinstance(self.last_change, array):
+            passes = self.passes
+            return [passes - last < SETTLE_PASSES for last in self.last_change]
+        return self.passes - self.last_change < SETTLE_PASSES
+
+    def awake_count(self):
+        return int(sum(self.awake()))
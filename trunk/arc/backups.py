@@ -0,0 +1,290 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import gzip, hashlib, os, shutil, struct, time
+from array import array
+from cStringIO import StringIO
+
+try:
+    import simplejson
+except ImportError:
+    import json as simplejson
+
+from arc.compression import compress, split
+from arc.gzipstream import *
+from arc.journal import BlockJournal
+from arc.regions import RegionFile
+from arc.worldmeta import read_meta, read_size, write_meta
+
+BACKUP_VERSION = 1
+# Blocks are cut into chunks this big, in offset order, before hashing; the
+# same size as a region, so a change in one spot only costs one new chunk.
+CHUNK_BYTES = 32 * 32 * 32
+# Files that make up a world, for backups from before the chunk store
+LEGACY_FILES = ["blocks.gz", "blocks.rgi", "blocks.rgn", "blocks.journal", "world.meta"]
+
+class BackupStore(object):
+    """
+    The backups of one world. The blocks are stored as chunks named by their
+    SHA-1, so a chunk that's in every backup is only on disk once, and each
+    backup is just a manifest listing its chunks. Backups made as whole
+    copies of the world (the old way) are still listed and restorable.
+    """
+
+    def __init__(self, world_dir):
+        self.world_dir = world_dir
+        self.backup_dir = os.path.join(world_dir, "backup")
+        self.chunk_dir = os.path.join(self.backup_dir, "chunks")
+        self.manifest_dir = os.path.join(self.backup_dir, "manifests")
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, "%s.json" % name)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest[2:])
+
+    def is_legacy(self, name):
+        "Says if the named backup is an old-style copy of the world files."
+        return name not in ("chunks", "manifests") and os.path.isdir(os.path.join(self.backup_dir, name))
+
+    def exists(self, name):
+        return os.path.isfile(self.manifest_path(name)) or self.is_legacy(name)
+
+    def backups(self):
+        "Returns the names of all backups, numbered ones first, oldest first."
+        names = set()
+        if os.path.isdir(self.manifest_dir):
+            for filename in os.listdir(self.manifest_dir):
+                if filename.endswith(".json"):
+                    names.add(filename[:-5])
+        if os.path.isdir(self.backup_dir):
+            for filename in os.listdir(self.backup_dir):
+                if self.is_legacy(filename):
+                    names.add(filename)
+        numbered = sorted([name for name in names if name.isdigit()], key=int)
+        named = sorted([name for name in names if not name.isdigit()])
+        return numbered + named
+
+    def next_number(self):
+        "Returns the number the next automatically named backup should get."
+        numbered = [int(name) for name in self.backups() if name.isdigit()]
+        return (max(numbered) + 1) if numbered else 0
+
+    def put_chunks(self, chunks):
+        """
+        Stores the given strings as chunks, skipping any we already have.
+        Returns their digests and how many were new.
+        """
+        digests = [hashlib.sha1(chunk).hexdigest() for chunk in chunks]
+        new = {}
+        for digest, chunk in zip(digests, chunks):
+            if digest not in new and not os.path.isfile(self.chunk_path(digest)):
+                new[digest] = chunk
+        if new:
+            order = new.keys()
+            for digest, (segment, crc, size) in zip(order, compress([new[digest] for digest in order])):
+                path = self.chunk_path(digest)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # Write it under another name first, so a chunk is either all there or not at all
+                fh = open(path + ".new", "wb")
+                fh.write(segment)
+                fh.close()
+                os.rename(path + ".new", path)
+        return digests, len(new)
+
+    def get_chunk(self, digest):
+        "Returns the contents of a chunk, making sure it's intact."
+        fh = open(self.chunk_path(digest), "rb")
+        try:
+            data = inflate_segment(fh.read())
+        finally:
+            fh.close()
+        if hashlib.sha1(data).hexdigest() != digest:
+            raise IOError("Backup chunk %s is corrupt" % digest)
+        return data
+
+    def backup(self, name, size, blocks, meta):
+        """
+        Records a backup called name of a world of the given (x, y, z) size,
+        from its raw blocks and its metadata file's contents.
+        Returns the number of chunks that weren't stored already.
+        """
+        block_digests, new_blocks = self.put_chunks(split(blocks, CHUNK_BYTES))
+        (meta_digest,), new_meta = self.put_chunks([meta])
+        manifest = {
+            "version": BACKUP_VERSION,
+            "created": int(time.time()),
+            "size": list(size),
+            "chunk_bytes": CHUNK_BYTES,
+            "blocks": block_digests,
+            "meta": meta_digest,
+        }
+        if not os.path.isdir(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+        path = self.manifest_path(name)
+        fh = open(path + ".new", "w")
+        simplejson.dump(manifest, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.rename(path + ".new", path)
+        return new_blocks + new_meta
+
+    def load_manifest(self, name):
+        fh = open(self.manifest_path(name))
+        try:
+            manifest = simplejson.load(fh)
+        finally:
+            fh.close()
+        if manifest.get("version") != BACKUP_VERSION:
+            raise IOError("Backup %s is not a version %d backup" % (name, BACKUP_VERSION))
+        return manifest
+
+    def restore(self, name):
+        """
+        Puts the world files back the way they were in the named backup.
+        The world must not be booted.
+        """
+        blocks_path = os.path.join(self.world_dir, "blocks.gz")
+        if self.is_legacy(name):
+            self.restore_legacy(name)
+            return
+        manifest = self.load_manifest(name)
+        x, y, z = manifest["size"]
+        blocks = "".join([self.get_chunk(digest) for digest in manifest["blocks"]])
+        if len(blocks) != x * y * z:
+            raise IOError("Backup %s holds %d blocks, not %d" % (name, len(blocks), x * y * z))
+        meta = self.get_chunk(manifest["meta"])
+        # Keep the world in whichever format it's in now
+        if RegionFile.exists_for(blocks_path):
+            RegionFile.create(blocks_path, x, y, z, StringIO(blocks))
+        else:
+            header = struct.pack("!i", x * y * z)
+            fh = open(blocks_path + ".new", "wb")
+            fh.write(assemble_gzip(compress([header] + split(blocks))))
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+            if os.path.exists(blocks_path):
+                os.remove(blocks_path)
+            os.rename(blocks_path + ".new", blocks_path)
+        # The journal belongs to the blocks we just replaced
+        journal_path = os.path.join(self.world_dir, "blocks.journal")
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        write_meta(self.world_dir, meta)
+
+    def restore_legacy(self, name):
+        "Restores an old-style backup by copying its files back."
+        backup_dir = os.path.join(self.backup_dir, name)
+        if os.path.exists(os.path.join(backup_dir, "blocks.rgi")):
+            for filename in ["blocks.rgi", "blocks.rgn"]:
+                shutil.copy(os.path.join(backup_dir, filename), self.world_dir)
+        else:
+            shutil.copy(os.path.join(backup_dir, "blocks.gz"), self.world_dir)
+            # Don't let newer regions shadow the restored blocks.gz
+            for filename in ["blocks.rgi", "blocks.rgn"]:
+                if os.path.exists(os.path.join(self.world_dir, filename)):
+                    os.remove(os.path.join(self.world_dir, filename))
+        # The world's journal belongs to the old blocks, so swap it too
+        if os.path.exists(os.path.join(backup_dir, "blocks.journal")):
+            shutil.copy(os.path.join(backup_dir, "blocks.journal"), self.world_dir)
+        elif os.path.exists(os.path.join(self.world_dir, "blocks.journal")):
+            os.remove(os.path.join(self.world_dir, "blocks.journal"))
+        for filename, other in [("world.db", "world.meta"), ("world.meta", "world.db")]:
+            if os.path.exists(os.path.join(backup_dir, filename)):
+                shutil.copy(os.path.join(backup_dir, filename), self.world_dir)
+                # Otherwise the newer metadata would be loaded instead
+                if os.path.exists(os.path.join(self.world_dir, other)):
+                    os.remove(os.path.join(self.world_dir, other))
+                break
+
+    def delete(self, name, collect=True):
+        "Deletes the named backup, and (unless told not to) any chunks only it used."
+        if self.is_legacy(name):
+            shutil.rmtree(os.path.join(self.backup_dir, name))
+        else:
+            os.remove(self.manifest_path(name))
+            if collect:
+                self.collect()
+
+    def trash(self, name, trash_dir):
+        """
+        Moves the named backup, along with the chunks it uses, into the backup
+        store of trash_dir, so it can still be brought back. It's renamed if
+        the trash already has one called that. Returns its name there.
+        """
+        trash = BackupStore(trash_dir)
+        trashed_name, copies = name, 0
+        while trash.exists(trashed_name):
+            copies += 1
+            trashed_name = "%s_%d" % (name, copies)
+        if self.is_legacy(name):
+            if not os.path.isdir(trash.backup_dir):
+                os.makedirs(trash.backup_dir)
+            shutil.move(os.path.join(self.backup_dir, name), os.path.join(trash.backup_dir, trashed_name))
+            return trashed_name
+        manifest = self.load_manifest(name)
+        for digest in manifest["blocks"] + [manifest["meta"]]:
+            path = trash.chunk_path(digest)
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                shutil.copy(self.chunk_path(digest), path)
+        if not os.path.isdir(trash.manifest_dir):
+            os.makedirs(trash.manifest_dir)
+        shutil.copy(self.manifest_path(name), trash.manifest_path(trashed_name))
+        self.delete(name)
+        return trashed_name
+
+    def prune(self, keep):
+        "Deletes the oldest numbered backups, so there are at most keep left."
+        numbered = [name for name in self.backups() if name.isdigit()]
+        doomed = numbered[:max(0, len(numbered) - keep)]
+        for name in doomed:
+            self.delete(name, collect=False)
+        if doomed:
+            self.collect()
+        return doomed
+
+    def collect(self):
+        "Removes chunks no backup refers to any more. Returns how many went."
+        if not os.path.isdir(self.chunk_dir):
+            return 0
+        used = set()
+        for name in self.backups():
+            if not self.is_legacy(name):
+                manifest = self.load_manifest(name)
+                used.update(manifest["blocks"])
+                used.add(manifest["meta"])
+        removed = 0
+        for prefix in os.listdir(self.chunk_dir):
+            for rest in os.listdir(os.path.join(self.chunk_dir, prefix)):
+                if prefix + rest not in used:
+                    os.remove(os.path.join(self.chunk_dir, prefix, rest))
+                    removed += 1
+        return removed
+
+def read_world(world_dir):
+    """
+    Reads an unbooted world off disk, journal and all.
+    Returns its (x, y, z) size, its raw blocks and its metadata file's contents.
+    """
+    blocks_path = os.path.join(world_dir, "blocks.gz")
+    size = read_size(world_dir)
+    blocks = array('c')
+    if RegionFile.exists_for(blocks_path):
+        regions = RegionFile(blocks_path)
+        regions.load_index()
+        regions.read_into(blocks)
+    else:
+        gz = gzip.GzipFile(blocks_path)
+        gz.read(4)
+        blocks.fromstring(gz.read())
+        gz.close()
+    def apply(offset, block):
+        blocks[offset] = block
+    BlockJournal(blocks_path, len(blocks)).replay(apply)
+    return size, blocks.tostring(), read_meta(world_dir)
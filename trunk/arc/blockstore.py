@@ -2,95 +2,253 @@
 # Arc is licensed under the BSD 2-Clause modified License.
 # To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
 
-import gzip, os, struct
+import gzip, os, struct, time, traceback
 from array import array
-from Queue import Queue
-from threading import Thread
+from Queue import Empty, Queue
+from threading import Event
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from arc.compression import CompressJob, compress, split
 from arc.constants import *
+from arc.executor import get_executor
 from arc.globals import *
+from arc.gzipstream import *
+from arc.heightmap import HeightMap
+from arc.journal import BlockJournal
 from arc.logger import ColouredLogger
+from arc.neighbours import NeighbourTable
 from arc.physics import Physics
+from arc.physicsprocess import ProcessPhysics
+from arc.physicsscheduler import PhysicsScheduler
+from arc.regions import REGION_BYTES, RegionFile
+from arc.spongefield import CHR_SPONGE, SpongeField
+from arc.vectorphysics import VectorPhysics
+
+# Physics engines a world can pick from
+PHYSICS_ENGINES = {"classic": Physics, "vector": VectorPhysics}
+
+class TaskQueue(Queue):
+    "A Queue that calls on_put after anything is put in it."
+
+    def __init__(self, on_put):
+        Queue.__init__(self)
+        self.on_put = on_put
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        self.on_put()
 
-class BlockStore(Thread):
+class BlockStore(object):
     """
     A class which deals with storing the block worlds, flushing them, etc.
+    It doesn't have a thread of its own; the world executor's workers run it
+    a slice at a time, whenever it has tasks waiting or physics to do.
     """
 
-    def __init__(self, blocks_path, sx, sy, sz):
-        Thread.__init__(self)
+    def __init__(self, blocks_path, sx, sy, sz, journal_limit=1024 * 1024, use_numpy=True, physics_clock=None,
+            predecessor=None):
         self.x, self.y, self.z = sx, sy, sz
         self.blocks_path = blocks_path
         self.world_name = os.path.basename(os.path.dirname(blocks_path))
-        self.in_queue = Queue()
+        # Region-format worlds only rewrite the regions that changed (see open_files)
+        self.region_file = None
+        self.region_bytes = REGION_BYTES
+        self.predecessor = predecessor # A BlockStore for this world that's still saving; we load once it's stopped
+        # Changes are journalled between saves; past journal_limit bytes they get folded into the blocks file
+        self.journal = BlockJournal(blocks_path, sx * sy * sz)
+        self.journal_limit = journal_limit
+        self.in_queue = TaskQueue(self.wake)
         self.out_queue = Queue()
+        self.loaded = Event() # Set once raw_blocks holds the whole level, so other threads may read it
+        self.applied_batch = 0 # Number of the last World batch (see World.send_batch) applied to raw_blocks
+        self.stopped = Event() # Set once we've stopped and everything is on disk
+        self.executor = None
+        self.use_numpy = use_numpy and numpy is not None
+        self.block_view = None # A (y, z, x) NumPy view onto raw_blocks, if we have NumPy
+        self.neighbours = NeighbourTable(sx, sy, sz)
         self.logger = ColouredLogger()
-
-    def run(self):
-        # Initialise variables
         self.physics = False
         self.physics_engine = Physics(self)
-        self.raw_blocks = None # Read this from any thread but please update through TASK_BLOCKSET so queued_blocks is updated
+        self.physics_engine_name = "classic"
+        self.physics_process = False # Run physics in a process of its own?
+        self.physics_clock = physics_clock or PhysicsScheduler() # Says when physics ticks, and for how long
+        self.sponge_field = None # Where sponges hold back fluids; only kept while physics wants it
+        self.height_map = None # How high each column's highest opaque block is, once loaded
+        self.raw_blocks = None # Read this from any thread once loaded is set, but please update through TASK_BLOCKSET(S) so the change gets saved
         self.running = True
         self.unflooding = False
         self.finite_water = False
-        self.queued_blocks = {} # Blocks which need to be flushed into the file.
-        self.create_raw_blocks()
-        # Start physics engine
-        self.physics_engine.start()
-        # Main eval loop
-        while self.running:
+        self.dirty_regions = set() # Regions (runs of region_bytes offsets) changed since the last save.
+        self.unsaved_changes = 0 # How many block changes the blocks file is missing.
+        self.unsynced_changes = 0 # How many block changes aren't on disk at all yet (not even journalled).
+        self.generation = 0 # Bumped on every change, so we know when level_cache is stale.
+        self.level_cache = None # (generation, gzipped level) shared by every joining client.
+        self.level_callbacks = [] # Waiting on the level that's being compressed right now.
+        self.compressing = [] # [job, on_done, on_error] for compression running in the pool.
+        self.saving = False # Is a save waiting on the pool?
+        self.saving_regions = set() # Regions in that save, which aren't on disk yet.
+
+    def start(self):
+        "Hands us to the world executor, which loads the level and gets going."
+        self.executor = get_executor()
+        self.executor.add(self)
+
+    def wake(self):
+        "Asks for a slice soon, as there's a task waiting."
+        if self.executor is not None:
+            self.executor.schedule(self)
+
+    def isAlive(self):
+        "Says if we've been started and haven't finished stopping."
+        return self.executor is not None and not self.stopped.isSet()
+
+    def join(self, timeout=None):
+        "Waits until we've stopped and everything is on disk."
+        self.stopped.wait(timeout)
+
+    def run_slice(self, deadline):
+        """
+        Does the work that's waiting, up to deadline: tasks off the queue
+        first, then physics. Returns the seconds until we next need a
+        slice, or None if that's only once a task comes in.
+        """
+        if self.raw_blocks is None:
+            # Don't read the files while the store we replace is still writing them
+            if self.predecessor is not None:
+                if not self.predecessor.stopped.isSet():
+                    return 0.05
+                self.predecessor = None
             try:
-                # Pop something off the queue
-                task = self.in_queue.get()
-                # If we've been asked to flush, do so, and say we did.
-                if task[0] is TASK_FLUSH:
-                    self.flush()
-                    self.out_queue.put([TASK_FLUSH])
-                # New block?
-                elif task[0] is TASK_BLOCKSET:
-                    try:
-                        self[task[1]] = task[2]
-                        if len(task) == 4 and task[3] == True:
-                            # Tells the server to update the given block for clients.
-                            self.out_queue.put([TASK_BLOCKSET, (task[1][0], task[1][1], task[1][2], task[2])])
-                    except AssertionError:
-                        self.logger.warning("Tried to set a block at %s in %s!" % (task[1], self.world_name))
-                # Asking for a block?
-                elif task[0] is TASK_BLOCKGET:
-                    self.out_queue.put([TASK_BLOCKGET, task[1], self[task[1]]])
-                # Perhaps physics was enabled?
-                elif task[0] is TASK_PHYSICSOFF:
-                    self.logger.debug("Disabling physics on '%s'..." % self.world_name)
-                    self.disable_physics()
-                # Or disabled?
-                elif task[0] is TASK_PHYSICSON:
-                    self.logger.debug("Enabling physics on '%s'..." % self.world_name)
-                    self.enable_physics()
-                # I can haz finite water tiem?
-                elif task[0] is TASK_FWATERON:
-                    self.logger.debug("Enabling finite water on '%s'..." % self.world_name)
-                    self.finite_water = True
-                # Noes, no more finite water.
-                elif task[0] is TASK_FWATEROFF:
-                    self.logger.debug("Disabling finite water on '%s'..." % self.world_name)
-                    self.finite_water = False
-                # Do they need to do a Moses?
-                elif task[0] is TASK_UNFLOOD:
-                    self.logger.debug("Unflood started on '%s'..." % self.world_name)
-                    self.unflooding = True
-                # Perhaps that's it, and we need to stop?
-                elif task[0] is TASK_STOP:
-                    self.logger.debug("Stopping block store '%s'..." % self.world_name)
-                    self.physics_engine.stop()
-                    self.flush()
-                    self.logger.debug("Stopped block store '%s'." % self.world_name)
-                    return
-                # ???
-                else:
-                    raise ValueError("Unknown BlockStore task: %s" % task)
-            except (KeyboardInterrupt, IOError):
-                pass
+                self.create_raw_blocks()
+            except Exception:
+                self.logger.error("Unable to load the blocks of '%s':" % self.world_name)
+                self.logger.error(traceback.format_exc())
+                self.running = False
+                self.finish_stop()
+                return None
+            finally:
+                # Even if loading blew up, don't leave readers waiting forever
+                self.loaded.set()
+        # Deal with any compression the pool has finished for us
+        self.finish_compressing()
+        while self.running and time.time() < deadline:
+            try:
+                task = self.in_queue.get_nowait()
+            except Empty:
+                break
+            try:
+                self.handle_task(task)
+                # Caught up? Write out the journal batch while we're idle.
+                if self.running and self.in_queue.empty():
+                    self.journal.write()
+            except IOError:
+                self.logger.error(traceback.format_exc())
+        if not self.running:
+            # Stopping; just wait for the last save to finish
+            return 0.05 if self.compressing else None
+        if not self.in_queue.empty():
+            return 0
+        # Physics gets what's left of the slice
+        if self.physics_engine.remote:
+            delay = self.physics_engine.poll(deadline)
+            if not self.physics_engine.running:
+                # The process died; carry on in this one
+                self.physics_process = False
+                self.start_physics_engine()
+                # and give it a slice straight away, rather than waiting for a task
+                delay = 0
+        elif self.physics or self.physics_engine.was_physics:
+            delay = self.physics_clock.run(self.physics_engine, deadline)
+        else:
+            self.physics_clock.reset()
+            delay = None
+        if self.compressing:
+            delay = 0.05 if delay is None else min(delay, 0.05)
+        return delay
+
+    def handle_task(self, task):
+        "Carries out one task from the queue."
+        # If we've been asked to flush, do so, and say we did.
+        if task[0] is TASK_FLUSH:
+            self.flush(lambda: self.out_queue.put([TASK_FLUSH]))
+        # Or just to make sure our changes are safe?
+        elif task[0] is TASK_SAVE:
+            token = task[1] if len(task) > 1 else None
+            self.save(lambda: self.out_queue.put([TASK_SAVE, token]))
+        # Someone's joining and needs the level?
+        elif task[0] is TASK_LEVELSTREAM:
+            self.level_stream(lambda stream: self.out_queue.put([TASK_LEVELSTREAM, stream]))
+        # New block?
+        elif task[0] is TASK_BLOCKSET:
+            try:
+                self[task[1]] = task[2]
+                if len(task) == 4 and task[3] == True:
+                    # Tells the server to update the given block for clients.
+                    self.out_queue.put([TASK_BLOCKSET, (task[1][0], task[1][1], task[1][2], task[2])])
+            except AssertionError:
+                self.logger.warning("Tried to set a block at %s in %s!" % (task[1], self.world_name))
+        # Lots of new blocks?
+        elif task[0] is TASK_BLOCKSETS:
+            self.set_blocks(task[1], task[2])
+            if len(task) >= 4 and task[3] == True:
+                # Tells the server to update the given blocks for clients (or resend the level, if we may and it's smaller).
+                self.out_queue.put([TASK_BLOCKSETS, task[1], task[2], len(task) >= 5 and task[4] == True])
+            if len(task) == 6:
+                # The World's numbered batches; it reads past its own copy of these once we've got them
+                self.applied_batch = task[5]
+        # Asking for a block?
+        elif task[0] is TASK_BLOCKGET:
+            self.out_queue.put([TASK_BLOCKGET, task[1], self[task[1]]])
+        # Perhaps physics was enabled?
+        elif task[0] is TASK_PHYSICSOFF:
+            self.logger.debug("Disabling physics on '%s'..." % self.world_name)
+            self.disable_physics()
+        # Or disabled?
+        elif task[0] is TASK_PHYSICSON:
+            self.logger.debug("Enabling physics on '%s'..." % self.world_name)
+            self.enable_physics()
+        # Or swapped for another engine?
+        elif task[0] is TASK_PHYSICSENGINE:
+            self.set_physics_engine(task[1])
+        # Or moved out into a process of its own (or back)?
+        elif task[0] is TASK_PHYSICSPROCESS:
+            self.set_physics_process(task[1])
+        # Or asked to look the whole world over again?
+        elif task[0] is TASK_PHYSICSWAKE:
+            self.physics_engine.wake()
+        # I can haz finite water tiem?
+        elif task[0] is TASK_FWATERON:
+            self.logger.debug("Enabling finite water on '%s'..." % self.world_name)
+            self.finite_water = True
+        # Noes, no more finite water.
+        elif task[0] is TASK_FWATEROFF:
+            self.logger.debug("Disabling finite water on '%s'..." % self.world_name)
+            self.finite_water = False
+        # Do they need to do a Moses?
+        elif task[0] is TASK_UNFLOOD:
+            self.logger.debug("Unflood started on '%s'..." % self.world_name)
+            self.unflooding = True
+        # Perhaps that's it, and we need to stop?
+        elif task[0] is TASK_STOP:
+            self.logger.debug("Stopping block store '%s'..." % self.world_name)
+            self.running = False
+            self.physics_engine.stop()
+            self.flush(self.finish_stop)
+        # ???
+        else:
+            raise ValueError("Unknown BlockStore task: %s" % task)
+
+    def finish_stop(self):
+        "Lets go of everything once the final save is done."
+        self.journal.close()
+        self.logger.debug("Stopped block store '%s'." % self.world_name)
+        self.stopped.set()
+        if self.executor is not None:
+            self.executor.remove(self)
 
     def enable_physics(self):
         "Turns on physics"
@@ -99,20 +257,100 @@ class BlockStore(Thread):
     def disable_physics(self):
         "Disables physics, and clears the in-memory store."
         self.physics = False
+        self.sponge_field = None
+
+    def sponge_coverage(self):
+        "Returns the SpongeField for this world, building it if need be."
+        if self.sponge_field is None:
+            self.sponge_field = SpongeField(self)
+        return self.sponge_field
+
+    def set_physics_engine(self, name):
+        "Switches to the named physics engine; it starts over, looking at the whole world."
+        engine = PHYSICS_ENGINES.get(name)
+        if engine is None:
+            self.logger.warn("Unknown physics engine '%s' for '%s'." % (name, self.world_name))
+            return
+        if engine is VectorPhysics and self.block_view is None:
+            self.logger.warn("The vector physics engine needs NumPy; '%s' is using the classic one." % self.world_name)
+            name = "classic"
+        if name != self.physics_engine_name:
+            self.physics_engine_name = name
+            self.start_physics_engine()
+
+    def set_physics_process(self, on):
+        "Moves physics into a process of its own, or back into this one; it starts over either way."
+        if on != self.physics_process:
+            self.physics_process = on
+            self.start_physics_engine()
+
+    def start_physics_engine(self):
+        "Replaces the physics engine with a new one, of the kind and in the process we've been told."
+        self.physics_engine.stop()
+        if self.physics_process:
+            self.logger.debug("Running the %s physics engine for '%s' in its own process..." % (self.physics_engine_name, self.world_name))
+            self.sponge_field = None # The process keeps its own
+            try:
+                self.physics_engine = ProcessPhysics(self, self.physics_engine_name, self.physics_clock)
+                return
+            except Exception:
+                self.logger.error("Unable to start a physics process for '%s':" % self.world_name)
+                self.logger.error(traceback.format_exc())
+                self.physics_process = False
+        self.logger.debug("Using the %s physics engine on '%s'..." % (self.physics_engine_name, self.world_name))
+        self.physics_engine = PHYSICS_ENGINES[self.physics_engine_name](self)
+
+    def physics_stats(self):
+        "Returns the physics tick stats (see TickStats.summary), wherever physics is running."
+        if self.physics_engine.remote:
+            return self.physics_engine.stats
+        return self.physics_engine.summary(self.physics_clock)
+
+    def open_files(self):
+        "Looks at how the blocks are stored on disk; region-format worlds get their index read."
+        if RegionFile.exists_for(self.blocks_path):
+            self.region_file = RegionFile(self.blocks_path)
+            self.region_file.load_index()
+            self.region_bytes = self.region_file.region_bytes
+        else:
+            self.region_file = None
+            self.region_bytes = REGION_BYTES
 
     def create_raw_blocks(self):
-        "Reads in the gzipped data into a raw array"
-        # Open the blocks file
-        fh = gzip.GzipFile(self.blocks_path)
+        "Reads in the gzipped data into a raw array, then replays the journal over it"
+        self.open_files()
         self.raw_blocks = array('c')
-        # Read off the size header
-        fh.read(4)
-        # Copy into the array in chunks
-        chunk = fh.read(2048)
-        while chunk:
-            self.raw_blocks.extend(chunk)
+        if self.region_file:
+            self.region_file.read_into(self.raw_blocks)
+        else:
+            # Open the blocks file
+            fh = gzip.GzipFile(self.blocks_path)
+            # Read off the size header
+            fh.read(4)
+            # Copy into the array in chunks
             chunk = fh.read(2048)
-        fh.close()
+            while chunk:
+                self.raw_blocks.extend(chunk)
+                chunk = fh.read(2048)
+            fh.close()
+        self.replay_journal()
+        if self.use_numpy:
+            # Shares raw_blocks' memory, so it's only valid while raw_blocks isn't resized
+            self.block_view = numpy.frombuffer(self.raw_blocks, numpy.uint8).reshape(self.y, self.z, self.x)
+        self.height_map = HeightMap(self)
+
+    def replay_journal(self):
+        "Applies changes which were journalled but never made it into the blocks file."
+        def apply(offset, block):
+            self.raw_blocks[offset] = block
+            self.mark_dirty(offset, block)
+        try:
+            count = self.journal.replay(apply)
+        except IOError as e:
+            self.logger.error("Unable to replay the journal for '%s': %s" % (self.world_name, e))
+            return
+        if count:
+            self.logger.info("Replayed %d journalled changes for '%s'." % (count, self.world_name))
 
     def get_offset(self, x, y, z):
         "Turns block coordinates into a data offset"
@@ -135,14 +373,76 @@ class BlockStore(Thread):
     def __setitem__(self, (x, y, z), block):
         "Set a block in this level to the given value."
         assert isinstance(block, str) and len(block) == 1
-        # Save to queued blocks
+        # Note it needs saving
         offset = self.get_offset(x, y, z)
-        self.queued_blocks[offset] = block
+        self.mark_dirty(offset, block)
+        self.journal.add(offset, block)
+        self.unsynced_changes += 1
+        self.generation += 1
         # And directly to raw blocks, if we must
         if self.raw_blocks:
+            if self.sponge_field is not None and (block == CHR_SPONGE) != (self.raw_blocks[offset] == CHR_SPONGE):
+                if block == CHR_SPONGE:
+                    self.sponge_field.update([offset], [])
+                else:
+                    self.sponge_field.update([], [offset])
             self.raw_blocks[offset] = block
-            # Ask the physics engine if they'd like a look at that
+            sky_changes = self.height_map.update([offset])
+        else:
+            sky_changes = []
+        # Ask the physics engine if they'd like a look at that
         self.physics_engine.handle_change(offset, block)
+        if sky_changes:
+            self.physics_engine.handle_sky_changes(sky_changes)
+
+    def set_blocks(self, offsets, blocks):
+        """
+        Sets a batch of blocks in one pass. offsets is an array of block
+        offsets, and blocks a string holding one block byte per offset.
+        Later entries win if an offset appears twice.
+        """
+        assert len(offsets) == len(blocks)
+        if not len(offsets):
+            return
+        if self.block_view is not None:
+            offset_array = numpy.frombuffer(offsets, "u%d" % offsets.itemsize) if isinstance(offsets, array) else numpy.asarray(offsets)
+            highest = offset_array.max()
+        else:
+            highest = max(offsets)
+        if highest >= len(self.raw_blocks):
+            self.logger.warn("Tried to set %d blocks outside of %s!" % (len(offsets), self.world_name))
+            return
+        if self.block_view is not None:
+            flat = self.block_view.reshape(-1)
+            if self.sponge_field is not None:
+                touched = numpy.unique(offset_array)
+                was_sponge = flat[touched] == BLOCK_SPONGE
+            # Fancy indexing assigns in order, so later entries still win
+            flat[offset_array] = numpy.frombuffer(blocks, numpy.uint8)
+            if self.sponge_field is not None:
+                is_sponge = flat[touched] == BLOCK_SPONGE
+                self.sponge_field.update(touched[is_sponge & ~was_sponge], touched[was_sponge & ~is_sponge])
+            self.dirty_regions.update(numpy.unique(offset_array // self.region_bytes).tolist())
+        else:
+            raw_blocks = self.raw_blocks
+            if self.sponge_field is not None:
+                touched = set(offsets)
+                was_sponge = set([offset for offset in touched if raw_blocks[offset] == CHR_SPONGE])
+            for offset, block in zip(offsets, blocks):
+                raw_blocks[offset] = block
+            if self.sponge_field is not None:
+                is_sponge = set([offset for offset in touched if raw_blocks[offset] == CHR_SPONGE])
+                self.sponge_field.update(is_sponge - was_sponge, was_sponge - is_sponge)
+            region_bytes = self.region_bytes
+            self.dirty_regions.update([offset // region_bytes for offset in offsets])
+        self.unsaved_changes += len(offsets)
+        self.unsynced_changes += len(offsets)
+        self.journal.add_many(offsets, blocks)
+        self.generation += 1
+        sky_changes = self.height_map.update(offsets)
+        self.physics_engine.handle_changes(offsets)
+        if sky_changes:
+            self.physics_engine.handle_sky_changes(sky_changes)
 
     def __getitem__(self, (x, y, z)):   # TODO ditch this because can read raw_blocks
         "Return the value at position x, y, z - possibly not efficiently."
@@ -150,70 +450,210 @@ class BlockStore(Thread):
         try:
             return self.raw_blocks[offset]
         except (TypeError,):
+            # Expensive! Open the gzip and read the byte.
+            gz = gzip.GzipFile(self.blocks_path)
+            gz.seek(offset + 4)
+            block = gz.read(1)
+            gz.close()
+            return block
+
+    def resident_bytes(self):
+        "Roughly how much memory the blocks and the cached level are using."
+        level_cache = getattr(self, "level_cache", None)
+        index_bytes = self.sponge_field.nbytes() if self.sponge_field is not None else 0
+        index_bytes += self.height_map.nbytes() if self.height_map is not None else 0
+        # A physics process has a shared copy of the blocks
+        shared_bytes = self.x * self.y * self.z if self.physics_engine.remote else 0
+        return self.x * self.y * self.z + (len(level_cache[1]) if level_cache else 0) + index_bytes + shared_bytes
+
+    def level_stream(self, callback):
+        """
+        Calls callback with the level as a gzipped string, the way clients
+        want it, once it's ready. It's only recompressed if a block changed
+        since it was last asked for, and that happens in the pool.
+        """
+        if self.level_cache is not None and self.level_cache[0] == self.generation:
+            callback(self.level_cache[1])
+            return
+        self.level_callbacks.append(callback)
+        if len(self.level_callbacks) > 1:
+            return # Already on its way
+        generation = self.generation
+        if self.region_file:
+            # Regions that changed since they were written out get compressed
+            # fresh, and the rest come straight off disk
+            fresh = sorted(self.dirty_regions | self.saving_regions)
+            chunks = []
+            for region in fresh:
+                start, end = self.region_file.region_span(region)
+                chunks.append(self.raw_blocks[start:end].tostring())
+            assemble = lambda segments: self.region_file.gzip_stream(dict(zip(fresh, segments)))
+        else:
+            chunks = self.level_chunks()
+            assemble = assemble_gzip
+        def finished(segments):
             try:
-                return self.queued_blocks[offset]
-            except (IndexError, KeyError):
-                # Expensive! Open the gzip and read the byte.
-                gz = gzip.GzipFile(self.blocks_path)
-                gz.seek(offset + 4)
-                block = gz.read(1)
-                gz.close()
-                return block
-
-    def flush(self):
+                stream = assemble(segments)
+            except Exception as e:
+                # Can't read the regions back? Do the whole lot from memory then.
+                self.logger.error("Problem building the level for %s: %s" % (self.world_name, e))
+                stream = assemble_gzip(compress(self.level_chunks()))
+            self.level_cache = (generation, stream)
+            callbacks, self.level_callbacks = self.level_callbacks, []
+            for callback in callbacks:
+                callback(stream)
+        def failed(error):
+            self.logger.error("Problem compressing world %s: %s" % (self.world_name, error))
+            finished(compress(chunks))
+        self.start_compressing(chunks, finished, failed)
+
+    def level_chunks(self):
+        "Returns the size header and the whole level, cut up ready for compressing."
+        return [struct.pack("!i", len(self.raw_blocks))] + split(self.raw_blocks.tostring())
+
+    def start_compressing(self, chunks, on_done, on_error):
         """
-        Flushes queued blocks into the .gz file.
-        Needed before sending gzipped block data to clients.
+        Hands some strings to the compression pool. on_done gets called with
+        their (segment, crc32, size) tuples from this thread once they're
+        ready, or on_error with the exception if it went wrong.
         """
-        try:
-            if not self.queued_blocks:  # Don't flush if there's nothing to do
+        self.compressing.append([CompressJob(chunks), on_done, on_error])
+
+    def finish_compressing(self, wait=False):
+        "Runs the callbacks of finished compression jobs; wait=True waits for all of them."
+        while self.compressing:
+            job, on_done, on_error = self.compressing[0]
+            if not (wait or job.ready()):
                 return
-            self.logger.debug("Flushing %s..." % self.world_name)
-            # Open the old and the new file
-            if os.path.exists(self.blocks_path + ".new"):
-                os.remove(self.blocks_path + ".new")
-            gz = gzip.GzipFile(self.blocks_path)
-            new_gz = gzip.GzipFile(self.blocks_path + ".new", 'wb', compresslevel=4)
-            # Copy over the size header
-            new_gz.write(gz.read(4))
-            # Order the blocks we're going to write
-            ordered_blocks = sorted(self.queued_blocks.items())
-            # Start writing out the blocks in chunks, replacing as we go.
-            chunk_size = 1024
-            chunk = list(gz.read(chunk_size))
-            pos = 0
-            blocks_pos = 0
-            chunk_end = len(chunk)
-            while chunk:
-                while blocks_pos < len(ordered_blocks) and ordered_blocks[blocks_pos][0] < chunk_end:
-                    offset, value = ordered_blocks[blocks_pos]
-                    chunk[offset - pos] = value
-                    blocks_pos += 1
-                chunk_str = "".join(chunk)
-                new_gz.write(chunk_str)
-                pos += len(chunk)
-                chunk = list(gz.read(chunk_size))
-                chunk_end = pos + len(chunk)
-                # Safety first. If this isn't true, there's a bug.
-            assert blocks_pos == len(ordered_blocks)
-            new_gz.flush()
-            os.fsync(new_gz.fileno())
-            # OK, close up shop.
-            gz.close()
-            new_gz.close()
+            self.compressing.pop(0)
+            try:
+                try:
+                    segments = job.result()
+                except Exception as e:
+                    on_error(e)
+                else:
+                    on_done(segments)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+    def mark_dirty(self, offset, block):
+        "Notes that the block at offset needs writing into the blocks file."
+        self.dirty_regions.add(offset // self.region_bytes)
+        self.unsaved_changes += 1
+
+    def save(self, done=None):
+        """
+        Makes sure all changes so far are on disk. Normally that's just an
+        append to the journal; once that grows past the limit, it's folded
+        into the blocks file. done is called once the changes are safe.
+        """
+        self.unsynced_changes = 0
+        try:
+            self.journal.sync()
+        except (IOError, OSError) as e:
+            self.logger.error("Unable to write the journal for '%s': %s" % (self.world_name, e))
+            self.flush(done)
+            return
+        # (If a save is already underway, the next call will see to it.)
+        if self.journal.size() >= self.journal_limit and not self.saving:
+            self.logger.debug("Journal for '%s' is over the limit, compacting..." % self.world_name)
+            self.flush(done)
+        elif done is not None:
+            done()
+
+    def flush(self, done=None):
+        """
+        Writes queued blocks into the blocks file, and clears the journal.
+        Compression happens in the pool; done is called once it's all on
+        disk.
+        """
+        # One save at a time, please
+        if self.saving:
+            self.finish_compressing(wait=True)
+        if self.region_file:
+            self.flush_regions(done)
+        else:
+            self.flush_gzip(done)
 
-            # Make a backup of the old level and put the new one in place
-            if os.path.exists(self.blocks_path + ".old"):
-                os.remove(self.blocks_path + ".old")
-            os.rename(self.blocks_path, self.blocks_path + ".old")
-            os.rename(self.blocks_path + ".new", self.blocks_path)
+    def flush_done(self, done=None):
+        "Tidies up after a save."
+        self.saving = False
+        self.saving_regions = set()
+        # Everything is in the blocks file now, so the journal can go
+        if not self.dirty_regions:
+            self.journal.reset()
+        if done is not None:
+            done()
 
+    def flush_gzip(self, done=None):
+        "Writes a freshly compressed copy of the level over the .gz file."
+        if not self.dirty_regions:  # Don't flush if there's nothing to do
+            self.flush_done(done)
+            return
+        self.logger.debug("Flushing %s..." % self.world_name)
+        self.saving = True
+        saving, changes = self.dirty_regions, self.unsaved_changes
+        self.dirty_regions, self.unsaved_changes = set(), 0
+        chunks = self.level_chunks()
+        def finished(segments):
+            try:
+                if os.path.exists(self.blocks_path + ".new"):
+                    os.remove(self.blocks_path + ".new")
+                fh = open(self.blocks_path + ".new", "wb")
+                fh.write(assemble_gzip(segments))
+                fh.flush()
+                os.fsync(fh.fileno())
+                fh.close()
+                # Make a backup of the old level and put the new one in place
+                if os.path.exists(self.blocks_path + ".old"):
+                    os.remove(self.blocks_path + ".old")
+                os.rename(self.blocks_path, self.blocks_path + ".old")
+                os.rename(self.blocks_path + ".new", self.blocks_path)
+            except Exception as a:
+                failed(a)
+                return
             self.logger.info("World '%s' has been saved with %d changes." %
-                             (self.world_name, len(self.queued_blocks)))
-            self.queued_blocks = {}
-        except Exception as a:
+                             (self.world_name, changes))
+            self.flush_done(done)
+        def failed(error):
+            # Those changes still need saving
+            self.dirty_regions.update(saving)
+            self.unsaved_changes += changes
+            self.logger.error("Problem saving world %s" % self.world_name)
+            self.logger.error("Error: %s" % error)
+            self.flush_done(done)
+        self.start_compressing(chunks, finished, failed)
+
+    def flush_regions(self, done=None):
+        "Rewrites only the dirty regions of a region-format world."
+        if not self.dirty_regions:
+            self.flush_done(done)
+            return
+        self.logger.debug("Flushing %s..." % self.world_name)
+        self.saving = True
+        dirty = sorted(self.dirty_regions)
+        changes = self.unsaved_changes
+        self.saving_regions, self.dirty_regions, self.unsaved_changes = set(dirty), set(), 0
+        chunks = []
+        for region in dirty:
+            start, end = self.region_file.region_span(region)
+            chunks.append(self.raw_blocks[start:end].tostring())
+        def finished(segments):
+            try:
+                self.region_file.write_segments(dict(zip(dirty, segments)))
+            except Exception as a:
+                failed(a)
+                return
+            self.logger.info("World '%s' has been saved with %d changes in %d regions." %
+                             (self.world_name, changes, len(dirty)))
+            self.flush_done(done)
+        def failed(error):
+            self.dirty_regions.update(dirty)
+            self.unsaved_changes += changes
             self.logger.error("Problem saving world %s" % self.world_name)
-            self.logger.error("Error: %s" % a)
+            self.logger.error("Error: %s" % error)
+            self.flush_done(done)
+        self.start_compressing(chunks, finished, failed)
 
     @classmethod
     def create_new(cls, blocks_path, sx, sy, sz, levels):
@@ -222,11 +662,8 @@ class BlockStore(Thread):
         level, signifying its block type.
         """
         assert len(levels) == sy
-        # Open the gzip
-        fh = gzip.GzipFile(blocks_path, mode="wb")
-        # Write a size header
-        fh.write(struct.pack("!i", sx * sy * sz))
-        # Write each level
-        for level in levels:
-            fh.write(chr(level) * (sx * sz))
+        header = struct.pack("!i", sx * sy * sz)
+        data = "".join([chr(level) * (sx * sz) for level in levels])
+        fh = open(blocks_path, "wb")
+        fh.write(assemble_gzip(compress([header] + split(data))))
         fh.close()
@@ -0,0 +1,99 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+A process pool that deflates world data in parallel (and does other heavy
+lifting, like generating terrain, through PoolJob).
+Data is cut into segments which are compressed on their own (see
+arc.gzipstream), so however many processes did the work, the result can be
+put back together into one ordinary gzip member.
+"""
+
+import multiprocessing, signal
+
+from arc.gzipstream import *
+
+SEGMENT_BYTES = 1024 * 1024 # Big enough that splitting barely costs any compression
+
+_pool = None
+
+def _init_worker():
+    # Ctrl-C is the server's business, not ours
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _deflate(job):
+    data, level = job
+    return deflate_segment(data, level), crc32(data), len(data)
+
+def start_pool(processes=0):
+    """
+    Starts the compression pool; processes=0 means one per CPU. Call this
+    early, before the world workers are running, since it forks.
+    Passing a negative number leaves the pool off, and compression happens
+    in the calling thread instead.
+    """
+    global _pool
+    stop_pool()
+    if processes < 0:
+        return
+    if processes == 0:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    _pool = multiprocessing.Pool(processes, _init_worker)
+
+def stop_pool():
+    "Shuts the compression pool down, letting queued jobs finish first."
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        pool.close()
+        pool.join()
+
+def split(data, size=SEGMENT_BYTES):
+    "Cuts a string into segment-sized pieces."
+    return [data[i:i + size] for i in xrange(0, len(data), size)] or [""]
+
+class PoolJob(object):
+    """
+    A batch of calls to function, one per job, that's either running in the
+    pool or already done. Poll ready(), then call result() for the list of
+    return values, in the same order as the jobs went in. function has to
+    live at the top level of a module, so the pool can find it.
+    """
+
+    def __init__(self, function, jobs):
+        self.async_result = None
+        if _pool is not None:
+            try:
+                self.async_result = _pool.map_async(function, jobs)
+            except (ValueError, AssertionError):
+                # The pool's been shut down under us (i.e. we're exiting)
+                pass
+        if self.async_result is None:
+            self.results = map(function, jobs)
+
+    def ready(self):
+        return self.async_result is None or self.async_result.ready()
+
+    def result(self):
+        "Returns the results, waiting for them if need be. Raises if a call failed."
+        if self.async_result is not None:
+            self.results = self.async_result.get()
+            self.async_result = None
+        return self.results
+
+class CompressJob(PoolJob):
+    """
+    A compression job; its result() is the list of (segment, crc32, size)
+    tuples for the chunks it was given.
+    """
+
+    def __init__(self, chunks, level=4):
+        PoolJob.__init__(self, _deflate, [(chunk, level) for chunk in chunks])
+
+def compress(chunks, level=4):
+    "Compresses the given strings in parallel, and waits for the segments."
+    return CompressJob(chunks, level).result()
@@ -45,6 +45,17 @@ CONFIG = [
     ("default_name", ("options.conf", "worlds", "default_name"), None, False, "get", None, True, None),
     ("default_backup", ("options.conf", "worlds", "default_backup"), None, True, "get", None, False, "main"),
     ("asd_delay", ("options.conf", "worlds", "asd_delay"), None, True, "getint", "startASDLoop", False, 5),
+    ("region_worlds", ("options.conf", "worlds", "region_worlds"), None, True, "getboolean", None, False, False),
+    ("journal_limit", ("options.conf", "worlds", "journal_limit"), None, True, "getint", None, False, 1024),
+    ("save_processes", ("options.conf", "worlds", "save_processes"), None, False, "getint", None, False, 0),
+    ("world_memory", ("options.conf", "worlds", "world_memory"), None, True, "getint", None, False, 1024),
+    ("save_interval", ("options.conf", "worlds", "save_interval"), None, True, "getint", None, False, 60),
+    ("save_concurrency", ("options.conf", "worlds", "save_concurrency"), None, True, "getint", None, False, 2),
+    ("numpy_blocks", ("options.conf", "worlds", "numpy_blocks"), None, False, "getboolean", None, False, True),
+    ("world_workers", ("options.conf", "worlds", "world_workers"), None, False, "getint", None, False, 4),
+    ("physics_interval", ("options.conf", "worlds", "physics_interval"), None, True, "getint", None, False, 700),
+    ("physics_budget", ("options.conf", "worlds", "physics_budget"), None, True, "getint", None, False, 200),
+    ("physics_catchup", ("options.conf", "worlds", "physics_catchup"), None, True, "getint", None, False, 2),
     ("backup_auto", ("options.conf", "backups", "backup_auto"), None, True, "get", "initBackupLoop", False, True),
     ("backup_freq", ("options.conf", "backups", "backup_freq"), "self.backup_auto == True", True, "getint",
      "changeBackupFrequency", False, 10),
@@ -163,6 +174,12 @@ TASK_FWATERON = 15
 TASK_FWATEROFF = 16
 TASK_PLAYERRESPAWN = 17
 TASK_INSTANTRESPAWN = 18
+TASK_SAVE = 19
+TASK_LEVELSTREAM = 20
+TASK_BLOCKSETS = 21
+TASK_PHYSICSENGINE = 22
+TASK_PHYSICSPROCESS = 23
+TASK_PHYSICSWAKE = 24
 
 COLOUR_BLACK = "&0"
 COLOUR_DARKBLUE = "&1"
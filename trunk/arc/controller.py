@@ -141,6 +141,20 @@ class ControllerProtocol(LineReceiver):
     def commandWorlds(self, data):
         self.sendJson({"worlds": list(self.factory.worlds.keys())})
 
+    def commandMemory(self, data):
+        memory = self.factory.worldMemory()
+        self.sendJson({"memory": {
+            "used": sum(memory.values()),
+            "budget": self.factory.world_memory * 1024 * 1024,
+            "worlds": memory,
+            }})
+
+    def commandSaves(self, data):
+        self.sendJson({"saves": dict(
+            (world_id, {"last_save": last_save, "backlog": backlog})
+            for world_id, (last_save, backlog) in self.factory.saveStatus().items()
+            )})
+
     def commandUserworlds(self, data):
         self.sendJson({"worlds": [
         (world.id, [client.username for client in world.clients if client.username], {
@@ -157,6 +171,9 @@ class ControllerProtocol(LineReceiver):
             "y": world.y,
             "z": world.z,
             "owner": world.status["owner"],
+            "memory": world.resident_bytes(),
+            "last_save": world.last_saved,
+            "backlog": world.backlog(),
             })
         for world in self.factory.worlds.values()
         ]})
@@ -177,6 +194,9 @@ class ControllerProtocol(LineReceiver):
             "y": world.y,
             "z": world.z,
             "owner": world.status["owner"],
+            "memory": world.resident_bytes(),
+            "last_save": world.last_saved,
+            "backlog": world.backlog(),
             })
 
 
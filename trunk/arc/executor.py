@@ -0,0 +1,153 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+A fixed set of worker threads that run every world's BlockStore (and its
+physics), instead of each world having two threads of its own. A store is
+queued whenever a task lands in its in_queue or its physics is due, and a
+worker runs it for one slice, a short time budget, before moving on to the
+next store in line, so a busy world can't starve the others.
+"""
+
+import heapq, time, traceback
+from collections import deque
+from threading import Condition, Thread
+
+from arc.logger import ColouredLogger
+
+SLICE_TIME = 0.05 # Seconds a store gets before it goes to the back of the line
+
+_executor = None
+
+class WorldExecutor(object):
+    """
+    Runs stores on a pool of worker threads. A store is anything with a
+    run_slice(deadline) method, which does what it can before deadline (a
+    time.time() value) and returns how many seconds it wants to wait
+    before its next slice: 0 to go again as soon as it's its turn, or None
+    to wait until it's woken up by schedule().
+    """
+
+    def __init__(self, workers):
+        self.logger = ColouredLogger()
+        self.condition = Condition()
+        self.ready = deque() # Stores waiting for a worker, oldest first
+        self.timers = [] # Heap of (when, sequence, store) for stores that asked to wait
+        self.sequence = 0
+        self.queued = set() # Stores in ready (by id), so nothing is in line twice
+        self.running = set() # Stores a worker has right now
+        self.woken = set() # Running stores that were scheduled meanwhile, so go again
+        self.stores = set() # Every store that hasn't finished
+        self.stopping = False
+        self.threads = []
+        for i in range(max(1, workers)):
+            thread = Thread(target=self.work, name="World worker %d" % (i + 1))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, store):
+        "Takes on a new store and gives it its first slice."
+        with self.condition:
+            self.stores.add(store)
+        self.schedule(store)
+
+    def remove(self, store):
+        "Forgets a store once it's finished for good."
+        with self.condition:
+            self.stores.discard(store)
+            self.condition.notifyAll()
+
+    def schedule(self, store, delay=0):
+        "Queues store to run, after delay seconds if given."
+        with self.condition:
+            if store not in self.stores:
+                return
+            if delay > 0:
+                self.sequence += 1
+                heapq.heappush(self.timers, (time.time() + delay, self.sequence, store))
+            elif store in self.running:
+                self.woken.add(store)
+            elif store not in self.queued:
+                self.queued.add(store)
+                self.ready.append(store)
+            self.condition.notifyAll()
+
+    def next_store(self):
+        "Waits for a store that needs running and takes it. Call with the condition held."
+        while not self.stopping:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, sequence, store = heapq.heappop(self.timers)
+                if store in self.stores and store not in self.queued and store not in self.running:
+                    self.queued.add(store)
+                    self.ready.append(store)
+            if self.ready:
+                store = self.ready.popleft()
+                self.queued.discard(store)
+                self.running.add(store)
+                return store
+            self.condition.wait((self.timers[0][0] - now) if self.timers else None)
+        return None
+
+    def work(self):
+        "The loop each worker thread runs."
+        while True:
+            with self.condition:
+                store = self.next_store()
+            if store is None:
+                return
+            try:
+                delay = store.run_slice(time.time() + SLICE_TIME)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                delay = 0.5 # Don't spin on a broken store
+            with self.condition:
+                self.running.discard(store)
+                if store in self.woken:
+                    self.woken.discard(store)
+                    delay = 0
+            if delay is not None:
+                self.schedule(store, delay)
+
+    def wait_idle(self, timeout=None):
+        "Waits until every store has finished (i.e. stopped). Returns False on timeout."
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.stores:
+                if end is not None and time.time() >= end:
+                    return False
+                self.condition.wait(None if end is None else end - time.time())
+        return True
+
+    def stop(self):
+        "Stops the worker threads; stores that are still around won't run again."
+        with self.condition:
+            self.stopping = True
+            self.condition.notifyAll()
+        for thread in self.threads:
+            thread.join()
+
+def start_executor(workers=4):
+    "Starts the world workers; BlockStores started after this run on them."
+    global _executor
+    stop_executor()
+    _executor = WorldExecutor(workers)
+
+def get_executor():
+    "Returns the world executor, starting a default one if need be."
+    if _executor is None:
+        start_executor()
+    return _executor
+
+def stop_executor(timeout=None):
+    """
+    Lets stopping worlds finish up (waiting at most timeout seconds), then
+    stops the workers.
+    """
+    global _executor
+    if _executor is not None:
+        executor, _executor = _executor, None
+        executor.wait_idle(timeout)
+        executor.stop()
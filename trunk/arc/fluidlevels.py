@@ -0,0 +1,222 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+Finite water that keeps track of how full each block of it is, so it can
+flow into flat pools and stop, rather than shuffling whole blocks about
+for ever. The volume of water is kept exactly as it moves; only spouts
+(which make it) and sponges under it (which soak it up) change how much
+there is. Clients can only see full blocks of water or none, so each
+body of partly full cells (those joined through their faces) is shown as
+however many whole blocks its water adds up to, in the fullest of its
+cells, and a cell only changes block when that choice moves.
+"""
+
+from arc.constants import *
+
+MAX_LEVEL = 32 # How much water a full block holds
+# A cell gives each lower neighbour beside it 1/FLOW_SHARE of the difference between them. With four
+# neighbours and a share of five it can never give away more than it has, or fill one past full.
+FLOW_SHARE = 5
+
+CHR_AIR = chr(BLOCK_AIR)
+CHR_WATER = chr(BLOCK_WATER)
+CHR_SPONGE = chr(BLOCK_SPONGE)
+
+class FluidLevels(object):
+    """
+    The fill levels of a world's finite water, and the rules they flow by.
+    Only cells whose level isn't what their block says (a water block is
+    full, air is empty) are kept, in levels. Each pass, water first falls
+    as far as the cell below has room, then spreads out sideways; every
+    cell works from the levels at the start of each of those steps, so the
+    order cells are looked at in doesn't matter. Then each body of cells in
+    levels that moved is shown as water or air, so that it has one water
+    block for every whole MAX_LEVEL of water in it; bodies that didn't move
+    are left as they are.
+    """
+
+    def __init__(self, blockstore):
+        self.blockstore = blockstore
+        self.levels = {} # Offset: level, for cells whose level isn't what their block says
+        self.active = set() # Cells whose level moved last pass, to look at again
+        self.sent = {} # Offset: block, for the changes we've sent that haven't come back yet
+
+    def clear(self):
+        "Forgets every level; the blocks say what's where again."
+        self.levels = {}
+        self.active = set()
+        self.sent = {}
+
+    def take_active(self):
+        "Returns (and forgets) the cells that need looking at again."
+        active, self.active = self.active, set()
+        return active
+
+    def level(self, offset):
+        "How full the cell at offset is, or None if water can't go there."
+        try:
+            return self.levels[offset]
+        except KeyError:
+            block = self.blockstore.raw_blocks[offset]
+            if block == CHR_WATER:
+                return MAX_LEVEL
+            if block == CHR_AIR:
+                return 0
+            return None
+
+    def volume(self):
+        "The total amount of water in the world, in levels."
+        blocks = buffer(self.blockstore.raw_blocks)[:]
+        total = blocks.count(CHR_WATER) * MAX_LEVEL
+        for offset, level in self.levels.items():
+            total += level - (MAX_LEVEL if blocks[offset] == CHR_WATER else 0)
+        return total
+
+    def note_changes(self, offsets):
+        """
+        Drops the level of any cell whose block has changed other than how
+        we asked, as someone's built or dug there; its block says what's in
+        it now.
+        """
+        if not self.levels and not self.sent:
+            return
+        levels = self.levels
+        sent = self.sent
+        raw_blocks = self.blockstore.raw_blocks
+        for offset in offsets:
+            if sent.pop(offset, None) == raw_blocks[offset]:
+                continue
+            if offset in levels:
+                del levels[offset]
+
+    def step(self, cells, spouts):
+        """
+        Does one pass over cells (offsets of water, or of cells whose level
+        moved last pass), with water spouts at the offsets in spouts
+        filling the cells under them. Returns the block changes clients
+        need to see, as (offset, block) pairs.
+        """
+        blockstore = self.blockstore
+        raw_blocks = blockstore.raw_blocks
+        table = blockstore.neighbours
+        layer = table.layer
+        new = {} # Levels this pass has changed
+        def get(offset):
+            return new[offset] if offset in new else self.level(offset)
+        def apply(moves):
+            for source, target, amount in moves:
+                new[source] = get(source) - amount
+                if target is not None:
+                    new[target] = get(target) + amount
+        # Spouts fill the cell under them right up
+        for offset in spouts:
+            if offset >= layer:
+                level = get(offset - layer)
+                if level is not None and level < MAX_LEVEL:
+                    new[offset - layer] = MAX_LEVEL
+        # Water falls as far as the cell below has room, or soaks into a sponge
+        wet = set([offset for offset in cells if get(offset)])
+        moves = []
+        for offset in wet:
+            if offset < layer:
+                continue
+            below = offset - layer
+            if raw_blocks[below] == CHR_SPONGE:
+                moves.append((offset, None, get(offset)))
+                continue
+            level = get(below)
+            if level is not None and level < MAX_LEVEL:
+                moves.append((offset, below, min(get(offset), MAX_LEVEL - level)))
+        apply(moves)
+        # What didn't fall spreads out to lower cells beside it
+        fell = set([move[0] for move in moves])
+        moves = []
+        for offset in wet:
+            if offset in fell:
+                continue
+            level = get(offset)
+            x, y, z = blockstore.get_coords(offset)
+            for beside in table.offsets_around(x, y, z, offset, table.horizontal):
+                other = get(beside)
+                if other is not None and level - other >= FLOW_SHARE:
+                    moves.append((offset, beside, (level - other) // FLOW_SHARE))
+        apply(moves)
+        # Look at whatever moved again next time
+        levels = self.levels
+        moved = []
+        for offset, level in new.items():
+            if level != self.level(offset):
+                levels[offset] = level
+                moved.append(offset)
+                x, y, z = blockstore.get_coords(offset)
+                self.active.add(offset)
+                self.active.update(table.offsets_around(x, y, z, offset, table.faces))
+        # Only the bodies that moved need their water blocks picking again
+        changes = []
+        for body in self.pieces([offset for offset in moved if offset in levels]):
+            changes.extend(self.show(body))
+        return changes
+
+    def body(self, start):
+        "Returns the cells in levels joined to the one at start through their faces, itself included."
+        levels = self.levels
+        blockstore = self.blockstore
+        table = blockstore.neighbours
+        body = set([start])
+        todo = [start]
+        while todo:
+            offset = todo.pop()
+            x, y, z = blockstore.get_coords(offset)
+            for other in table.offsets_around(x, y, z, offset, table.faces):
+                if other in levels and other not in body:
+                    body.add(other)
+                    todo.append(other)
+        return body
+
+    def show(self, body):
+        """
+        Picks which cells of a body (see body) show as water: as many as the
+        water in them adds up to whole blocks, fullest first (then those
+        already showing, then the lowest). Returns the block changes that
+        takes, and drops the levels their new blocks now say. If dropping
+        them splits the body up, each piece is shown on its own.
+        """
+        levels = self.levels
+        raw_blocks = self.blockstore.raw_blocks
+        blocks = {} # Offset: the block we've picked for it
+        bodies = [body]
+        while bodies:
+            body = bodies.pop()
+            count = sum([levels[offset] for offset in body]) // MAX_LEVEL
+            ranked = sorted(body, key=lambda offset: (-levels[offset], blocks.get(offset, raw_blocks[offset]) != CHR_WATER, offset))
+            shown = set(ranked[:count])
+            dropped = False
+            for offset in ranked:
+                visible = offset in shown
+                blocks[offset] = CHR_WATER if visible else CHR_AIR
+                if levels[offset] == (MAX_LEVEL if visible else 0):
+                    del levels[offset]
+                    dropped = True
+            if dropped:
+                pieces = self.pieces([offset for offset in body if offset in levels])
+                if len(pieces) > 1:
+                    bodies.extend(pieces)
+        changes = []
+        for offset, block in blocks.items():
+            if raw_blocks[offset] != block:
+                changes.append((offset, ord(block)))
+                self.sent[offset] = block
+        return changes
+
+    def pieces(self, cells):
+        "Splits cells (all in levels) into the bodies they make up."
+        pieces = []
+        done = set()
+        for offset in cells:
+            if offset not in done:
+                body = self.body(offset)
+                done.update(body)
+                pieces.append(body)
+        return pieces
@@ -0,0 +1,94 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+Helpers for building a single gzip member out of independently deflated
+segments. Each segment is raw deflate data ending on a sync flush, so the
+segments can simply be laid end to end; we then add one empty final block,
+the gzip header and a trailer with the combined CRC32.
+"""
+
+import struct, time, zlib
+
+GZIP_FINAL_BLOCK = "\x03\x00"
+
+def deflate_segment(data, level=4):
+    "Deflates a string into a non-final, sync-flushed raw deflate segment."
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def inflate_segment(segment):
+    "Inflates a segment made by deflate_segment."
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(segment)
+
+def crc32(data, value=0):
+    "zlib.crc32, but always unsigned."
+    return zlib.crc32(data, value) & 0xffffffff
+
+def _gf2_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, matrix[n]) for n in xrange(32)]
+
+_combine_ops = {}
+
+def _combine_op(length):
+    "Returns the GF(2) operator that shifts a CRC over length zero bytes."
+    op = _combine_ops.get(length)
+    if op is not None:
+        return op
+    # Start with the operator for one zero bit, square up to one byte
+    odd = [0xedb88320] + [1 << n for n in xrange(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    # Identity, then multiply in every power of two set in length
+    op = [1 << n for n in xrange(32)]
+    power = odd
+    remaining = length
+    while remaining:
+        power = _gf2_square(power)
+        if remaining & 1:
+            op = [_gf2_times(power, column) for column in op]
+        remaining >>= 1
+    _combine_ops[length] = op
+    return op
+
+def crc32_combine(crc1, crc2, length2):
+    "Combines CRC32s of two strings, given the length of the second one."
+    if length2 <= 0:
+        return crc1
+    return _gf2_times(_combine_op(length2), crc1 & 0xffffffff) ^ (crc2 & 0xffffffff)
+
+def gzip_header(mtime=None):
+    "Returns a minimal gzip member header."
+    if mtime is None:
+        mtime = int(time.time())
+    return struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, mtime & 0xffffffff, 0, 255)
+
+def gzip_trailer(crc, size):
+    "Returns the gzip member trailer for the given CRC32 and data size."
+    return struct.pack("<II", crc & 0xffffffff, size & 0xffffffff)
+
+def assemble_gzip(segments):
+    """
+    Given an iterable of (segment, crc32, size) tuples, returns the whole gzip
+    member as a string.
+    """
+    parts = [gzip_header()]
+    crc, size = 0, 0
+    for segment, segment_crc, segment_size in segments:
+        parts.append(segment)
+        crc = crc32_combine(crc, segment_crc, segment_size)
+        size += segment_size
+    parts.append(GZIP_FINAL_BLOCK)
+    parts.append(gzip_trailer(crc, size))
+    return "".join(parts)
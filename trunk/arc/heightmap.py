@@ -0,0 +1,127 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import string
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from arc.constants import *
+
+# Blocks the sun shines through; anything else (water included) casts a shadow
+SEE_THROUGH = [BLOCK_AIR, BLOCK_GLASS, BLOCK_LEAVES]
+SEE_THROUGH_CHRS = "".join([chr(block) for block in SEE_THROUGH])
+# Turns a run of blocks into "\1" for each opaque one and "\0" for each see-through one
+OPAQUE = string.maketrans("".join([chr(block) for block in range(256)]),
+    "".join([("\0" if block in SEE_THROUGH else "\1") for block in range(256)]))
+COLUMN_CHUNK = 16384 # Columns worked out in one go with NumPy
+
+class HeightMap(object):
+    """
+    The y of the highest opaque block in every (x, z) column of a world, or
+    -1 for columns with nothing but see-through blocks in them. A block can
+    see the sky if it's at or above its column's height. It's built from the
+    blocks once, then kept up to date by whoever changes them.
+    """
+
+    def __init__(self, blockstore):
+        self.x, self.y, self.z = blockstore.x, blockstore.y, blockstore.z
+        self.raw_blocks = blockstore.raw_blocks
+        self.view = blockstore.block_view
+        if self.view is not None:
+            self.opaque = numpy.ones(256, bool)
+            self.opaque[SEE_THROUGH] = False
+            self.heights = numpy.empty((self.z, self.x), numpy.int16)
+            self.flat = self.heights.reshape(-1)
+            columns = numpy.arange(self.x * self.z)
+            for start in xrange(0, len(columns), COLUMN_CHUNK):
+                chunk = columns[start:start + COLUMN_CHUNK]
+                self.flat[chunk] = self.column_heights(chunk // self.x, chunk % self.x)
+        else:
+            self.heights = None
+            self.flat = array('h', [-1]) * (self.x * self.z)
+            # Work down from the top a layer at a time, until every column has found its height
+            layer = self.x * self.z
+            left = layer
+            blocks = buffer(self.raw_blocks)[:]
+            for y in xrange(self.y - 1, -1, -1):
+                opaque = blocks[y * layer:(y + 1) * layer].translate(OPAQUE)
+                column = opaque.find("\1")
+                while column != -1:
+                    if self.flat[column] == -1:
+                        self.flat[column] = y
+                        left -= 1
+                    column = opaque.find("\1", column + 1)
+                if not left:
+                    break
+
+    def nbytes(self):
+        return self.x * self.z * 2
+
+    def column_heights(self, zs, xs):
+        "Works out, from the blocks, the heights of the columns at the given coordinate arrays."
+        opaque = self.opaque[self.view[:, zs, xs]]
+        heights = self.y - 1 - opaque[::-1].argmax(axis=0)
+        heights[~opaque.any(axis=0)] = -1
+        return heights
+
+    def height(self, x, z):
+        "Returns the y of the highest opaque block at x, z, or -1 if there isn't one."
+        return int(self.flat[z * self.x + x])
+
+    def sky_visible(self, offset):
+        "Says if nothing opaque is above the block at offset."
+        layer = self.x * self.z
+        return offset // layer >= self.flat[offset % layer]
+
+    def update(self, offsets):
+        """
+        Catches up with the blocks at offsets having changed (they must
+        already have their new values). Returns the offsets of blocks that
+        have just gained or lost the sky: the old and new top of every
+        column whose height moved.
+        """
+        layer = self.x * self.z
+        if self.view is not None:
+            if isinstance(offsets, array):
+                offsets = numpy.frombuffer(offsets, "u%d" % offsets.itemsize)
+            columns = numpy.unique(numpy.asarray(offsets, numpy.int64) % layer)
+            before = self.flat[columns].astype(numpy.int64)
+            after = self.column_heights(columns // self.x, columns % self.x)
+            moved = before != after
+            if not moved.any():
+                return []
+            columns, before, after = columns[moved], before[moved], after[moved]
+            self.flat[columns] = after
+            tops = numpy.concatenate([before * layer + columns, after * layer + columns])
+            return tops[numpy.concatenate([before, after]) >= 0].tolist()
+        raw_blocks = self.raw_blocks
+        flat = self.flat
+        before = {}
+        for offset in offsets:
+            column = offset % layer
+            y = offset // layer
+            top = flat[column]
+            if column not in before:
+                before[column] = top
+            if raw_blocks[offset] not in SEE_THROUGH_CHRS:
+                if y > top:
+                    flat[column] = y
+            elif y == top:
+                # The top's gone; look down for the next one
+                below = offset - layer
+                while below >= 0 and raw_blocks[below] in SEE_THROUGH_CHRS:
+                    below -= layer
+                flat[column] = below // layer if below >= 0 else -1
+        tops = []
+        for column, top in before.items():
+            if flat[column] != top:
+                if top >= 0:
+                    tops.append(top * layer + column)
+                if flat[column] >= 0:
+                    tops.append(flat[column] * layer + column)
+        return tops
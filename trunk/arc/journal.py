@@ -0,0 +1,140 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import os, struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+JOURNAL_MAGIC = "ARCJ"
+JOURNAL_VERSION = 1
+JOURNAL_HEADER = "!4sBi"
+JOURNAL_RECORD = "!Ic"
+JOURNAL_RECORD_SIZE = struct.calcsize(JOURNAL_RECORD)
+JOURNAL_BATCH = 4096 # Records buffered before we hit the disk anyway
+if numpy is not None:
+    # The same layout as JOURNAL_RECORD, for packing big batches in one go
+    JOURNAL_DTYPE = numpy.dtype([("offset", ">u4"), ("block", "S1")])
+
+class BlockJournal(object):
+    """
+    An append-only log of block changes (offset + block byte) that sits next
+    to a world's blocks file. Changes get appended in batches, so making them
+    durable is a cheap sequential write instead of a rewrite of blocks.gz.
+    Replaying a journal is idempotent, so it is only truncated once its
+    changes have been folded into the blocks file.
+    """
+
+    def __init__(self, blocks_path, volume):
+        self.path = os.path.splitext(blocks_path)[0] + ".journal"
+        self.volume = volume
+        self.pending = []
+        self.pending_records = 0
+        self.fh = None
+
+    def add(self, offset, block):
+        "Queues a change for the journal."
+        self.pending.append(struct.pack(JOURNAL_RECORD, offset, block))
+        self.pending_records += 1
+        if self.pending_records >= JOURNAL_BATCH:
+            self.write()
+
+    def add_many(self, offsets, blocks):
+        "Queues a batch of changes; blocks has one byte per offset."
+        if numpy is not None and len(offsets) > 64:
+            records = numpy.empty(len(offsets), JOURNAL_DTYPE)
+            if isinstance(offsets, array):
+                offsets = numpy.frombuffer(offsets, "u%d" % offsets.itemsize)
+            records["offset"] = offsets
+            records["block"] = numpy.frombuffer(blocks, "S1")
+            self.pending.append(records.tostring())
+        else:
+            pack = struct.pack
+            self.pending.append("".join([pack(JOURNAL_RECORD, offset, block) for offset, block in zip(offsets, blocks)]))
+        self.pending_records += len(offsets)
+        if self.pending_records >= JOURNAL_BATCH:
+            self.write()
+
+    def open(self):
+        if self.fh is None:
+            exists = os.path.isfile(self.path)
+            self.fh = open(self.path, "ab")
+            if not exists or self.fh.tell() == 0:
+                self.fh.write(struct.pack(JOURNAL_HEADER, JOURNAL_MAGIC, JOURNAL_VERSION, self.volume))
+        return self.fh
+
+    def write(self):
+        "Appends the pending batch to the journal file."
+        if not self.pending:
+            return
+        fh = self.open()
+        fh.write("".join(self.pending))
+        self.pending = []
+        self.pending_records = 0
+
+    def sync(self):
+        "Writes out the pending batch and makes sure it's on disk."
+        self.write()
+        if self.fh is not None:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def size(self):
+        "Returns the size of the journal in bytes, including what's pending."
+        size = self.pending_records * JOURNAL_RECORD_SIZE
+        if self.fh is not None:
+            size += self.fh.tell()
+        elif os.path.isfile(self.path):
+            size += os.path.getsize(self.path)
+        return size
+
+    def replay(self, apply):
+        """
+        Calls apply(offset, block) for every record in the journal, oldest
+        first. A torn record at the end (from a crash mid-write) is ignored.
+        Returns the number of records replayed.
+        """
+        if not os.path.isfile(self.path):
+            return 0
+        fh = open(self.path, "rb")
+        try:
+            header = fh.read(struct.calcsize(JOURNAL_HEADER))
+            if len(header) < struct.calcsize(JOURNAL_HEADER):
+                return 0
+            magic, version, volume = struct.unpack(JOURNAL_HEADER, header)
+            if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+                raise IOError("%s is not a version %d block journal" % (self.path, JOURNAL_VERSION))
+            if volume != self.volume:
+                raise IOError("%s was written for a world of %d blocks, not %d" % (self.path, volume, self.volume))
+            count = 0
+            chunk = fh.read(JOURNAL_RECORD_SIZE * 1024)
+            while chunk:
+                usable = len(chunk) - (len(chunk) % JOURNAL_RECORD_SIZE)
+                for position in xrange(0, usable, JOURNAL_RECORD_SIZE):
+                    offset, block = struct.unpack_from(JOURNAL_RECORD, chunk, position)
+                    if offset < volume:
+                        apply(offset, block)
+                        count += 1
+                if usable != len(chunk):
+                    break
+                chunk = fh.read(JOURNAL_RECORD_SIZE * 1024)
+            return count
+        finally:
+            fh.close()
+
+    def reset(self):
+        "Throws the journal away; call once its changes are in the blocks file."
+        self.pending = []
+        self.pending_records = 0
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
@@ -0,0 +1,76 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+Neighbour offset tables. Turning coordinates into offsets one neighbour at
+a time (with get_offset's bounds asserts) is most of what a physics check
+costs, so each world works out, once, how far apart in the level its
+neighbours are. Blocks far enough from the edges of the world for a table
+to fit around them skip the bounds checks altogether.
+"""
+
+# The four blocks beside one, in the order physics tries them
+HORIZONTAL = [(0, 0, 1), (0, 0, -1), (1, 0, 0), (-1, 0, 0)]
+# Beside one and down a level, then the diagonals down a level
+BELOW_STRAIGHT = [(0, -1, 1), (0, -1, -1), (1, -1, 0), (-1, -1, 0)]
+BELOW_DIAGONAL = [(1, -1, 1), (1, -1, -1), (-1, -1, 1), (-1, -1, -1)]
+# All six faces
+FACES = HORIZONTAL + [(0, 1, 0), (0, -1, 0)]
+
+def cube(radius):
+    "Returns the deltas of every block within radius (a cube), but not the middle one."
+    return [(dx, dy, dz)
+        for dx in range(-radius, radius + 1)
+        for dy in range(-radius, radius + 1)
+        for dz in range(-radius, radius + 1)
+        if dx or dy or dz]
+
+class Neighbours(object):
+    "One set of neighbours, worked out for a world: (dx, dy, dz, offset delta) each."
+
+    def __init__(self, deltas, row, layer):
+        self.deltas = [(dx, dy, dz, dy * layer + dz * row + dx) for dx, dy, dz in deltas]
+        self.offsets = [delta[3] for delta in self.deltas]
+        self.reach = max([max(abs(dx), abs(dy), abs(dz)) for dx, dy, dz in deltas] or [0])
+
+class NeighbourTable(object):
+    """
+    The neighbour sets physics (or anything else) looks at, for a world of
+    the given size. Use around() for coordinates and offsets of the
+    neighbours that are in the world, or offsets_around() for just offsets.
+    """
+
+    def __init__(self, sx, sy, sz):
+        self.x, self.y, self.z = sx, sy, sz
+        self.row = sx # Offset step of one block along z
+        self.layer = sx * sz # Offset step of one block up
+        self.horizontal = self.neighbours(HORIZONTAL)
+        self.below_straight = self.neighbours(BELOW_STRAIGHT)
+        self.below_diagonal = self.neighbours(BELOW_DIAGONAL)
+        self.faces = self.neighbours(FACES)
+        self.cube2 = self.neighbours(cube(2))
+
+    def neighbours(self, deltas):
+        "Works out a Neighbours for deltas in this world; build your own sets with this."
+        return Neighbours(deltas, self.row, self.layer)
+
+    def interior(self, x, y, z, reach):
+        "Says if every block within reach of x, y, z is inside the world."
+        return reach <= x < self.x - reach and reach <= y < self.y - reach and reach <= z < self.z - reach
+
+    def around(self, x, y, z, offset, neighbours):
+        "Returns (x, y, z, offset) for each of the neighbours of the block at x, y, z (and offset) that's in the world."
+        if self.interior(x, y, z, neighbours.reach):
+            return [(x + dx, y + dy, z + dz, offset + step) for dx, dy, dz, step in neighbours.deltas]
+        sx, sy, sz = self.x, self.y, self.z
+        return [(x + dx, y + dy, z + dz, offset + step) for dx, dy, dz, step in neighbours.deltas
+            if 0 <= x + dx < sx and 0 <= y + dy < sy and 0 <= z + dz < sz]
+
+    def offsets_around(self, x, y, z, offset, neighbours):
+        "Like around(), but just the offsets."
+        if self.interior(x, y, z, neighbours.reach):
+            return [offset + step for step in neighbours.offsets]
+        sx, sy, sz = self.x, self.y, self.z
+        return [offset + step for dx, dy, dz, step in neighbours.deltas
+            if 0 <= x + dx < sx and 0 <= y + dy < sy and 0 <= z + dz < sz]
@@ -2,14 +2,19 @@
 # Arc is licensed under the BSD 2-Clause modified License.
 # To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
 
-import sys, time
-from threading import Thread
+import random, re, string, sys, time
+from array import array
 
-from twisted.internet import reactor
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+from arc.activity import REGION_SIZE, RegionActivity
 from arc.constants import *
-from arc.globals import Popxrange
+from arc.fluidlevels import FluidLevels
 from arc.logger import ColouredLogger
+from arc.neighbours import BELOW_DIAGONAL, BELOW_STRAIGHT
 
 debug = (True if "--debug" in sys.argv else False)
 
@@ -34,284 +39,427 @@ CHR_SAND_SPOUT = chr(BLOCK_SAND_SPOUT)
 # checks are more expensive here then updates (not sure about for the server and client)
 LIMIT_CHECKS = 256 * 256 * 256
 LIMIT_UNFLOOD = 256 * 256 * 256
+# changes are sent to the blockstore in batches of this size
+BATCH_SIZE = 4096
 
-class Physics(Thread):
+# What unflooding takes away
+UNFLOODED = [BLOCK_LAVA, BLOCK_WATER, BLOCK_SPOUT, BLOCK_LAVA_SPOUT]
+UNFLOODED_PATTERN = re.compile("[%s]" % "".join([re.escape(chr(block)) for block in UNFLOODED]))
+
+def find_unflooded(blockstore, limit):
+    """
+    Finds the blocks unflooding should take away, in one scan of the level.
+    Returns an array('I') of at most limit offsets, and whether there were
+    more than that.
+    """
+    if blockstore.block_view is not None:
+        table = numpy.zeros(256, bool)
+        table[UNFLOODED] = True
+        found = numpy.flatnonzero(table[blockstore.block_view.reshape(-1)])
+        return array('I', found[:limit].astype(numpy.uint32).tostring()), len(found) > limit
+    offsets = array('I')
+    for match in UNFLOODED_PATTERN.finditer(buffer(blockstore.raw_blocks)[:]):
+        if len(offsets) >= limit:
+            return offsets, True
+        offsets.append(match.start())
+    return offsets, False
+
+# What a pass might find something to do for (besides dirt, which only can at the top of its column)
+ACTIVE = [BLOCK_GRASS, BLOCK_WATER, BLOCK_STILLWATER, BLOCK_LAVA, BLOCK_SAND, BLOCK_SPOUT, BLOCK_LAVA_SPOUT, BLOCK_SAND_SPOUT]
+ACTIVE_MARKS = string.maketrans("".join([chr(block) for block in range(256)]),
+    "".join([("\1" if block in ACTIVE else "\0") for block in range(256)]))
+
+def find_active(blockstore, activity):
+    """
+    Finds the blocks a physics pass might have something to do for, in the
+    regions activity says are awake: fluids, spouts, grass, and dirt at the
+    top of its column. Returns an array('I') of their offsets.
+    """
+    awake = activity.awake()
+    layer = blockstore.x * blockstore.z
+    height_map = blockstore.height_map
+    if blockstore.block_view is not None:
+        flat = blockstore.block_view.reshape(-1)
+        table = numpy.zeros(256, bool)
+        table[ACTIVE] = True
+        found = numpy.flatnonzero(table[flat])
+        tops = height_map.flat.astype(numpy.int64)
+        columns = numpy.flatnonzero(tops >= 0)
+        dirt = tops[columns] * layer + columns
+        found = numpy.union1d(found, dirt[flat[dirt] == BLOCK_DIRT])
+        awake = numpy.asarray(awake, bool)
+        if not awake.all():
+            found = found[awake[activity.regions(found)]]
+        return array('I', found.astype(numpy.uint32).tostring())
+    found = array('I')
+    blocks = buffer(blockstore.raw_blocks)[:]
+    marks = blocks.translate(ACTIVE_MARKS)
+    sx = blockstore.x
+    offset = marks.find("\1")
+    while offset != -1:
+        if awake[activity.region(offset)]:
+            found.append(offset)
+            offset = marks.find("\1", offset + 1)
+        else:
+            # Skip the rest of this row of the sleeping region
+            x = offset % sx
+            offset = marks.find("\1", offset + min(REGION_SIZE - x % REGION_SIZE, sx - x))
+    for column in xrange(layer):
+        top = height_map.flat[column]
+        if top >= 0:
+            offset = top * layer + column
+            if blocks[offset] == CHR_DIRT and awake[activity.region(offset)]:
+                found.append(offset)
+    return found
+
+class Physics(object):
     """
     Given a BlockStore, works out what needs doing (water, grass etc.)
     and send the changes back to the BlockStore.
     """
-    # This thread:
-    # * Receives changes by ATOMIC updates to 'changed' eg. self.changed.add(offset)
-    # * Sends changes by queueing updates in the blockstore
-    # * Reads but doesn't modify self.blockstore.raw_blocks[]
+    # The BlockStore:
+    # * Tells us about changes through handle_change(s), eg. self.changed.add(offset)
+    # * Tells us about blocks that gained or lost the sky through handle_sky_changes
+    # * Asks us to look the whole world over again with wake()
+    # * Calls tick() from its slices, when its PhysicsScheduler says to
+    # We:
+    # * Send changes by queueing updates in the blockstore
+    # * Read but don't modify self.blockstore.raw_blocks[]
     # Optimised by only checking blocks near changes, advantages are a small work set and very up-to-date
+    # When physics starts, only the regions that haven't settled (see arc.activity) get looked over
+    # Finite water keeps fill levels and moves all at once at the end of a pass (see arc.fluidlevels)
+
+    remote = False # Engines in other processes (see arc.physicsprocess) are polled instead of ticked
 
     def __init__(self, blockstore):
-        Thread.__init__(self)
         self.blockstore = blockstore
-        #self.setDaemon(True) # means that python can terminate even if still active
-        #self.work = Event()    # TODO use event to start and stop
+        self.neighbours = blockstore.neighbours
         self.last_lag = 0
         self.running = True
         self.was_physics = False
         self.was_unflooding = False
+        self.was_finite = False
+        self.rescan = False # Look everything over on the next pass, asleep or not?
+        self.activity = RegionActivity(blockstore)
+        self.fluid = FluidLevels(blockstore)
+        self.fluid_cells = set() # Finite water (and cells whose level moved) to move this pass
+        self.fluid_spouts = set() # Water spouts to fill from this pass
+        self.in_pass = False # Partway through a physics pass that ran out of time?
+        self.pass_checks = 0
+        self.pass_updates = 0
+        self.checks = 0 # Blocks looked at in every finished pass, for benchmarks
+        self.random = random.Random() # Seed this to make a run repeatable
+        self.choose_directions()
         self.changed = set()
+        self.sky_changed = set() # Tops of columns whose height moved; their grass or dirt may need changing
         self.working = set() # could be a list or a sorted list but why bother (world updates may appear in random order but most of the time so many get updated it should be unnoticable)
-        self.sponge_locations = set()
+        self.batch_offsets = array('I')
+        self.batch_blocks = []
         self.logger = ColouredLogger(debug)
 
     def stop(self):
         self.running = False
-        self.join()
-
-    def run(self):
-        while self.running:
-            if self.blockstore.physics:
-                if self.blockstore.unflooding:
-                    # Do n fluid removals
-                    updates = 0
-                    for offset, block in enumerate(self.blockstore.raw_blocks):
-                        if block == CHR_LAVA or block == CHR_WATER or block == CHR_SPOUT or block == CHR_LAVA_SPOUT:
-                            x, y, z = self.blockstore.get_coords(offset)
-                            self.set_block((x, y, z), BLOCK_AIR)
-                            updates += 1
-                            if updates >= LIMIT_UNFLOOD:
-                                break
-                    else:
-                        # Unflooding complete.
-                        self.blockstore.unflooding = False
-                        self.blockstore.message(COLOUR_YELLOW + "Unflooding complete.")
-                        self.changed.clear()
-                        self.working = set()
-                else:
+
+    def tick(self, deadline):
+        """
+        Does one pass of physics, or as much of it as fits before deadline
+        (a time.time() value). Returns True once the pass is over, or False
+        if it ran out of time; the next call carries on where it left off.
+        """
+        if not self.running:
+            return True
+        self.check_rules()
+        if self.blockstore.physics:
+            if self.blockstore.unflooding:
+                self.unflood()
+            else:
+                if not self.in_pass:
                     # If this is the first of a physics run, redo the queues from scratch
-                    if not self.was_physics or self.was_unflooding:
-                        self.logger.debug("Queue everything for '%s'." % self.blockstore.world_name)
-                        self.changed.clear()
-                        self.working = Popxrange(0, (self.blockstore.x * self.blockstore.y * self.blockstore.z))
+                    if not self.was_physics or self.was_unflooding or self.rescan:
+                        self.forget_changes()
+                        self.working = set(find_active(self.blockstore, self.activity))
+                        self.rescan = False
+                        self.logger.debug("Queue everything in %d awake regions for '%s'." % (
+                        self.activity.awake_count(), self.blockstore.world_name))
                     # if working list is empty then copy changed set to working set
                     # otherwise keep using the working set till empty
                     elif len(self.working) == 0:
                         self.logger.debug("Performing expand checks for '%s' with %d changes." % (
                         self.blockstore.world_name, len(self.changed)))
                         changedfixed = self.changed # 'changedfixed' is 'changed' so gets all updates
-                        self.changed = set()        # until 'changed' is a new set. This and the above statment are ATOMIC
-                        self.working = set()         # changes from a Popxrange to a set
+                        self.changed = set()        # until 'changed' is a new set.
+                        self.working = set()
                         while len(changedfixed) > 0:
                             self.expand_checks(changedfixed.pop())
+                        self.working.update(self.sky_changed)
+                        self.sky_changed = set()
                     self.logger.debug("Starting physics run for '%s' with %d checks." % (
                     self.blockstore.world_name, len(self.working)))
-                    updates = 0
-                    try:
-                        for x in xrange(LIMIT_CHECKS):
-                            offset = self.working.pop()
-                            updates += self.handle(offset)
-                    except KeyError:
-                        pass
-                        #if overflow and (time.time() - self.last_lag > self.LAG_INTERVAL):
-                        #self.blockstore.message("Physics is currently lagging in %(id)s.")
-                        #self.last_lag = time.time()
-                    self.logger.debug("Ended physics run for '%s' with %d updates and %d checks remaining." % (
-                    self.blockstore.world_name, updates, len(self.working)))
-            else:
-                if self.was_physics:
-                    self.blockstore.unflooding = False
-                    self.changed.clear()
-                    self.working = set()
-            self.was_physics = self.blockstore.physics
-            self.was_unflooding = self.blockstore.unflooding
-            # Wait till next iter
-            time.sleep(0.7) # TODO change this so takes into account run time
-
-    def handle_change(self, offset, block): # must be ATOMIC
+                    self.in_pass = True
+                    self.fluid_cells = self.fluid.take_active()
+                    self.fluid_spouts = set()
+                    self.choose_directions()
+                    self.pass_checks = 0
+                    self.pass_updates = 0
+                try:
+                    while self.pass_checks < LIMIT_CHECKS:
+                        # Look at the clock every so often, so one world can't hog the workers
+                        if self.pass_checks % 256 == 0 and self.pass_checks and time.time() >= deadline:
+                            self.send_batch()
+                            return False
+                        offset = self.working.pop()
+                        self.pass_checks += 1
+                        self.pass_updates += self.handle(offset)
+                except KeyError:
+                    pass
+                if self.blockstore.finite_water:
+                    for offset, block in self.flow():
+                        self.set_offset(offset, block)
+                        self.pass_updates += 1
+                self.in_pass = False
+                self.checks += self.pass_checks
+                self.activity.settle()
+                self.logger.debug("Ended physics run for '%s' with %d updates and %d checks remaining." % (
+                self.blockstore.world_name, self.pass_updates, len(self.working)))
+        else:
+            self.in_pass = False
+            if self.was_physics:
+                self.blockstore.unflooding = False
+                self.changed.clear()
+                self.sky_changed.clear()
+                self.working = set()
+        # Hand whatever this pass changed to the blockstore
+        self.send_batch()
+        self.was_physics = self.blockstore.physics
+        self.was_unflooding = self.blockstore.unflooding
+        return True
+
+    def unflood(self):
+        """
+        Removes up to LIMIT_UNFLOOD fluid blocks as one batch; once there
+        are no more than that left, it's done. Clients may be sent the whole
+        level again instead of the changes, if that's less to send.
+        """
+        offsets, more = find_unflooded(self.blockstore, LIMIT_UNFLOOD)
+        if offsets:
+            self.blockstore.in_queue.put([TASK_BLOCKSETS, offsets, CHR_AIR * len(offsets), True, True])
+        if not more:
+            self.blockstore.unflooding = False
+            self.blockstore.message(COLOUR_YELLOW + "Unflooding complete.")
+            self.forget_changes()
+            self.fluid.clear()
+
+    def choose_directions(self):
+        """
+        Shuffles the order finite fluids try the four ways down and out
+        (straight, then diagonal) in, once a pass, so they don't all drift
+        the same way. Both orders are lists of indexes into BELOW_STRAIGHT
+        and BELOW_DIAGONAL.
+        """
+        self.straight_order = self.random.sample(range(4), 4)
+        self.diagonal_order = self.random.sample(range(4), 4)
+        self.below_straight = self.neighbours.neighbours([BELOW_STRAIGHT[i] for i in self.straight_order])
+        self.below_diagonal = self.neighbours.neighbours([BELOW_DIAGONAL[i] for i in self.diagonal_order])
+
+    def check_rules(self):
+        """
+        Wakes every region if finite water's been switched; what settled
+        under one set of rules may not under the other. Water levels are
+        dropped either way, so water blocks start out full.
+        """
+        if self.blockstore.finite_water != self.was_finite:
+            self.was_finite = self.blockstore.finite_water
+            self.activity.wake_all()
+            self.fluid.clear()
+
+    def wake(self):
+        "Wakes every region, and looks them all over on the next pass."
+        self.activity.wake_all()
+        self.rescan = True
+
+    def summary(self, clock):
+        "Returns clock's tick stats (see TickStats.summary), and how many of our regions are awake."
+        summary = clock.stats.summary()
+        summary["regions"] = len(self.activity.last_change)
+        summary["awake_regions"] = self.activity.awake_count()
+        return summary
+
+    def forget_changes(self):
+        "Drops the changes we were going to look at."
+        self.changed.clear()
+        self.sky_changed.clear()
+        self.working = set()
+
+    def flow(self):
+        "Moves this pass's finite water on, and returns the block changes it makes, as (offset, block)."
+        changes = self.fluid.step(self.fluid_cells, self.fluid_spouts)
+        self.fluid_cells = set()
+        self.fluid_spouts = set()
+        # Levels can keep moving without a block changing; keep their regions awake meanwhile
+        if self.fluid.active:
+            self.activity.touch_many(list(self.fluid.active))
+        return changes
+
+    def handle_change(self, offset, block):
         "Gets called when a block is changed, with its offset and type."
         self.changed.add(offset)
+        self.activity.touch(offset)
+        self.fluid.note_changes([offset])
+
+    def handle_changes(self, offsets):
+        "Gets called when a batch of blocks is changed, with their offsets."
+        self.changed.update(offsets)
+        self.activity.touch_many(offsets)
+        self.fluid.note_changes(offsets)
+
+    def handle_sky_changes(self, offsets):
+        "Gets called with the offsets of blocks that have just gained or lost the sky."
+        self.sky_changed.update(offsets)
+        self.activity.touch_many(offsets)
 
     def set_block(self, (x, y, z), block): # only place blockstore is updated
         "Call to queue a block change, with its position and type."
-        self.blockstore.in_queue.put([TASK_BLOCKSET, (x, y, z), chr(block), True])
+        self.set_offset(self.blockstore.get_offset(x, y, z), block)
+
+    def set_offset(self, offset, block):
+        "Like set_block, with the block's offset."
+        self.batch_offsets.append(offset)
+        self.batch_blocks.append(chr(block))
+        if len(self.batch_offsets) >= BATCH_SIZE:
+            self.send_batch()
+
+    def send_batch(self):
+        "Sends the queued block changes to the blockstore as one task."
+        if self.batch_offsets:
+            self.blockstore.in_queue.put([TASK_BLOCKSETS, self.batch_offsets, "".join(self.batch_blocks), True])
+            self.batch_offsets = array('I')
+            self.batch_blocks = []
 
     def expand_checks(self, offset):
         self.working.add(offset)
-        block = self.blockstore.raw_blocks[offset]
         x, y, z = self.blockstore.get_coords(offset)
-        #if block == oldblock:
-        #return
         # radius of 2 (because of sponge) should be enough
-        for nx, ny, nz, new_offset in self.get_blocks(x, y, z, self.block_radius(2)):
-            self.working.add(new_offset)
-            # handle grass and dirt under
-            # if block and oldblock are both either see though or not then ignore
-            #bseethough = (block == CHR_AIR) or (block == CHR_GLASS) or (block == CHR_LEAVES)
-            #oseethough = (oldblock == CHR_AIR) or (oldblock == CHR_GLASS) or (oldblock == CHR_LEAVES)
-            #if bseethough == oseethough:
-            #return
-        # find first block under that isn't see through
-        blocker_offset = offset
-        blocker_block = block
-        for ny in xrange(y - 1, -1, -1):
-            test_offset = self.blockstore.get_offset(x, ny, z)
-            test_block = self.blockstore.raw_blocks[test_offset]
-            if not (test_block == CHR_AIR or test_block == CHR_GLASS or test_block == CHR_LEAVES):
-                blocker_offset = test_offset
-                blocker_block = test_block
-                break
-            # if dirt or grass add
-        if blocker_offset != offset and (blocker_block == CHR_DIRT or blocker_block == CHR_GRASS):
-            self.working.add(blocker_offset)
-
-    def block_radius(self, r):
-        "Returns blocks within the radius"
-        for x in range(-r, r + 1):
-            for y in range(-r, r + 1):
-                for z in range(-r, r + 1):
-                    if x or y or z:
-                        yield (x, y, z)
-
-    def get_blocks(self, x, y, z, deltas):
-        "Given a starting point and some deltas, returns all offsets which exist."
-        for dx, dy, dz in deltas:
-            try:
-                new_offset = self.blockstore.get_offset(x + dx, y + dy, z + dz)
-                yield x + dx, y + dy, z + dz, new_offset
-            except AssertionError:
-                pass
-
-    def is_blocked(self, x, y, z):
-        "Given coords, determines if the block can see the sky."
-        blocked = False
-        for ny in xrange(y + 1, self.blockstore.y):
-            blocker_offset = self.blockstore.get_offset(x, ny, z)
-            blocker_block = self.blockstore.raw_blocks[blocker_offset]
-            if not ((blocker_block == CHR_AIR) or (blocker_block == CHR_GLASS) or (blocker_block == CHR_LEAVES)):
-                blocked = True
-                break
-        return blocked
-
-    def sponge_within_radius(self, x, y, z, r):
-        for nx, ny, nz, new_offset in self.get_blocks(x, y, z, self.block_radius(r)):
-            if new_offset in self.sponge_locations:
-                if self.blockstore.raw_blocks[new_offset] != CHR_SPONGE:
-                    self.sponge_locations.discard(new_offset)
-                    continue
-                return True
-        return False
+        # (grass or dirt further down that gained or lost the sky comes in through handle_sky_changes)
+        self.working.update(self.neighbours.offsets_around(x, y, z, offset, self.neighbours.cube2))
+
+    def is_blocked(self, offset):
+        "Given an offset, determines if the block can't see the sky."
+        return not self.blockstore.height_map.sky_visible(offset)
+
+    def sponge_within_radius(self, offset):
+        "Says if there's a sponge within SPONGE_RADIUS of the block at offset."
+        return self.blockstore.sponge_coverage().covered(offset)
 
     def handle(self, offset):
-        block = self.blockstore.raw_blocks[offset]
+        raw_blocks = self.blockstore.raw_blocks
+        neighbours = self.neighbours
+        block = raw_blocks[offset]
         x, y, z = self.blockstore.get_coords(offset)
+        below = offset - neighbours.layer # Only if y > 0, mind
         updates = 0
 
         if block == CHR_DIRT:
             # See if there's any grass next to us
-            for nx, ny, nz, new_offset in self.get_blocks(x, y, z, [(0, 0, 1), (0, 0, -1), (1, 0, 0), (-1, 0, 0)]):
-                if self.blockstore.raw_blocks[new_offset] == CHR_GRASS:
+            for new_offset in neighbours.offsets_around(x, y, z, offset, neighbours.horizontal):
+                if raw_blocks[new_offset] == CHR_GRASS:
                     # Alright, can we see the sun?
-                    if not self.is_blocked(x, y, z):
-                        self.set_block((x, y, z), BLOCK_GRASS)
+                    if not self.is_blocked(offset):
+                        self.set_offset(offset, BLOCK_GRASS)
                         return updates + 1
                     return updates
 
         elif block == CHR_GRASS:
             # Alright, can we see the sun?
-            if self.is_blocked(x, y, z):
-                self.set_block((x, y, z), BLOCK_DIRT)
+            if self.is_blocked(offset):
+                self.set_offset(offset, BLOCK_DIRT)
                 updates += 1
 
         # Spouts produce water, lava or sand in finite mode
         elif block == CHR_SPOUT or block == CHR_LAVA_SPOUT or block == CHR_SAND_SPOUT:
             # If there's a gap below, produce water
-            if self.blockstore.finite_water:
-                try:
-                    below = self.blockstore.get_offset(x, y - 1, z)
-                    if self.blockstore.raw_blocks[below] == CHR_AIR:
-                        if block == CHR_SPOUT:
-                            self.set_block((x, y - 1, z), BLOCK_WATER)
-                        elif block == CHR_LAVA_SPOUT:
-                            self.set_block((x, y - 1, z), BLOCK_LAVA)
-                        else:
-                            self.set_block((x, y - 1, z), BLOCK_SAND)
-                        updates += 1
-                except AssertionError:
-                    pass # At bottom of world
+            if self.blockstore.finite_water and y > 0:
+                if block == CHR_SPOUT:
+                    # Water's filled in by flow()
+                    self.fluid_spouts.add(offset)
+                elif raw_blocks[below] == CHR_AIR:
+                    if block == CHR_LAVA_SPOUT:
+                        self.set_offset(below, BLOCK_LAVA)
+                    else:
+                        self.set_offset(below, BLOCK_SAND)
+                    updates += 1
+
+        # Finite water is moved by flow(), at the end of the pass
+        elif block == CHR_WATER and self.blockstore.finite_water:
+            self.fluid_cells.add(offset)
 
         # Handles sand falling. If there's air below it, it behaves like finite water but stacks instead of spreading.
         elif block == CHR_WATER or block == CHR_STILLWATER or block == CHR_LAVA or block == CHR_SAND:
             # OK, so, can it drop?
-            try:
-                below = self.blockstore.get_offset(x, y - 1, z)
+            if y > 0:
                 if self.blockstore.finite_water:
-                    if self.blockstore.raw_blocks[below] == CHR_AIR:
-                        self.set_block((x, y - 1, z), ord(block))
-                        self.set_block((x, y, z), BLOCK_AIR)
+                    if raw_blocks[below] == CHR_AIR:
+                        self.set_offset(below, ord(block))
+                        self.set_offset(offset, BLOCK_AIR)
                         return updates + 2
-                    elif self.blockstore.raw_blocks[below] == CHR_SPONGE:
-                        self.set_block((x, y, z), BLOCK_AIR)
+                    elif raw_blocks[below] == CHR_SPONGE:
+                        self.set_offset(offset, BLOCK_AIR)
                         return updates + 1
                 else:
-                    if self.blockstore.raw_blocks[below] == CHR_AIR and not self.sponge_within_radius(x, y - 1, z, 2):
-                        self.set_block((x, y - 1, z), ord(block))
-                        self.set_block((x, y, z), BLOCK_AIR)
+                    if raw_blocks[below] == CHR_AIR and not self.sponge_within_radius(below):
+                        self.set_offset(below, ord(block))
+                        self.set_offset(offset, BLOCK_AIR)
                         return updates + 2
-            except AssertionError:
-                pass # At bottom of world
 
             # Noice. Now, can it spread?
             if self.blockstore.finite_water:
-                # Finite water first tries to move downwards and straight TODO randomise or water will spread in one direction
-                for nx, ny, nz, new_offset in self.get_blocks(x, y, z,
-                    [(0, -1, 1), (0, -1, -1), (1, -1, 0), (-1, -1, 0)]):
-                    above_offset = self.blockstore.get_offset(nx, ny + 1, nz)
-                    if self.blockstore.raw_blocks[above_offset] == CHR_AIR:
+                # Finite water first tries to move downwards and straight, in this pass's order
+                for new_offset in neighbours.offsets_around(x, y, z, offset, self.below_straight):
+                    if raw_blocks[new_offset + neighbours.layer] == CHR_AIR:
                         # Air? Fall.
-                        if self.blockstore.raw_blocks[new_offset] == CHR_AIR:
-                            self.set_block((nx, ny, nz), ord(block))
-                            self.set_block((x, y, z), BLOCK_AIR)
+                        if raw_blocks[new_offset] == CHR_AIR:
+                            self.set_offset(new_offset, ord(block))
+                            self.set_offset(offset, BLOCK_AIR)
                             return updates + 2
                             # Sponge? Absorb.
-                        if self.blockstore.raw_blocks[new_offset] == CHR_SPONGE:
-                            self.set_block((x, y, z), BLOCK_AIR)
+                        if raw_blocks[new_offset] == CHR_SPONGE:
+                            self.set_offset(offset, BLOCK_AIR)
                             return updates + 1
                     # Then it tries a diagonal
-                for nx, ny, nz, new_offset in self.get_blocks(x, y, z,
-                    [(1, -1, 1), (1, -1, -1), (-1, -1, 1), (-1, -1, -1)]):
-                    above_offset = self.blockstore.get_offset(nx, ny + 1, nz)
-                    left_offset = self.blockstore.get_offset(x, ny + 1, nz)
-                    right_offset = self.blockstore.get_offset(nx, ny + 1, z)
-                    if self.blockstore.raw_blocks[above_offset] == CHR_AIR and\
-                       (self.blockstore.raw_blocks[left_offset] == CHR_AIR or\
-                        self.blockstore.raw_blocks[right_offset] == CHR_AIR):
+                for nx, ny, nz, new_offset in neighbours.around(x, y, z, offset, self.below_diagonal):
+                    above_offset = new_offset + neighbours.layer
+                    left_offset = offset + (nz - z) * neighbours.row
+                    right_offset = offset + (nx - x)
+                    if raw_blocks[above_offset] == CHR_AIR and\
+                       (raw_blocks[left_offset] == CHR_AIR or\
+                        raw_blocks[right_offset] == CHR_AIR):
                         # Air? Fall.
-                        if self.blockstore.raw_blocks[new_offset] == CHR_AIR:
-                            self.set_block((nx, ny, nz), ord(block))
-                            self.set_block((x, y, z), BLOCK_AIR)
+                        if raw_blocks[new_offset] == CHR_AIR:
+                            self.set_offset(new_offset, ord(block))
+                            self.set_offset(offset, BLOCK_AIR)
                             return updates + 2
                             # Sponge? Absorb.
-                        if self.blockstore.raw_blocks[new_offset] == CHR_SPONGE:
-                            self.set_block((x, y, z), BLOCK_AIR)
+                        if raw_blocks[new_offset] == CHR_SPONGE:
+                            self.set_offset(offset, BLOCK_AIR)
                             return updates + 1
                 if block == CHR_SAND:
                     return updates
-                    # TODO got to stop water from stacking, water on water pushes out
             else:
                 if block == CHR_SAND:
                     return updates
                     # Infinite water spreads in the 4 horiz directions.
-                for nx, ny, nz, new_offset in self.get_blocks(x, y, z, [(0, 0, 1), (0, 0, -1), (1, 0, 0), (-1, 0, 0)]):
-                    if self.blockstore.raw_blocks[new_offset] == CHR_AIR and not self.sponge_within_radius(nx, ny, nz,
-                        2):
-                        self.set_block((nx, ny, nz), ord(block))
+                for new_offset in neighbours.offsets_around(x, y, z, offset, neighbours.horizontal):
+                    if raw_blocks[new_offset] == CHR_AIR and not self.sponge_within_radius(new_offset):
+                        self.set_offset(new_offset, ord(block))
                         updates += 1
                         # TODO make water levels the same even if tunnel to water is lower then surface
-        elif block == CHR_SPONGE:   # TODO check if sponge adding and (below) removal requires re-animation
-            # OK, it's a sponge. Add it to sponge locations.
-            self.sponge_locations.add(offset)
+        elif block == CHR_SPONGE:   # TODO check if sponge removal requires re-animation
+            # OK, it's a sponge; the blockstore's SpongeField already knows about it.
             # Make sure all the water blocks around it go away
             if not self.blockstore.finite_water:
-                for nx, ny, nz, new_offset in self.get_blocks(x, y, z, self.block_radius(2)):
-                    block = self.blockstore.raw_blocks[new_offset]
+                for new_offset in neighbours.offsets_around(x, y, z, offset, neighbours.cube2):
+                    block = raw_blocks[new_offset]
                     if block == CHR_WATER and block == CHR_LAVA and block == CHR_SAND:
-                        self.set_block((nx, ny, nz), BLOCK_AIR)
+                        self.set_offset(new_offset, BLOCK_AIR)
                         updates += 1
                         # If it's finite water, re-animate anything at the edges.
                         #if self.blockstore.finite_water:
@@ -320,13 +468,4 @@ class Physics(Thread):
                         #if block == CHR_WATER or block == CHR_LAVA:
                         #self.current[FLUID].add(new_offset)
 
-        elif block == CHR_AIR:
-            if offset in self.sponge_locations:
-                self.sponge_locations.discard(offset)
-                ## See if there's some water or lava that needs reanimating
-                #for nx, ny, nz, new_offset in self.get_blocks(x, y, z, self.block_radius(3)):
-                #block = self.blockstore.raw_blocks[new_offset]
-                #if block == CHR_WATER or block == CHR_LAVA:
-                #self.current[FLUID].add(new_offset)
-
         return updates
@@ -0,0 +1,238 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+A headless harness for timing the physics engines, and for checking that a
+change to one doesn't change what it does. It runs an engine on a copy of
+a world with no executor, threads or clock in the way: a scenario's
+scripted block changes go in, a fixed number of passes run back to back,
+and out come how fast it looked at blocks, how many it changed, and a hash
+of the world at the end. The same scenario, engine and seed always give the
+same hash. Scenarios can also check the world they end up with, and
+report anything wrong with it.
+"""
+
+import hashlib, os, shutil, tempfile, time
+from Queue import Empty
+
+from arc.blockstore import BlockStore
+from arc.constants import *
+from arc.fluidlevels import MAX_LEVEL
+from arc.globals import makefiles
+from arc.physics import BLOCK_SAND_SPOUT, BLOCK_SPOUT
+from arc.worldmeta import read_size
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+class Scenario(object):
+    """
+    A scripted physics run. script is called with the loaded BlockStore and
+    returns the block changes to make, as (tick, x, y, z, block); tick 0
+    changes go in before physics starts, and the rest just before that tick.
+    check, if given, is called with the BlockStore once the run is over, and
+    returns a list of what's wrong with the world it's left.
+    """
+
+    def __init__(self, name, description, script, ticks, finite_water=False, world="small", check=None):
+        self.name = name
+        self.description = description
+        self.script = script
+        self.ticks = ticks
+        self.finite_water = finite_water
+        self.world = world # A template name, or the path to a world folder
+        self.check = check
+
+    def world_dir(self):
+        if os.path.isdir(self.world):
+            return self.world
+        return os.path.join(TEMPLATES, self.world)
+
+class BenchResult(object):
+    "What one run of a scenario did."
+
+    def __init__(self, scenario, engine, seed):
+        self.scenario = scenario
+        self.engine = engine
+        self.seed = seed
+        self.checks = 0 # Blocks the engine looked at
+        self.tick_updates = [] # Blocks it changed, each tick
+        self.physics_time = 0.0 # Seconds in the engine
+        self.apply_time = 0.0 # Seconds the BlockStore spent applying its changes
+        self.world_hash = None
+        self.problems = [] # What the scenario's check found wrong
+
+    def updates(self):
+        return sum(self.tick_updates)
+
+    def checks_per_second(self):
+        return self.checks / self.physics_time if self.physics_time else 0.0
+
+    def updates_per_tick(self):
+        return self.updates() / float(len(self.tick_updates)) if self.tick_updates else 0.0
+
+    def summary(self):
+        summary = "%s (%s, seed %d): %d ticks, %d checks (%.0f/s), %d updates (%.1f/tick), %.3fs physics + %.3fs applying, world %s" % (
+            self.scenario.name, self.engine, self.seed, len(self.tick_updates), self.checks, self.checks_per_second(),
+            self.updates(), self.updates_per_tick(), self.physics_time, self.apply_time, self.world_hash)
+        if self.problems:
+            summary += "\n  FAILED: " + "\n  FAILED: ".join(self.problems)
+        return summary
+
+def run_scenario(scenario, engine="classic", seed=0, use_numpy=True, ticks=None):
+    "Runs scenario on a scratch copy of its world, and returns a BenchResult."
+    ticks = scenario.ticks if ticks is None else ticks
+    result = BenchResult(scenario, engine, seed)
+    # The BlockStore logs to the same folders as the server, which run.py would have made
+    makefiles(["logs/", "logs/console/", "logs/levels/"])
+    scratch = tempfile.mkdtemp(prefix="physicsbench-")
+    try:
+        world_dir = os.path.join(scratch, scenario.name)
+        shutil.copytree(scenario.world_dir(), world_dir)
+        sx, sy, sz = read_size(world_dir)
+        store = BlockStore(os.path.join(world_dir, "blocks.gz"), sx, sy, sz, use_numpy=use_numpy)
+        store.create_raw_blocks()
+        store.set_physics_engine(engine)
+        result.engine = store.physics_engine_name # The vector engine may not be available
+        store.physics_engine.random.seed(seed)
+        store.finite_water = scenario.finite_water
+        changes = {}
+        for tick, x, y, z, block in scenario.script(store):
+            changes.setdefault(tick, []).append((x, y, z, block))
+        for x, y, z, block in changes.get(0, []):
+            store[x, y, z] = chr(block)
+        store.physics = True
+        for tick in range(ticks):
+            if tick:
+                for x, y, z, block in changes.get(tick, []):
+                    store[x, y, z] = chr(block)
+            started = time.time()
+            while not store.physics_engine.tick(started + 3600):
+                pass
+            result.physics_time += time.time() - started
+            started = time.time()
+            result.tick_updates.append(apply_tasks(store))
+            result.apply_time += time.time() - started
+        result.checks = store.physics_engine.checks
+        result.world_hash = hashlib.sha1(store.raw_blocks.tostring()).hexdigest()
+        if scenario.check is not None:
+            result.problems = scenario.check(store)
+        store.journal.close()
+    finally:
+        shutil.rmtree(scratch, True)
+    return result
+
+def apply_tasks(store):
+    "Has the BlockStore apply what the engine sent it, like a slice would. Returns how many blocks changed."
+    updates = 0
+    while True:
+        try:
+            task = store.in_queue.get_nowait()
+        except Empty:
+            break
+        if task[0] is TASK_BLOCKSETS:
+            updates += len(task[1])
+        store.handle_task(task)
+    # Nobody's listening for the broadcasts
+    while True:
+        try:
+            store.out_queue.get_nowait()
+        except Empty:
+            return updates
+
+def ground(store, x, z):
+    "The y of the block just above the ground at x, z."
+    return store.height_map.height(x, z) + 1
+
+def flood(store):
+    "A spring of infinite water in the middle of the world, dammed on one side, with a second spring later."
+    x, z = store.x // 2, store.z // 2
+    changes = [(0, x, ground(store, x, z), z, BLOCK_WATER)]
+    for dz in range(-8, 9):
+        changes.append((0, x + 6, ground(store, x + 6, z + dz), z + dz, BLOCK_STONE))
+    changes.append((10, x - 12, ground(store, x - 12, z - 12) + 3, z - 12, BLOCK_WATER))
+    return changes
+
+def sand_avalanche(store):
+    "A block of sand dropped from the sky, that has to slide out into a heap, and a sand spout."
+    x, z = store.x // 2, store.z // 2
+    base = ground(store, x, z) + 8
+    changes = [(0, x + dx, base + dy, z + dz, BLOCK_SAND)
+        for dx in range(-4, 5) for dz in range(-4, 5) for dy in range(12)]
+    changes.append((5, x - 16, ground(store, x - 16, z) + 6, z, BLOCK_SAND_SPOUT))
+    return changes
+
+def grass_spread(store):
+    "Bare dirt around one tuft of grass, half of it under a glass roof and a quarter under stone."
+    x, z = store.x // 2, store.z // 2
+    changes = []
+    for dx in range(-16, 16):
+        for dz in range(-16, 16):
+            top = ground(store, x + dx, z + dz) - 1
+            changes.append((0, x + dx, top, z + dz, BLOCK_DIRT if (dx or dz) else BLOCK_GRASS))
+            if dz >= 0:
+                changes.append((0, x + dx, top + 4, z + dz, BLOCK_STONE if dx >= 0 else BLOCK_GLASS))
+    # Take part of the stone away again later
+    for dx in range(0, 16):
+        for dz in range(0, 8):
+            changes.append((30, x + dx, ground(store, x + dx, z + dz) + 3, z + dz, BLOCK_AIR))
+    return changes
+
+def sponge_field(store):
+    "Infinite water flooding through a grid of sponges, some of which are taken away again."
+    x, z = store.x // 2, store.z // 2
+    changes = [(0, x, ground(store, x, z), z, BLOCK_WATER)]
+    for dx in range(-24, 25, 8):
+        for dz in range(-24, 25, 8):
+            if dx or dz:
+                changes.append((0, x + dx, ground(store, x + dx, z + dz), z + dz, BLOCK_SPONGE))
+    for dx in range(-24, 25, 16):
+        changes.append((20, x + dx, ground(store, x + dx, z + 8), z + 8, BLOCK_AIR))
+    return changes
+
+def finite_pools(store):
+    "Finite water from a spout, and a slab of it on a stone shelf that's later taken away."
+    x, z = store.x // 2, store.z // 2
+    changes = [(0, x - 10, ground(store, x - 10, z) + 10, z, BLOCK_SPOUT)]
+    for dx in range(6, 12):
+        for dz in range(-3, 3):
+            for dy in range(4, 10):
+                changes.append((0, x + dx, ground(store, x + dx, z + dz) + dy, z + dz, BLOCK_WATER))
+            changes.append((0, x + dx, ground(store, x + dx, z + dz) + 3, z + dz, BLOCK_STONE))
+            changes.append((15, x + dx, ground(store, x + dx, z + dz) + 3, z + dz, BLOCK_AIR))
+    return changes
+
+def water_blocks(count):
+    "Returns a check that the world's finite water comes to count blocks, and that count of them show."
+    def check(store):
+        problems = []
+        volume = store.physics_engine.fluid.volume()
+        if volume != count * MAX_LEVEL:
+            problems.append("%d levels of water, not %d" % (volume, count * MAX_LEVEL))
+        shown = store.raw_blocks.tostring().count(chr(BLOCK_WATER))
+        if shown != count:
+            problems.append("%d water blocks show, not %d" % (shown, count))
+        return problems
+    return check
+
+def finite_block(store):
+    "One block of finite water on open ground, which spreads out thin but should still show as one block."
+    x, z = store.x // 2, store.z // 2
+    return [(0, x, ground(store, x, z), z, BLOCK_WATER)]
+
+def finite_cube(store):
+    "A 3x3x3 cube of finite water dropped from above the ground, which should still show as 27 blocks."
+    x, z = store.x // 2, store.z // 2
+    base = max([ground(store, x + dx, z + dz) for dx in range(-1, 2) for dz in range(-1, 2)]) + 4
+    return [(0, x + dx, base + dy, z + dz, BLOCK_WATER) for dx in range(-1, 2) for dy in range(3) for dz in range(-1, 2)]
+
+# The reference scenarios, by name
+SCENARIOS = dict([(scenario.name, scenario) for scenario in [
+    Scenario("flood", flood.__doc__, flood, 40),
+    Scenario("sand_avalanche", sand_avalanche.__doc__, sand_avalanche, 60, finite_water=True),
+    Scenario("grass_spread", grass_spread.__doc__, grass_spread, 60),
+    Scenario("sponge_field", sponge_field.__doc__, sponge_field, 40),
+    Scenario("finite_pools", finite_pools.__doc__, finite_pools, 60, finite_water=True),
+    Scenario("finite_block", finite_block.__doc__, finite_block, 60, finite_water=True, check=water_blocks(1)),
+    Scenario("finite_cube", finite_cube.__doc__, finite_cube, 80, finite_water=True, check=water_blocks(27)),
+]])
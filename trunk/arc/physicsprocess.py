@@ -0,0 +1,414 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+Runs a world's physics in a process of its own, so a big flood doesn't
+fight the network reactor for the GIL. The process works on a copy of the
+world's blocks in shared memory, which the BlockStore keeps up to date as
+it applies changes, and sends back batches of changes for the BlockStore to
+apply and broadcast, just like an engine in the same process would.
+
+Forking from a server that's already running threads can leave the child
+stuck on a lock one of them held, so physics processes are forked from a
+launcher instead, started along with the server (see start_launcher). The
+shared blocks and the connection to each process are passed between them
+as file handles, which needs a system that can fork and do that; anywhere
+else, physics stays in the server process.
+"""
+
+import mmap, multiprocessing, os, signal, tempfile, threading, time, traceback
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import _multiprocessing
+    from multiprocessing.reduction import recv_handle, send_handle
+except ImportError:
+    recv_handle = send_handle = None
+
+from arc.constants import *
+from arc.heightmap import HeightMap
+from arc.logger import ColouredLogger
+from arc.neighbours import NeighbourTable
+from arc.physics import Physics
+from arc.physicsscheduler import PhysicsScheduler
+from arc.spongefield import CHR_SPONGE, SpongeField
+from arc.vectorphysics import VectorPhysics
+
+POLL_INTERVAL = 0.05 # Seconds between the BlockStore looking for batches from the process
+STOP_TIMEOUT = 0.5 # Seconds a stopping process gets before it's killed (it has nothing to lose)
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None # Where the shared blocks' (unlinked) file goes
+
+_launcher = None # The launcher's (Process, connection), once it's started
+_launcher_lock = threading.Lock() # Worlds on any worker may ask it for a process
+
+def start_launcher():
+    """
+    Starts the launcher physics processes are forked from, if this system
+    can do that. Call this early, before the compression pool and the world
+    workers are running, since it forks.
+    """
+    global _launcher
+    if _launcher is not None or not hasattr(os, "fork") or send_handle is None:
+        return
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_launcher, name="Physics launcher", args=(child_connection,))
+    process.daemon = True
+    process.start()
+    child_connection.close()
+    _launcher = (process, connection)
+
+def stop_launcher():
+    "Stops the launcher; physics processes it started carry on until their worlds stop them."
+    global _launcher
+    if _launcher is not None:
+        (process, connection), _launcher = _launcher, None
+        try:
+            connection.send(("stop",))
+        except (IOError, OSError):
+            pass
+        process.join(STOP_TIMEOUT)
+        connection.close()
+
+def can_launch():
+    "Says if physics can run in processes of its own here."
+    return _launcher is not None and _launcher[0].is_alive()
+
+def launch(blocks_file, size, world_name, engine_name, clock_settings):
+    """
+    Has the launcher start a physics process on the blocks in blocks_file
+    (a file of the world's size). Returns its pid and a connection to it.
+    """
+    if not can_launch():
+        raise OSError("physics processes can't be started here")
+    process, connection = _launcher
+    _launcher_lock.acquire()
+    try:
+        connection.send(("launch", size, world_name, engine_name, clock_settings))
+        send_handle(connection, blocks_file.fileno(), process.pid)
+        reply = connection.recv()
+        if reply[0] != "launched":
+            raise OSError("the launcher couldn't start a physics process: %s" % reply[1])
+        return reply[1], _multiprocessing.Connection(recv_handle(connection))
+    finally:
+        _launcher_lock.release()
+
+class ProcessPhysics(object):
+    """
+    Stands in for a physics engine in the BlockStore, and passes everything
+    on to the process that really runs it. The BlockStore calls poll()
+    every slice instead of running it on its PhysicsScheduler, since the
+    process keeps its own.
+    """
+
+    remote = True
+
+    def __init__(self, blockstore, engine_name, clock):
+        self.blockstore = blockstore
+        self.logger = ColouredLogger()
+        self.running = True
+        self.was_physics = False
+        self.stats = clock.stats.summary()
+        self.state = None # The (physics, finite_water, unflooding) the process last heard about
+        self.changed = array('I') # Offsets changed since we last told the process
+        size = blockstore.x * blockstore.y * blockstore.z
+        # The process maps the same file; it's gone from the disk as soon as we both let go of it
+        blocks_file = tempfile.TemporaryFile(dir=SHARED_DIR)
+        try:
+            blocks_file.write(blockstore.raw_blocks.tostring())
+            blocks_file.flush()
+            self.shared = mmap.mmap(blocks_file.fileno(), size)
+            self.pid, self.connection = launch(blocks_file, (blockstore.x, blockstore.y, blockstore.z),
+                blockstore.world_name, engine_name, (clock.interval, clock.budget, clock.catchup))
+        finally:
+            blocks_file.close()
+        if blockstore.block_view is not None:
+            self.shared_view = numpy.frombuffer(self.shared, numpy.uint8)
+        else:
+            self.shared_view = None
+
+    def send(self, message):
+        try:
+            self.connection.send(message)
+        except (IOError, OSError, EOFError):
+            self.running = False
+
+    def stop(self):
+        "Tells the process to finish, and waits a little for it before killing it."
+        if self.running:
+            self.running = False
+            self.send(("stop",))
+        # Keep reading (and dropping) what it sends, so it isn't stuck writing to a full pipe,
+        # until it closes its end by exiting
+        end = time.time() + STOP_TIMEOUT
+        finished = False
+        try:
+            while time.time() < end:
+                if self.connection.poll(0.05):
+                    self.connection.recv()
+        except (IOError, OSError, EOFError):
+            finished = True
+        if not finished:
+            self.logger.debug("The physics process for '%s' is busy; killing it." % self.blockstore.world_name)
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.connection.close()
+
+    def handle_change(self, offset, block):
+        self.shared[offset] = block
+        self.changed.append(offset)
+
+    def handle_changes(self, offsets):
+        if self.shared_view is not None:
+            offset_array = numpy.frombuffer(offsets, "u%d" % offsets.itemsize) if isinstance(offsets, array) else numpy.asarray(offsets)
+            self.shared_view[offset_array] = self.blockstore.block_view.reshape(-1)[offset_array]
+        else:
+            raw_blocks = self.blockstore.raw_blocks
+            for offset in offsets:
+                self.shared[offset] = raw_blocks[offset]
+        self.changed.extend(offsets)
+
+    def handle_sky_changes(self, offsets):
+        pass # The process keeps a height map of its own
+
+    def wake(self):
+        self.send(("wake",))
+
+    def poll(self, deadline):
+        """
+        Applies the batches the process has sent, and tells it what's
+        changed since. Returns the seconds until we should look again, or
+        None if physics is off and there's nothing left to come.
+        """
+        if not self.running:
+            return None
+        applied = None
+        more = False
+        try:
+            while self.connection.poll(0):
+                if time.time() >= deadline:
+                    more = True
+                    break
+                message = self.connection.recv()
+                if message[0] == "task":
+                    applied = message[1]
+                    self.blockstore.handle_task(message[2])
+                elif message[0] == "message":
+                    self.blockstore.message(message[1])
+                elif message[0] == "unflooded":
+                    self.blockstore.unflooding = False
+                    if self.state is not None:
+                        self.state = self.state[:2] + (False,)
+                elif message[0] == "stats":
+                    self.stats, self.was_physics = message[1], message[2]
+        except (IOError, OSError, EOFError):
+            # It's closed its end; it died
+            self.running = False
+        if not self.running:
+            self.logger.error("The physics process for '%s' died." % self.blockstore.world_name)
+            return None
+        if self.changed:
+            self.send(("changes", self.changed))
+            self.changed = array('I')
+        if applied is not None:
+            self.send(("applied", applied))
+        state = (self.blockstore.physics, self.blockstore.finite_water, self.blockstore.unflooding)
+        if state != self.state:
+            self.send(("state",) + state)
+            self.state = state
+        if more:
+            return 0
+        if self.blockstore.physics or self.was_physics:
+            return POLL_INTERVAL
+        return None
+
+class PhysicsHost(object):
+    """
+    What the engine in the physics process sees in place of the BlockStore:
+    the shared blocks, and a queue that sends its changes back.
+    """
+
+    def __init__(self, connection, shared, (sx, sy, sz), world_name):
+        self.connection = connection
+        self.x, self.y, self.z = sx, sy, sz
+        self.world_name = world_name
+        self.neighbours = NeighbourTable(sx, sy, sz)
+        self.raw_blocks = shared
+        self.block_view = None
+        if numpy is not None:
+            self.block_view = numpy.frombuffer(shared, numpy.uint8).reshape(sy, sz, sx)
+        self.height_map = HeightMap(self)
+        self.in_queue = self
+        self.physics = False
+        self.finite_water = False
+        self._unflooding = False
+        self.sponge_field = None
+        self.sponges = set() # Where the sponge field thinks there are sponges
+        self.sent = 0 # Batches sent back
+        self.applied = 0 # Batches the BlockStore says it has applied
+
+    def put(self, task):
+        "Sends a task (always a TASK_BLOCKSETS) to the BlockStore."
+        self.sent += 1
+        self.connection.send(("task", self.sent, task))
+
+    def message(self, message):
+        self.connection.send(("message", message))
+
+    def get_unflooding(self):
+        return self._unflooding
+
+    def set_unflooding(self, value):
+        # Only the engine turns unflooding off; let the BlockStore know
+        if self._unflooding and not value:
+            self.connection.send(("unflooded",))
+        self._unflooding = value
+
+    unflooding = property(get_unflooding, set_unflooding)
+
+    def get_offset(self, x, y, z):
+        "Turns block coordinates into a data offset"
+        assert 0 <= x < self.x
+        assert 0 <= y < self.y
+        assert 0 <= z < self.z
+        return y * (self.x * self.z) + z * (self.x) + x
+
+    def get_coords(self, offset):
+        "Turns a data offset into coordinates"
+        x = offset % self.x
+        z = (offset // self.x) % self.z
+        y = offset // (self.x * self.z)
+        return x, y, z
+
+    def sponge_coverage(self):
+        if self.sponge_field is None:
+            self.sponge_field = SpongeField(self)
+            if self.block_view is not None:
+                self.sponges = set(numpy.flatnonzero(self.block_view == BLOCK_SPONGE).tolist())
+            else:
+                blocks = buffer(self.raw_blocks)[:]
+                offset = blocks.find(CHR_SPONGE)
+                while offset != -1:
+                    self.sponges.add(offset)
+                    offset = blocks.find(CHR_SPONGE, offset + 1)
+        return self.sponge_field
+
+    def note_changes(self, offsets):
+        """
+        Catches the sponge field and height map up with changed blocks, and
+        returns the height map's sky changes. We can't see what the blocks
+        were before, so compare with where we know sponges were.
+        """
+        sky_changes = self.height_map.update(offsets)
+        if self.sponge_field is None:
+            return sky_changes
+        raw_blocks = self.raw_blocks
+        added = [offset for offset in offsets if raw_blocks[offset] == CHR_SPONGE and offset not in self.sponges]
+        removed = [offset for offset in offsets if offset in self.sponges and raw_blocks[offset] != CHR_SPONGE]
+        self.sponges.update(added)
+        self.sponges.difference_update(removed)
+        self.sponge_field.update(added, removed)
+        return sky_changes
+
+def run_launcher(connection):
+    "The launcher process: forks a physics process for each world that asks, and reaps them once they finish."
+    # Ctrl-C is the server's business, not ours
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        while True:
+            if connection.poll(1.0):
+                message = connection.recv()
+                if message[0] == "stop":
+                    return
+                size, world_name, engine_name, clock_settings = message[1:]
+                blocks_fd = recv_handle(connection)
+                try:
+                    shared = mmap.mmap(blocks_fd, size[0] * size[1] * size[2])
+                    physics_connection, child_connection = multiprocessing.Pipe()
+                    pid = os.fork()
+                except (IOError, OSError) as e:
+                    os.close(blocks_fd)
+                    connection.send(("failed", str(e)))
+                    continue
+                os.close(blocks_fd)
+                if pid == 0:
+                    # Only the world that asked talks to us
+                    connection.close()
+                    physics_connection.close()
+                    code = 0
+                    try:
+                        run_physics(child_connection, shared, size, world_name, engine_name, clock_settings)
+                    except BaseException:
+                        code = 1
+                    os._exit(code)
+                child_connection.close()
+                shared.close()
+                connection.send(("launched", pid))
+                send_handle(connection, physics_connection.fileno(), os.getppid())
+                physics_connection.close()
+            # Reap the processes that have finished
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0]:
+                    pass
+            except OSError:
+                pass # None left
+    except (IOError, OSError, EOFError):
+        pass # The server's gone
+
+def run_physics(connection, shared, size, world_name, engine_name, clock_settings):
+    "The physics process: runs the engine on its clock until it's told to stop."
+    # Ctrl-C is the server's business, not ours
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = ColouredLogger()
+    host = PhysicsHost(connection, shared, size, world_name)
+    if engine_name == "vector" and host.block_view is not None:
+        engine = VectorPhysics(host)
+    else:
+        engine = Physics(host)
+    clock = PhysicsScheduler(*clock_settings)
+    next_run = 0
+    try:
+        while True:
+            busy = host.physics or engine.was_physics
+            # Don't tick again until the BlockStore has applied what we sent, or fluids would move twice
+            if host.applied < host.sent or not busy:
+                timeout = None
+            else:
+                timeout = max(0, next_run - time.time())
+            if connection.poll(timeout):
+                while connection.poll(0):
+                    message = connection.recv()
+                    if message[0] == "stop":
+                        return
+                    elif message[0] == "changes":
+                        sky_changes = host.note_changes(message[1])
+                        engine.handle_changes(message[1])
+                        if sky_changes:
+                            engine.handle_sky_changes(sky_changes)
+                    elif message[0] == "wake":
+                        engine.wake()
+                    elif message[0] == "applied":
+                        host.applied = message[1]
+                    elif message[0] == "state":
+                        host.physics, host.finite_water, host._unflooding = message[1:]
+                continue
+            ticks = clock.stats.ticks
+            next_run = time.time() + clock.run(engine, time.time() + clock.budget)
+            if clock.stats.ticks != ticks:
+                connection.send(("stats", engine.summary(clock), engine.was_physics))
+            if not (host.physics or engine.was_physics):
+                clock.reset()
+    except (IOError, OSError, EOFError):
+        pass # The server's gone
+    except Exception:
+        logger.error("Physics for '%s' failed:" % world_name)
+        logger.error(traceback.format_exc())
+    finally:
+        connection.close()
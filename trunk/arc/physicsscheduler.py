@@ -0,0 +1,94 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import time
+
+class TickStats(object):
+    "How long a world's physics ticks have been taking."
+
+    def __init__(self):
+        self.ticks = 0
+        self.last = 0.0 # Seconds the last tick took
+        self.average = 0.0 # Moving average of that
+        self.longest = 0.0
+        self.overruns = 0 # Ticks that used up their budget and left work for the next one
+        self.skipped = 0 # Ticks dropped because we were running too late to catch up
+        self.lateness = 0.0 # Moving average of how late ticks started
+
+    def record(self, took, late, overran):
+        self.ticks += 1
+        self.last = took
+        self.longest = max(self.longest, took)
+        # Weight recent ticks, so the average follows the world's current load
+        weight = 0.1 if self.ticks > 10 else 1.0 / self.ticks
+        self.average += (took - self.average) * weight
+        self.lateness += (late - self.lateness) * weight
+        if overran:
+            self.overruns += 1
+
+    def summary(self):
+        "Returns the stats as a dict, with times in milliseconds."
+        return {
+            "ticks": self.ticks,
+            "last": self.last * 1000,
+            "average": self.average * 1000,
+            "longest": self.longest * 1000,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "lateness": self.lateness * 1000,
+        }
+
+class PhysicsScheduler(object):
+    """
+    Decides when a world's physics engine runs. Ticks are due every
+    interval seconds, counted from when the last one was due (not from when
+    it finished), so water flows at the same speed however long the
+    passes take. Each tick may spend at most budget seconds; a pass that
+    isn't done by then carries on in the next tick. When we fall behind, up
+    to catchup missed ticks are run back to back, and any more are skipped.
+    """
+
+    def __init__(self, interval=0.7, budget=0.2, catchup=2):
+        self.interval = max(0.01, interval)
+        self.budget = max(0.001, budget)
+        self.catchup = max(0, catchup)
+        self.stats = TickStats()
+        self.reset()
+
+    def reset(self):
+        "Forgets the schedule, for when physics stops; it starts afresh next time."
+        self.next_tick = None # When the next tick is due
+        self.in_tick = False # Is a tick partway done (it ran out of slice, not budget)?
+        self.spent = 0.0 # Seconds the current tick has used
+        self.late = 0.0 # How late the current tick started
+
+    def run(self, engine, deadline):
+        """
+        Runs engine for the tick that's due, if any, stopping at deadline or
+        when the tick's budget runs out. Returns the seconds until it next
+        needs to run (0 if the tick isn't finished).
+        """
+        now = time.time()
+        if self.next_tick is None:
+            self.next_tick = now
+        if not self.in_tick:
+            if now < self.next_tick:
+                return self.next_tick - now
+            # Too far behind? Skip the ticks we can't catch up on.
+            behind = int((now - self.next_tick) / self.interval)
+            if behind > self.catchup:
+                skipped = behind - self.catchup
+                self.stats.skipped += skipped
+                self.next_tick += skipped * self.interval
+            self.in_tick = True
+            self.spent = 0.0
+            self.late = now - self.next_tick
+        finished = engine.tick(min(deadline, now + self.budget - self.spent))
+        self.spent += time.time() - now
+        if not finished and self.spent < self.budget:
+            return 0 # Only ran out of slice; carry on in the next one
+        self.stats.record(self.spent, self.late, not finished)
+        self.in_tick = False
+        self.next_tick += self.interval
+        return max(0, self.next_tick - time.time())
@@ -134,6 +134,18 @@ class BlbPlugin(object):
             if (total > limit):
                 data["client"].sendServerMessage("BLB Area Limit exceeded. (Limit is %s)" % limit)
                 return
+        # With NumPy, and nothing in the way that needs checking block by block, fill it in one go
+        world = self.factory.worlds[w]
+        if world.vectorized and (data["overriderank"] or (world is getattr(data["client"], "world", None) and
+                data["client"].allowedToBuildBox(x, y, z, x2, y2, z2))):
+            keep = () if (data["overriderank"] or data["client"].isOp()) else (chr(BLOCK_SOLID),)
+            try:
+                world.fill_box(x, y, z, x2, y2, z2, block, keep)
+            except AssertionError:
+                data["client"].sendServerMessage("Out of bounds.")
+                return
+            data["client"].sendServerMessage("BLB finished, with %s blocks changed." % total)
+            return
         # Build the changeset
         changeset = {}
         for i in range(x, x2 + 1):
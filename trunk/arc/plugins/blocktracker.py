@@ -117,28 +117,18 @@ class BlockTrackerPlugin(object):
     def blockDetected(self, data):
         "Hook trigger for block changes."
         if not data["client"].isChecking: # Only add this block entry if we are not checking a block
-            before_block = data["client"].world.blockstore[x, y, z]
-            if before_block == u'':
-                before_block = 0
-            elif isinstance(before_block, Deferred):
-                # Nope, wait a bit
-                reactor.callLater(0.1, self.blockDetected, data)
-            else:
-                before_block = ord(before_block)
+            before_block = ord(data["client"].world.get_block(data["x"], data["y"], data["z"]))
             data["client"].world.blocktracker.add((
-                    data["client"].world.get_offset(x, y, z), before_block, block, data["client"].username.lower(),
+                    data["client"].world.get_offset(data["x"], data["y"], data["z"]), before_block, data["block"],
+                    data["client"].username.lower(),
                     time.mktime(time.localtime())))
 
     def blockChanged(self, data):
         if data["client"].isChecking: # Reverts the change if we are in checking mode
-            data["client"].world.blocktracker.getblockedits(self.client.world.get_offset(x, y, z)).addCallback(self.sendCallbackBlock)
+            data["client"].world.blocktracker.getblockedits(data["client"].world.get_offset(data["x"], data["y"], data["z"])).addCallback(
+                self.sendCallbackBlock, client=data["client"])
             data["client"].isChecking = False
-            block = self.client.world.blockstore[data["x"], data["y"], data["z"]]
-            if block == u'':
-                block = 0
-            else:
-                block = ord(block)
-            return block
+            return ord(data["client"].world.get_block(data["x"], data["y"], data["z"]))
 
     @config("category", "build")
     @config("usage", "[world x y z]")
@@ -519,7 +519,7 @@ class BuildUtilPlugin(object):
     @config("aliases", ["brep"])
     def commandReplace(self, data):
         "Replaces all blocks of blockA in this area to blockB."
-        if fromloc == "user":
+        if data["fromloc"] == "user":
             if len(data["parts"]) < 9 and len(data["parts"]) != 3:
                 data["client"].sendServerMessage("Please enter 2 types (and possibly two coord triples)")
                 return
@@ -536,7 +536,7 @@ class BuildUtilPlugin(object):
             data["client"].sendServerMessage("'%s' is either not a valid block type, or is not available to you." % data["parts"][2])
             return
         # If they only provided the type argument, use the last two block places
-        if len(data["parts"]) == 3 and fromloc == "user":
+        if len(data["parts"]) == 3 and data["fromloc"] == "user":
             try:
                 x, y, z = data["client"].last_block_changes[0]
                 x2, y2, z2 = data["client"].last_block_changes[1]
@@ -549,20 +549,36 @@ class BuildUtilPlugin(object):
             except ValueError:
                 data["client"].sendServerMessage("All coordinate parameters must be integers.")
                 return
-        if fromloc != "user" and len(data["parts"]) >= 10:
+        if data["fromloc"] != "user" and len(data["parts"]) >= 10:
             w = data["parts"][9]
             # Check if world is booted
             if w not in self.factory.worlds.keys():
                 data["client"].sendServerMessage("That world is currently not booted.")
                 return
         else:
-            if fromloc != "user":
+            if data["fromloc"] != "user":
                 data["client"].sendServerMessage("You must supply a world.")
             else:
                 w = str(data["client"].world.id)
         if x > x2: x, x2 = x2, x
         if y > y2: y, y2 = y2, y
         if z > z2: z, z2 = z2, z
+        # With NumPy, and nothing in the way that needs checking block by block, replace it in one go
+        world = self.factory.worlds[w]
+        if world.vectorized and (data["overriderank"] or (world is getattr(data["client"], "world", None) and
+                data["client"].allowedToBuildBox(x, y, z, x2, y2, z2))):
+            try:
+                total = world.count_blocks(x, y, z, x2, y2, z2).get(blockA, 0)
+            except AssertionError:
+                data["client"].sendServerMessage("Out of bounds.")
+                return
+            limit = data["client"].getBlbLimit(3)
+            if limit != -1 and total > limit:
+                data["client"].sendServerMessage("Replace limit exceeded. (Limit is %s)" % limit)
+                return
+            world.replace_box(x, y, z, x2, y2, z2, blockA, blockB)
+            data["client"].sendServerMessage("Replace finished, with %s blocks changed." % total)
+            return
         # Build the changeset
         changeset = {}
         for i in range(x, x2 + 1):
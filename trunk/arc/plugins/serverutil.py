@@ -2,6 +2,8 @@
 # Arc is licensed under the BSD 2-Clause modified License.
 # To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
 
+import time
+
 try:
     import psutil
 except ImportError:
@@ -134,6 +136,16 @@ class ServerUtilPlugin():
 
     def commandServerInfo(self, data):
         "Displays server information."
+        memory = self.factory.worldMemory()
+        loaded = len([used for used in memory.values() if used])
+        budget = ("%s MB" % self.factory.world_memory) if self.factory.world_memory else "no limit"
+        data["client"].sendServerMessage("WORLDS: %s booted, %s in memory, using %.1f MB (%s)" %
+            (len(memory), loaded, sum(memory.values()) / 1048576.0, budget))
+        saves = self.factory.saveStatus().values()
+        waiting = [last_save for last_save, backlog in saves if backlog]
+        data["client"].sendServerMessage("SAVES: %s worlds with %s unsaved changes, oldest saved %ss ago" %
+            (len(waiting), sum([backlog for last_save, backlog in saves]),
+            int(time.time() - min(waiting)) if waiting else 0))
         if nopsutils:
             data["client"].sendServerMessage("System information plugin disabled, unable to display system information.")
             return
@@ -6,8 +6,13 @@ import inspect, os, random, shutil
 
 from twisted.internet import reactor
 
+from arc.backups import BackupStore
+from arc.blockstore import PHYSICS_ENGINES
 from arc.constants import *
 from arc.decorators import *
+from arc.physicsprocess import can_launch
+from arc.terrain import TerrainBuild, TerrainSettings, can_generate
+from arc.vectorphysics import can_vectorize
 from arc.world import World
 
 class WorldUtilPlugin(object):
@@ -21,6 +26,9 @@ class WorldUtilPlugin(object):
         "physflush": "commandPhysflush",
         "unflood": "commandUnflood",
         "fwater": "commandFwater",
+        "physengine": "commandPhysengine",
+        "physstats": "commandPhysstats",
+        "physprocess": "commandPhysprocess",
 
         "private": "commandPrivate",
         "lock": "commandLock",
@@ -69,14 +77,17 @@ class WorldUtilPlugin(object):
             backupname = data["parts"][2]
         else:
             backupname = None
-        response = self.factory.doBackup(world_id, "user", backupname)
-        if response[0] == 1: # Success
-            data["client"].sendServerMessage("World %s's backup %s is saved." % (world_id, response[1]))
-            return
-        if response[1] == 2:
-            data["client"].sendServerMessage("World %s does not exist." % world_id)
-        elif response[1] == 3:
-            data["client"].sendServerMessage("Backup %s for world %s already exists." % (backupname, world_id))
+        def backedUp(response):
+            if response[0] == 1: # Success
+                data["client"].sendServerMessage("World %s's backup %s is saved." % (world_id, response[1]))
+                return
+            if response[1] == 2:
+                data["client"].sendServerMessage("World %s does not exist." % world_id)
+            elif response[1] == 3:
+                data["client"].sendServerMessage("Backup %s for world %s already exists." % (backupname, world_id))
+        def failed(failure):
+            data["client"].sendServerMessage("Unable to back up %s: %s" % (world_id, failure.getErrorMessage()))
+        self.factory.doBackup(world_id, "user", backupname).addCallbacks(backedUp, failed)
 
     @config("category", "world")
     @config("rank", "op")
@@ -88,26 +99,38 @@ class WorldUtilPlugin(object):
             return
         world_id = data["parts"][1].lower()
         world_dir = ("worlds/%s/" % world_id)
+        store = BackupStore(world_dir)
         if len(data["parts"]) < 3:
-            backups = os.listdir(world_dir + "backup/")
-            backups.sort(lambda x, y: int(x) - int(y))
-            backup_number = str(int(backups[-1]))
+            numbered = [name for name in store.backups() if name.isdigit()]
+            if not numbered:
+                data["client"].sendServerMessage("No backups found for %s." % world_id)
+                return
+            backup_number = numbered[-1]
         else:
             backup_number = data["parts"][2]
-        if not os.path.exists(world_dir + "backup/%s/" % backup_number):
+        if not store.exists(backup_number):
             data["client"].sendServerMessage("Backup %s does not exist." % backup_number)
             return
-        if not os.path.exists(world_dir + "blocks.gz.new"):
-            shutil.copy((world_dir + "backup/%s/blocks.gz" % backup_number), world_dir)
-            if os.path.exists(world_dir + "backup/%s/world.meta" % backup_number):
-                shutil.copy((world_dir + "backup/%s/world.meta" % backup_number), world_dir)
-        else:
-            reactor.callLater(1, self.commandRestore, self, data)
-        self.factory.unloadWorld(world_id, skiperror=True)
-        data["client"].sendServerMessage("%s has been restored to %s and booted." % (world_id, backup_number))
+        # Whichever BlockStores are saving the world (one it was cooled down from, too)
+        saving = [self.factory.stopping_blockstores.get(os.path.normpath(world_dir))]
         if world_id in self.factory.worlds:
-            for client in self.factory.worlds[world_id].clients:
-                client.changeToWorld(world_id)
+            world = self.factory.worlds[world_id]
+            saving.extend([world._blockstore, world.old_blockstore])
+            self.factory.unloadWorld(world_id, skiperror=True)
+        saving = [blockstore for blockstore in saving if blockstore is not None]
+        def doRestore():
+            # Wait for the world to finish saving, or it'd write over the restored files
+            if [blockstore for blockstore in saving if not blockstore.stopped.isSet()]:
+                reactor.callLater(0.1, doRestore)
+                return
+            try:
+                store.restore(backup_number)
+            except (IOError, OSError, ValueError) as e:
+                data["client"].sendServerMessage("Unable to restore %s: %s" % (world_id, e))
+                return
+            self.factory.loadWorld("worlds/%s" % world_id, world_id)
+            data["client"].sendServerMessage("%s has been restored to %s and booted." % (world_id, backup_number))
+        doRestore()
 
     @config("category", "world")
     @config("usage", "world")
@@ -120,20 +143,14 @@ class WorldUtilPlugin(object):
                 world = data["client"].world.id
             else:
                 data["client"].sendServerMessage("You must supply a world.")
-        if not os.path.exists("worlds/%s/" % world):
+                return
+        backups = BackupStore("worlds/%s/" % world).backups()
+        if not backups:
             data["client"].sendServerMessage("No backups found for %s." % world)
             return
-        world_dir = "worlds/%s/" % world
-        folders = os.listdir(world_dir + "backup/")
-        Num_backups = list([])
-        Name_backups = list([])
-        for x in folders:
-            if x.isdigit():
-                Num_backups.append(x)
-            else:
-                Name_backups.append(x)
-        Num_backups.sort(lambda x, y: int(x) - int(y))
-        if Num_backups > 2:
+        Num_backups = [x for x in backups if x.isdigit()]
+        Name_backups = [x for x in backups if not x.isdigit()]
+        if len(Num_backups) > 2:
             data["client"].sendServerList(["Backups for %s:" % world] + [Num_backups[0] + "-" + Num_backups[-1]] + Name_backups)
         else:
             data["client"].sendServerList(["Backups for %s:" % world] + Num_backups + Name_backups)
@@ -147,22 +164,13 @@ class WorldUtilPlugin(object):
         if len(data["parts"]) < 3:
             data["client"].sendServerMessage("Please specify a worldname.")
             return
-        if not os.path.exists("worlds/%s/backup/%s" % (data["parts"][1], data["parts"][2])):
+        store = BackupStore("worlds/%s/" % data["parts"][1])
+        if not store.exists(data["parts"][2]):
             data["client"].sendServerMessage("Backup %s for world %s doesn't exist." % (data["parts"][2], data["parts"][1]))
             return
-        name = data["parts"][1]
-        extra = "_0"
-        if os.path.exists("worlds/.trash/%s" % name):
-            def doRename():
-                if os.path.exists("worlds/.trash/%s" % (name + extra)):
-                    extra = "_" + str(int(extra[1:]) + 1)
-                    reactor.callLater(0.1, doRename)
-                else:
-                    name = name + extra
-            doRename()
-        shutil.copytree("worlds/%s/backup/%s" % (parts[1], parts[2]), "worlds/.trash/%s/%s" % (name, parts[2]))
-        shutil.rmtree("worlds/%s/backup/%s" % (parts[1], parts[2]))
-        data["client"].sendServerMessage("Backup deleted as %s." % name)
+        # Keep it in the trash, in case it's wanted after all
+        name = store.trash(data["parts"][2], "worlds/.trash/%s/" % data["parts"][1])
+        data["client"].sendServerMessage("Backup %s for world %s deleted (kept in the trash as %s)." % (data["parts"][2], data["parts"][1], name))
 
     @config("category", "world")
     @config("rank", "op")
@@ -212,6 +220,66 @@ class WorldUtilPlugin(object):
             data["client"].sendWorldMessage("This world now has finite water disabled.")
         data["client"].world.status["modified"] = True
 
+    @config("category", "world")
+    @config("rank", "admin")
+    @config("usage", "[classic|vector]")
+    @config("disabled-on", ["cmdblock", "irc"])
+    def commandPhysengine(self, data):
+        "Shows or picks the physics engine this world uses.\nvector is faster on big floods, but needs NumPy."
+        world = data["client"].world
+        if len(data["parts"]) < 2:
+            data["client"].sendServerMessage("This world uses the %s physics engine." % world.physics_engine)
+            return
+        name = data["parts"][1].lower()
+        if name not in PHYSICS_ENGINES:
+            data["client"].sendServerMessage("Physics engines: %s" % ", ".join(sorted(PHYSICS_ENGINES)))
+            return
+        if name == "vector" and not (can_vectorize() and self.factory.numpy_blocks):
+            data["client"].sendServerMessage("The vector physics engine needs NumPy.")
+            return
+        world.physics_engine = name
+        world.status["modified"] = True
+        data["client"].sendWorldMessage("This world now uses the %s physics engine." % name)
+
+    @config("category", "world")
+    @config("rank", "admin")
+    @config("usage", "[on|off]")
+    @config("disabled-on", ["cmdblock", "irc"])
+    def commandPhysprocess(self, data):
+        "Shows or sets if this world's physics runs in a process of its own.\nHelps the rest of the server keep up during big floods."
+        world = data["client"].world
+        if len(data["parts"]) < 2:
+            data["client"].sendServerMessage("This world's physics runs in %s." % (
+                "its own process" if world.physics_process else "the server process"))
+            return
+        setting = data["parts"][1].lower()
+        if setting not in ["on", "off"]:
+            data["client"].sendServerMessage("Use 'on' or 'off', not '%s'" % data["parts"][1])
+            return
+        if setting == "on" and not can_launch():
+            data["client"].sendServerMessage("This server can't run physics in a process of its own.")
+            return
+        world.physics_process = (setting == "on")
+        world.status["modified"] = True
+        if world.physics_process:
+            data["client"].sendWorldMessage("This world's physics now runs in its own process.")
+        else:
+            data["client"].sendWorldMessage("This world's physics now runs in the server process.")
+
+    @config("category", "world")
+    @config("rank", "admin")
+    @config("disabled-on", ["irc", "irc_query", "console"])
+    def commandPhysstats(self, data):
+        "Shows how long this world's physics ticks are taking."
+        stats = data["client"].world.physics_stats()
+        if not stats or not stats["ticks"]:
+            data["client"].sendServerMessage("No physics has run here yet.")
+            return
+        data["client"].sendServerMessage("Physics: %(ticks)d ticks, last %(last).1fms, average %(average).1fms, longest %(longest).1fms" % stats)
+        data["client"].sendServerMessage("Started %(lateness).1fms late on average; %(overruns)d over budget, %(skipped)d skipped" % stats)
+        if "regions" in stats:
+            data["client"].sendServerMessage("%(awake_regions)d of %(regions)d regions still awake" % stats)
+
     @config("category", "world")
     @config("rank", "admin")
     def commandPhysflush(self, data):
@@ -220,8 +288,8 @@ class WorldUtilPlugin(object):
             if self.factory.numberWithPhysics() >= self.factory.physics_limit:
                 data["client"].sendServerMessage("There are already %s worlds with physics on (the max)." % self.factory.physics_limit)
             else:
-                data["client"].world.status["physics"] = False
-                data["client"].world.status["physics"] = True
+                # Settled regions aren't looked at when physics starts up, so wake them all
+                data["client"].world.wake_physics()
                 data["client"].sendWorldMessage("This world now has a physics flush running.")
         else:
             data["client"].sendServerMessage("This world does not have physics on.")
@@ -493,35 +561,79 @@ class WorldUtilPlugin(object):
 
     @config("category", "world")
     @config("rank", "admin")
-    @config("usage", "worldname width height length")
+    @config("usage", "worldname width height length [seed|flat]")
     @config("disabled-on", ["cmdblock", "irc"])
     def commandCreate(self, data):
-        "Creates a new world with specified dimensions."
+        "Creates a new world with specified dimensions.\nGive a seed for the terrain, or 'flat' for flatgrass."
         if len(data["parts"]) == 1:
             data["client"].sendServerMessage("Please specify a world name.")
+            return
         elif self.factory.world_exists(data["parts"][1]):
             data["client"].sendServerMessage("World name in use.")
+            return
         elif len(data["parts"]) < 5:
-            data["client"].sendServerMessage("Please specify dimensions. (width, length, height)")
-        elif int(data["parts"][2]) < 16 or int(data["parts"][3]) < 16 or int(data["parts"][4]) < 16:
+            data["client"].sendServerMessage("Please specify dimensions. (width, height, length)")
+            return
+        try:
+            sx, sy, sz = [int(i) for i in data["parts"][2:5]]
+        except ValueError:
+            data["client"].sendServerMessage("All dimensions must be integers.")
+            return
+        if sx < 16 or sy < 16 or sz < 16:
             data["client"].sendServerMessage("No dimension may be smaller than 16.")
-        elif int(data["parts"][2]) > 1024 or int(data["parts"][3]) > 1024 or int(data["parts"][4]) > 1024:
+        elif sx > 1024 or sy > 1024 or sz > 1024:
             data["client"].sendServerMessage("No dimension may be greater than 1024.")
-        elif (int(data["parts"][2]) % 16) > 0 or (int(data["parts"][3]) % 16) > 0 or (int(data["parts"][4]) % 16) > 0:
+        elif (sx % 16) > 0 or (sy % 16) > 0 or (sz % 16) > 0:
             data["client"].sendServerMessage("All dimensions must be divisible by 16.")
         else:
             world_id = data["parts"][1].lower()
-            sx, sy, sz = [int(i) for i in data["parts"][2:4]]
-            grass_to = (sy // 2)
-            world = World.create(
-                "worlds/%s" % world_id,
-                sx, sy, sz, # Size
-                sx // 2, grass_to + 2, sz // 2, 0, # Spawn
-                ([BLOCK_DIRT] * (grass_to - 1) + [BLOCK_GRASS] + [BLOCK_AIR] * (sy - grass_to)) # Levels
-            )
-            self.factory.loadWorld("worlds/%s" % world_id, world_id)
-            self.factory.worlds[world_id].status["all_build"] = False
-            data["client"].sendServerMessage("World '%s' made and booted." % world_id)
+            flat = len(data["parts"]) > 5 and data["parts"][5].lower() == "flat"
+            if not (flat or can_generate()):
+                data["client"].sendServerMessage("NumPy isn't installed, so the world will be flat.")
+                flat = True
+            if flat:
+                grass_to = (sy // 2)
+                World.create(
+                    "worlds/%s" % world_id,
+                    sx, sy, sz, # Size
+                    sx // 2, grass_to + 2, sz // 2, 0, # Spawn
+                    ([BLOCK_DIRT] * (grass_to - 1) + [BLOCK_GRASS] + [BLOCK_AIR] * (sy - grass_to)), # Levels
+                    factory=self.factory,
+                )
+                self.bootCreated(data, world_id)
+                return
+            if len(data["parts"]) > 5:
+                try:
+                    seed = int(data["parts"][5])
+                except ValueError:
+                    # Any word will do as a seed
+                    seed = hash(data["parts"][5])
+            else:
+                seed = random.randint(0, 0x7fffffff)
+            settings = TerrainSettings(sx, sy, sz, seed)
+            os.mkdir("worlds/%s" % world_id)
+            data["client"].sendServerMessage("Generating world '%s' (seed %s)..." % (world_id, settings.seed))
+            reported = [0]
+            def progress(fraction):
+                # Every 10% is plenty
+                if int(fraction * 10) > reported[0]:
+                    reported[0] = int(fraction * 10)
+                    data["client"].sendServerMessage("Generating '%s': %d%% done." % (world_id, reported[0] * 10))
+            def generated(spawn):
+                World.create("worlds/%s" % world_id, sx, sy, sz, *spawn, factory=self.factory)
+                self.bootCreated(data, world_id)
+            def failed(reason):
+                shutil.rmtree("worlds/%s" % world_id, True)
+                self.factory.logger.error("Generating world '%s' failed: %s" % (world_id, reason.getErrorMessage()))
+                data["client"].sendServerMessage("Sorry, generating world '%s' failed." % world_id)
+            build = TerrainBuild("worlds/%s/blocks.gz" % world_id, settings, progress)
+            build.start().addCallbacks(generated, failed)
+
+    def bootCreated(self, data, world_id):
+        "Boots a world that /create just made."
+        self.factory.loadWorld("worlds/%s" % world_id, world_id)
+        self.factory.worlds[world_id].status["all_build"] = False
+        data["client"].sendServerMessage("World '%s' made and booted." % world_id)
 
     @config("category", "world")
     @config("rank", "admin")
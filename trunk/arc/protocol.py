@@ -459,16 +459,20 @@ class ArcServerProtocol(Protocol):
 
     def sendBlock(self, x, y, z, block=None):
         try:
-            def real_send(block):
-                self.sendPacked(TYPE_BLOCKSET, x, y, z, block)
-
-            if block is not None:
-                real_send(block)
-            else:
-                self.world[x, y, z].addCallback(real_send)
+            if block is None:
+                block = self.world.get_block(x, y, z)
+            if block is None:
+                # The blocks are still loading; send it once they're in
+                self.world[x, y, z].addCallback(lambda block: self.sendPacked(TYPE_BLOCKSET, x, y, z, block))
+                return
+            self.sendPacked(TYPE_BLOCKSET, x, y, z, block)
         except AssertionError:
             self.factory.logger.warn("Block out of range: %s %s %s" % (x, y, z))
 
+    def sendBlockPackets(self, packets):
+        "Sends a run of block changes that are already packed (see World.broadcast_blocks)."
+        self.transport.write(packets)
+
     def sendPlayerPos(self, id, x, y, z, h, p):
         self.sendPacked(TYPE_PLAYERPOS, id, x, y, z, h, p)
 
@@ -608,16 +612,17 @@ class ArcServerProtocol(Protocol):
     def sendLevel(self):
         "Starts the process of sending a level to the client."
         self.factory.recordPresence(self.username)
-        # Ask the World to flush the level and get a gzip handle back to us.
+        # Ask the World for the gzipped level (shared with anyone else joining).
         if hasattr(self, "world"):
-            self.world.get_gzip_handle().addCallback(self.sendLevelStart)
+            self.world.get_level_stream().addCallback(self.sendLevelStart)
 
-    def sendLevelStart(self, (gzip_handle, zipped_size)):
-        "Called when the world is flushed and the gzip is ready to read."
-        # Store that handle and size
-        self.zipped_level, self.zipped_size = gzip_handle, zipped_size
+    def sendLevelStart(self, zipped_level):
+        "Called when the gzipped level is ready to send."
+        # Store the level and where we're up to
+        self.zipped_level, self.zipped_size = zipped_level, len(zipped_level)
+        self.zipped_position = 0
         # Preload our first chunk, send a level stream header, and go!
-        self.chunk = self.zipped_level.read(1024)
+        self.chunk = self.zipped_level[:1024]
         self.factory.logger.debug("Sending level...")
         self.sendPacked(TYPE_PRECHUNK)
         reactor.callLater(0.001, self.sendLevelChunk)
@@ -627,15 +632,16 @@ class ArcServerProtocol(Protocol):
             self.factory.logger.error("Cannot send chunk, there isn't one! %r %r" % (self, self.__dict__))
             return
         if self.chunk:
+            self.zipped_position += len(self.chunk)
             self.sendPacked(TYPE_CHUNK, len(self.chunk), self.chunk,
-                chr(int(100 * (self.zipped_level.tell() / float(self.zipped_size)))))
-            self.chunk = self.zipped_level.read(1024)
+                chr(int(100 * (self.zipped_position / float(self.zipped_size)))))
+            self.chunk = self.zipped_level[self.zipped_position:self.zipped_position + 1024]
             reactor.callLater(0.001, self.sendLevelChunk)
         else:
-            self.zipped_level.close()
             del self.zipped_level
             del self.chunk
             del self.zipped_size
+            del self.zipped_position
             self.endSendLevel()
 
     def endSendLevel(self):
@@ -733,6 +739,20 @@ class ArcServerProtocol(Protocol):
         self.sendServerMessage("This world is locked. You must be Builder/Op or Mod+ to build here.")
         return False
 
+    def allowedToBuildBox(self, x1, y1, z1, x2, y2, z2):
+        """
+        Says if allowedToBuild would let us build anywhere in the box without
+        having to ask it block by block: no zones touch the box, and the world
+        lets us build. Admin blocks inside still need keeping for non-ops.
+        """
+        for zone in self.world.userzones.values() + self.world.rankzones.values():
+            zx1, zy1, zz1, zx2, zy2, zz2 = zone[1:7]
+            if zx1 < x2 and zx2 > x1 and zy1 < y2 and zy2 > y1 and zz1 < z2 and zz2 > z1:
+                return False
+        if self.world.id == self.factory.default_name and not self.isMod() and not self.world.status["all_build"]:
+            return False
+        return self.isBuilder() or self.isOp() or self.world.status["all_build"]
+
     def getBlockValue(self, value):
         # Try getting the block as a direct integer type.
         try:
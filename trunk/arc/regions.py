@@ -0,0 +1,227 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import gzip, os, struct
+from threading import Lock
+
+from arc.compression import compress
+from arc.gzipstream import *
+from arc.worldmeta import read_size
+
+REGION_MAGIC = "ARCR"
+REGION_VERSION = 1
+# Regions are runs of 32768 bytes (the volume of a 32x32x32 cube) in block
+# offset order. Keeping them contiguous means their deflate segments can be
+# spliced straight into the classic gzip stream without recompressing.
+REGION_BYTES = 32 * 32 * 32
+REGION_HEADER = "!4sBiiii"
+REGION_ENTRY = "!QIII"
+
+class RegionFile(object):
+    """
+    A world stored as independently compressed regions.
+    blocks.rgn holds the deflated regions, blocks.rgi is the index saying
+    where each one lives. Rewritten regions are appended to the data file and
+    the index is swapped in afterwards, so a crash mid-save leaves the old
+    index (and the old regions it points at) intact.
+    """
+
+    def __init__(self, blocks_path):
+        base = os.path.splitext(blocks_path)[0]
+        self.index_path = base + ".rgi"
+        self.data_path = base + ".rgn"
+        self.lock = Lock()
+        self.x, self.y, self.z = 0, 0, 0
+        self.region_bytes = REGION_BYTES
+        self.entries = [] # [data offset, compressed length, raw size, crc32]
+
+    @classmethod
+    def exists_for(cls, blocks_path):
+        "Says if the world at blocks_path has been converted to regions."
+        return os.path.isfile(os.path.splitext(blocks_path)[0] + ".rgi")
+
+    @property
+    def volume(self):
+        return self.x * self.y * self.z
+
+    def region_count(self):
+        return (self.volume + self.region_bytes - 1) // self.region_bytes
+
+    def load_index(self):
+        "Reads the region index into memory."
+        fh = open(self.index_path, "rb")
+        try:
+            header = fh.read(struct.calcsize(REGION_HEADER))
+            magic, version, self.x, self.y, self.z, self.region_bytes = struct.unpack(REGION_HEADER, header)
+            if magic != REGION_MAGIC or version != REGION_VERSION:
+                raise IOError("%s is not a version %d region index" % (self.index_path, REGION_VERSION))
+            entry_size = struct.calcsize(REGION_ENTRY)
+            self.entries = []
+            for i in xrange(self.region_count()):
+                self.entries.append(list(struct.unpack(REGION_ENTRY, fh.read(entry_size))))
+        finally:
+            fh.close()
+
+    def save_index(self):
+        "Atomically replaces the index on disk."
+        fh = open(self.index_path + ".new", "wb")
+        fh.write(struct.pack(REGION_HEADER, REGION_MAGIC, REGION_VERSION, self.x, self.y, self.z, self.region_bytes))
+        for entry in self.entries:
+            fh.write(struct.pack(REGION_ENTRY, *entry))
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(self.index_path + ".new", self.index_path)
+
+    def region_span(self, region):
+        "Returns the (start, end) block offsets covered by a region."
+        start = region * self.region_bytes
+        return start, min(start + self.region_bytes, self.volume)
+
+    def read_segments(self):
+        "Yields the (segment, crc32, size) of every region, in order."
+        # Open the data file along with copying the index, so a compact() can't swap it in between;
+        # the file we have open keeps the data the entries point at even once it's been replaced
+        with self.lock:
+            entries = [list(entry) for entry in self.entries]
+            fh = open(self.data_path, "rb")
+        try:
+            for offset, length, size, crc in entries:
+                fh.seek(offset)
+                yield fh.read(length), crc, size
+        finally:
+            fh.close()
+
+    def read_into(self, raw_blocks):
+        "Decompresses every region onto the end of the given array."
+        for segment, crc, size in self.read_segments():
+            raw_blocks.extend(inflate_segment(segment))
+
+    def write_regions(self, regions, level=4):
+        """
+        Writes out the given {region number: raw string} dict, then points the
+        index at the new copies.
+        """
+        ordered = sorted(regions.items())
+        segments = compress([data for region, data in ordered], level)
+        self.write_segments(dict(zip([region for region, data in ordered], segments)))
+
+    def write_segments(self, segments):
+        """
+        Writes out already compressed regions, given as a {region number:
+        (segment, crc32, size)} dict, then points the index at them.
+        """
+        fh = open(self.data_path, "ab")
+        fh.seek(0, 2)
+        position = fh.tell()
+        updated = {}
+        for region, (segment, crc, size) in sorted(segments.items()):
+            fh.write(segment)
+            updated[region] = [position, len(segment), size, crc]
+            position += len(segment)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        with self.lock:
+            for region, entry in updated.items():
+                self.entries[region] = entry
+            self.save_index()
+        # Once stale copies outweigh live ones, squash the data file.
+        live = sum(entry[1] for entry in self.entries)
+        if position > live * 2:
+            self.compact()
+
+    def compact(self):
+        "Rewrites the data file so it holds only the live regions."
+        old = open(self.data_path, "rb")
+        new = open(self.data_path + ".new", "wb")
+        entries = []
+        position = 0
+        for offset, length, size, crc in self.entries:
+            old.seek(offset)
+            new.write(old.read(length))
+            entries.append([position, length, size, crc])
+            position += length
+        new.flush()
+        os.fsync(new.fileno())
+        new.close()
+        old.close()
+        with self.lock:
+            if os.path.exists(self.data_path + ".old"):
+                os.remove(self.data_path + ".old")
+            os.rename(self.data_path, self.data_path + ".old")
+            os.rename(self.data_path + ".new", self.data_path)
+            self.entries = entries
+            self.save_index()
+            os.remove(self.data_path + ".old")
+
+    def gzip_stream(self, overrides=None):
+        """
+        Assembles the classic blocks.gz stream from the stored regions.
+        overrides is a {region number: (segment, crc32, size)} dict of fresher
+        copies to use instead of what's on disk.
+        """
+        overrides = overrides or {}
+        header = struct.pack("!i", self.volume)
+        def segments():
+            yield deflate_segment(header), crc32(header), len(header)
+            for region, segment in enumerate(self.read_segments()):
+                yield overrides.get(region, segment)
+        return assemble_gzip(segments())
+
+    @classmethod
+    def create(cls, blocks_path, sx, sy, sz, fh, level=4):
+        """
+        Creates a region store next to blocks_path, reading the raw block data
+        (without the size header) from the file-like fh.
+        """
+        regions = cls(blocks_path)
+        regions.x, regions.y, regions.z = sx, sy, sz
+        if os.path.exists(regions.data_path):
+            os.remove(regions.data_path)
+        data = open(regions.data_path, "wb")
+        position = 0
+        # Compress a megabyte or so of regions at a time, in parallel
+        batch = max(1, (1024 * 1024) // regions.region_bytes)
+        for first in xrange(0, regions.region_count(), batch):
+            chunks = []
+            for region in xrange(first, min(first + batch, regions.region_count())):
+                start, end = regions.region_span(region)
+                chunk = fh.read(end - start)
+                if len(chunk) != end - start:
+                    data.close()
+                    raise IOError("Block data is truncated at offset %d" % (start + len(chunk)))
+                chunks.append(chunk)
+            for segment, crc, size in compress(chunks, level):
+                data.write(segment)
+                regions.entries.append([position, len(segment), size, crc])
+                position += len(segment)
+        data.flush()
+        os.fsync(data.fileno())
+        data.close()
+        regions.save_index()
+        return regions
+
+def convert_world(blocks_path):
+    """
+    Upgrades a blocks.gz world to the region format. The old file is kept as
+    blocks.gz.old. Returns the new RegionFile.
+    """
+    gz = gzip.GzipFile(blocks_path)
+    volume = struct.unpack("!i", gz.read(4))[0]
+    # Get the dimensions from the meta rather than guessing from the volume
+    sx, sy, sz = read_size(os.path.dirname(blocks_path))
+    if sx * sy * sz != volume:
+        gz.close()
+        raise ValueError("%s holds %d blocks but its metadata says %dx%dx%d" % (blocks_path, volume, sx, sy, sz))
+    try:
+        regions = RegionFile.create(blocks_path, sx, sy, sz, gz)
+    finally:
+        gz.close()
+    if os.path.exists(blocks_path + ".old"):
+        os.remove(blocks_path + ".old")
+    os.rename(blocks_path, blocks_path + ".old")
+    return regions
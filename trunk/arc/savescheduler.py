@@ -0,0 +1,103 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import time
+
+from twisted.internet.task import LoopingCall
+
+SAVE_BACKLOG = 65536 # A world with this many unsaved changes gets saved without waiting its turn
+SAVE_TIMEOUT = 300 # Seconds before we give up waiting on a save and let another start
+
+class SaveScheduler(object):
+    """
+    Decides which worlds get saved, and when. Worlds with unsaved changes
+    are saved once they've waited save_interval seconds (or sooner, if the
+    changes are piling up), busiest and longest-waiting first, with at most
+    save_concurrency saves underway at once. Worlds with nothing new to
+    save are left alone.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.logger = factory.logger
+        self.saving = {} # World ID: (world, time its save started)
+        self.last_meta_save = time.time()
+        self.loop = LoopingCall(self.tick)
+
+    def start(self):
+        self.loop.start(1, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        "Starts the most urgent saves there's room for."
+        now = time.time()
+        self.prune(now)
+        if now - self.last_meta_save >= self.factory.save_interval:
+            self.factory.saveMeta()
+            self.last_meta_save = now
+        for world in self.due(now):
+            if len(self.saving) >= max(1, self.factory.save_concurrency):
+                break
+            self.save(world)
+
+    def prune(self, now):
+        "Forgets saves that will never report back (their world went away) or took too long."
+        for world_id, (world, started) in self.saving.items():
+            if self.factory.worlds.get(world_id) is not world or world.cold:
+                del self.saving[world_id]
+            elif now - started > SAVE_TIMEOUT:
+                self.logger.warn("Save of world '%s' is taking a long time." % world_id)
+                del self.saving[world_id]
+
+    def due(self, now):
+        """
+        Returns the worlds that need saving now, most urgent first. Worlds
+        with no unsaved blocks only get their meta checked, which is free
+        unless it changed.
+        """
+        due = []
+        for world_id, world in self.factory.worlds.items():
+            if world_id in self.saving:
+                continue
+            age = now - world.last_saved
+            backlog = world.backlog()
+            if not backlog:
+                if age >= self.factory.save_interval:
+                    world.save_meta()
+                    world.last_saved = now
+                continue
+            if age >= self.factory.save_interval or backlog >= SAVE_BACKLOG:
+                due.append((backlog, age, world_id))
+        due.sort(reverse=True)
+        return [self.factory.worlds[world_id] for backlog, age, world_id in due]
+
+    def save(self, world):
+        "Starts saving the given world."
+        deferred = self.factory.saveWorld(world.id)
+        if deferred is None:
+            return
+        self.saving[world.id] = (world, time.time())
+        deferred.addBoth(self.saved, world)
+
+    def saved(self, result, world):
+        if self.saving.get(world.id, (None,))[0] is world:
+            del self.saving[world.id]
+        return result
+
+    def save_all(self):
+        "Saves every world with unsaved changes right away, however many that is."
+        for world_id, world in self.factory.worlds.items():
+            if world_id not in self.saving and world.backlog():
+                self.save(world)
+            else:
+                world.save_meta()
+        self.factory.saveMeta()
+        self.last_meta_save = time.time()
+
+    def status(self):
+        "Returns {world ID: (time it was last saved, changes waiting to be saved)} for every booted world."
+        return dict((world_id, (world.last_saved, world.backlog())) for world_id, world in self.factory.worlds.items())
@@ -13,17 +13,24 @@ except:
     NOSSL = True
 else:
     from twisted.internet import ssl
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor, task, threads
 from twisted.internet.protocol import Factory
 
+from arc.backups import BackupStore, read_world
+from arc.compression import start_pool
 from arc.console import Console
+from arc.executor import start_executor
 from arc.constants import *
 from arc.globals import *
 from arc.heartbeat import Heartbeat
 from arc.irc_client import ChatBotFactory
 from arc.logger import ColouredLogger, ChatLogHandler
+from arc.physicsprocess import start_launcher
 from arc.protocol import ArcServerProtocol
+from arc.regions import RegionFile, convert_world
+from arc.savescheduler import SaveScheduler
 from arc.world import World
+from arc.worldmeta import read_meta
 
 class ArcFactory(Factory):
     """
@@ -56,6 +63,8 @@ class ArcFactory(Factory):
         # Initialise internal datastructures
         self.loops = {}
         self.worlds = {}
+        self.stopping_blockstores = {} # World directory: BlockStore still saving after that world was shut down
+        self.backup_lock = defer.DeferredLock() # Backups run one at a time, so they don't pick the same number
         self.owners = set()
         self.directors = set()
         self.admins = set()
@@ -74,6 +83,10 @@ class ArcFactory(Factory):
             self.chatlogs[k] = ChatLogHandler("logs/%s.log" % k, v)
         # Load the config
         self.loadConfig()
+        # Start the physics launcher and compression processes before any world threads are around
+        start_launcher()
+        start_pool(self.save_processes)
+        start_executor(self.world_workers)
         # Read in the greeting
         try:
             r = open('config/greeting.txt', 'r')
@@ -124,7 +137,8 @@ class ArcFactory(Factory):
                 "worlds/%s" % self.default_name,
                 sx, sy, sz, # Size
                 sx // 2, grass_to + 2, sz // 2, 0, # Spawn
-                ([BLOCK_DIRT] * (grass_to - 1) + [BLOCK_GRASS] + [BLOCK_AIR] * (sy - grass_to)) # Levels
+                ([BLOCK_DIRT] * (grass_to - 1) + [BLOCK_GRASS] + [BLOCK_AIR] * (sy - grass_to)), # Levels
+                factory=self,
             )
             self.logger.info("Generated.")
             # Load up the contents of data.
@@ -571,10 +585,12 @@ class ArcFactory(Factory):
         self.loops["sendmessages"].start(0.1)
         self.loops["printinfo"] = task.LoopingCall(self.printInfo)
         self.loops["printinfo"].start(60)
-        # Initial startup is instant, but it updates every 10 minutes.
-        self.world_save_stack = []
-        self.loops["saveworlds"] = task.LoopingCall(self.saveWorlds)
-        self.loops["saveworlds"].start(60, now=False)
+        self.loops["checkmemory"] = task.LoopingCall(self.checkMemory)
+        self.loops["checkmemory"].start(10, now=False)
+        # Worlds with unsaved changes get saved every so often, busiest first
+        self.save_scheduler = SaveScheduler(self)
+        self.loops["saveworlds"] = self.save_scheduler.loop
+        self.save_scheduler.start()
         gc.disable()
         self.loops["cleangarbage"] = task.LoopingCall(self.cleanGarbage)
         self.loops["cleangarbage"].start(60 * 15)
@@ -768,6 +784,33 @@ class ArcFactory(Factory):
                     self.useLowLag = False
                     self.logger.warn("Disabling low lag mode.")
 
+    def worldMemory(self):
+        "Returns a dict of how many bytes each booted world's blocks are using."
+        return dict((world_id, world.resident_bytes()) for world_id, world in self.worlds.items())
+
+    def checkMemory(self):
+        "Cools down the least recently used idle worlds until we're inside the world memory budget."
+        # Forget shut down worlds' BlockStores once they've finished saving
+        for path, blockstore in self.stopping_blockstores.items():
+            if blockstore.stopped.isSet():
+                del self.stopping_blockstores[path]
+        if not self.world_memory:
+            return
+        budget = self.world_memory * 1024 * 1024
+        used = sum(self.worldMemory().values())
+        if used <= budget:
+            return
+        idle = [world for world in self.worlds.values() if world.can_cool()]
+        idle.sort(key=lambda world: world.last_used)
+        for world in idle:
+            if used <= budget:
+                break
+            used -= world.resident_bytes()
+            world.save_meta()
+            world.cool()
+            self.logger.info("World '%s' unloaded from memory to stay within the world memory budget." % world.id)
+            self.runHook("worldCooled", {"world": world})
+
     def loadArchive(self, filename):
         "Boots an archive given a filename. Returns the new world ID."
         # Get an unused world name
@@ -784,34 +827,32 @@ class ArcFactory(Factory):
         return world_id
 
     def saveWorlds(self):
-        "Saves the worlds, one at a time, with a 1 second delay."
-        self._saveWorlds()
-
-    def _saveWorlds(self):
-        "Handles actual saving process."
-        if not self.saving:
-            if not self.world_save_stack:
-                self.world_save_stack = list(self.worlds)
-            key = self.world_save_stack.pop()
-            self.saveWorld(key)
-            if not self.world_save_stack:
-                self.saveMeta()
-            else:
-                reactor.callLater(1, self._saveWorlds)
+        "Saves every world with unsaved changes now, and the server's meta."
+        self.save_scheduler.save_all()
 
     def saveWorld(self, world_id, shutdown=False):
+        """
+        Saves the given world. Returns a Deferred that fires once its blocks
+        are on disk, or None if nothing was saved.
+        """
         value = self.runHook("worldSaving", {"world_id": world_id, "shutdown": shutdown})
         if value is False: return
+        deferred = None
         try:
             world = self.worlds[world_id]
             world.save_meta()
-            world.flush()
+            deferred = world.flush()
             self.logger.info("World '%s' has been saved." % world_id)
             if shutdown: del self.worlds[world_id]
         except Exception as e:
             self.logger.error("Error saving world %s." % world_id)
             self.logger.error("Error: %s" % e)
         self.runHook("worldSaved", {"world_id": world_id, "shutdown": shutdown})
+        return deferred
+
+    def saveStatus(self):
+        "Returns {world ID: (time it was last saved, changes waiting to be saved)} for every booted world."
+        return self.save_scheduler.status()
 
     def claimId(self, client):
         for i in range(1, self.max_clients + 1):
@@ -860,13 +901,23 @@ class ArcFactory(Factory):
         Returns the ID of the new world.
         """
         # Check if the world actually exists
-        if not (os.path.isfile("%s/blocks.gz" % filename) or os.path.isfile("%s/blocks.gz.old" % filename)):
+        blocks_path = "%s/blocks.gz" % filename
+        if not (os.path.isfile(blocks_path) or os.path.isfile("%s/blocks.gz.old" % filename) or RegionFile.exists_for(blocks_path)):
             raise AssertionError # Lazy workaround, need to fix
+        # Upgrade old worlds to the region format if we've been asked to
+        if self.region_worlds and os.path.isfile(blocks_path) and not RegionFile.exists_for(blocks_path):
+            self.logger.info("Converting world '%s' to the region format..." % world_id)
+            try:
+                convert_world(blocks_path)
+            except Exception as e:
+                self.logger.error("Unable to convert world '%s': %s" % (world_id, e))
         world = self.worlds[world_id] = World(filename, factory=self)
         world.source = filename
         world.clients = set()
         world.id = world_id
         world.factory = self
+        # If it was only just shut down, its blocks get loaded once that save is finished
+        world.old_blockstore = self.takeStoppingBlockstore(filename)
         world.start()
         self.logger.info("World '%s' Booted." % world_id)
         self.runHook("worldLoaded", {"world_id": world_id})
@@ -883,6 +934,7 @@ class ArcFactory(Factory):
             client.changeToWorld(self.default_name)
             client.sendServerMessage("World '%s' has been shut down." % world_id)
         self.worlds[world_id].stop()
+        self.keepStoppingBlockstore(self.worlds[world_id])
         self.saveWorld(world_id, shutdown=True)
         self.logger.info("World '%s' Shutdown." % world_id)
         self.runHook("worldUnloaded", {"world_id": world_id})
@@ -903,6 +955,7 @@ class ArcFactory(Factory):
         self.worlds[world_id].stop()
         self.worlds[world_id].flush()
         self.worlds[world_id].save_meta()
+        self.keepStoppingBlockstore(self.worlds[world_id])
         del self.worlds[world_id]
         filename = "worlds/%s" % world_id
         world = self.worlds[world_id] = World(filename, factory=self)
@@ -910,10 +963,25 @@ class ArcFactory(Factory):
         world.clients = set()
         world.id = world_id
         world.factory = self
+        # The new BlockStore waits for the old one's last save before it reads the files
+        world.old_blockstore = self.takeStoppingBlockstore(filename)
         world.start()
         self.logger.info("Rebooted %s" % world_id)
         self.runHook("worldRebooted", {"world_id": world_id})
 
+    def keepStoppingBlockstore(self, world):
+        "Remembers the BlockStore of a world that's being shut down, until its last save is done."
+        blockstore = world._blockstore or world.old_blockstore
+        if blockstore is not None and not blockstore.stopped.isSet():
+            self.stopping_blockstores[os.path.normpath(world.basename)] = blockstore
+
+    def takeStoppingBlockstore(self, filename):
+        "Returns the BlockStore that's still saving the world in filename, if there is one."
+        blockstore = self.stopping_blockstores.pop(os.path.normpath(filename), None)
+        if blockstore is not None and blockstore.stopped.isSet():
+            return None
+        return blockstore
+
     def publicWorlds(self):
         """
         Returns the IDs of all public worlds
@@ -954,6 +1022,13 @@ class ArcFactory(Factory):
                         for client in world.clients:
                             if client is not source_client:
                                 client.sendBlock(*data)
+                # Lots of blocks changed at once (data is their packets, ready to go)
+                elif task is TASK_BLOCKSETS:
+                    value = self.runHook("onBlocksets", {"world": world, "packets": data})
+                    if value is not False:
+                        world.status["modified"] = True
+                        for client in world.clients:
+                            client.sendBlockPackets(data)
                 # Someone moved
                 elif task is TASK_PLAYERPOS:
                     value = self.runHook("onPlayerPos", {"client": source_client, "data": data})
@@ -977,9 +1052,10 @@ class ArcFactory(Factory):
                         for client in world.clients:
                             # Save their initial position
                             client.initial_position = client.x >> 5, client.y >> 5, client.z >> 5, client.h
-                            client.sendPlayerLeave(data)
+                            if data is not None:
+                                client.sendPlayerLeave(data)
                             client.loading_world = True
-                            breakable_admins = client.runHook("canbreakadmin")
+                            breakable_admins = self.runHook("canBreakAdmincrete", {"client": client})
                             client.sendPacked(TYPE_INITIAL, 7, ("%s: %s" % (self.server_name, world.id)),
                                 "Respawning world '%s'..." % world.id, 100 if breakable_admins else 0)
                             client.sendLevel()
@@ -1213,13 +1289,26 @@ class ArcFactory(Factory):
         return os.path.isdir("worlds/%s/" % world_id)
 
     def autoBackup(self):
-        for world in self.worlds:
+        for world_id, world in self.worlds.items():
             if world.status["modified"] == True:
-                self.doBackup(world, "server", None)
+                self.doBackup(world_id, "server", None).addErrback(self.logBackupError, world_id)
                 # Reset modification flag
                 world.status["modified"] = False
 
+    def logBackupError(self, failure, world_id):
+        self.logger.error("Unable to back up '%s': %s" % (world_id, failure.getErrorMessage()))
+
     def doBackup(self, world_id, fromloc, id=None):
+        """
+        Backs up the given world. Hashing and compressing the blocks happens
+        in a thread, and backups run one at a time. Returns a Deferred that
+        fires with (1, backup name), or (0, 1) if it's the default world and
+        that isn't backed up, (0, 2) if the world doesn't exist, or (0, 3) if
+        the named backup already exists.
+        """
+        return self.backup_lock.run(self.runBackup, world_id, fromloc, id)
+
+    def runBackup(self, world_id, fromloc, id):
         world_dir = ("worlds/%s/" % world_id)
         if world_id == self.default_name and (not self.backup_default and fromloc == "server"):
             # Server is backing up default
@@ -1227,35 +1316,43 @@ class ArcFactory(Factory):
         if not os.path.exists(world_dir):
             # World does not exist
             return (0, 2)
-        if not os.path.exists(world_dir + "backup/"):
-            os.mkdir(world_dir + "backup/")
+        store = BackupStore(world_dir)
         if id != None:
-            path = os.path.join(world_dir + "backup/", parts[2])
-            if os.path.exists(path):
+            if store.exists(id):
                 return (0, 3) # Named backup exists
+            backupname = id
         else:
-            backups = list([])
-            for x in folders:
-                if x.isdigit():
-                    backups.append(x)
-            backups.sort(lambda x, y: int(x) - int(y))
-            path = os.path.join(world_dir + "backup/", "0")
-            if backups:
-                path = os.path.join(world_dir + "backup/", str(int(backups[-1]) + 1))
-        os.mkdir(path)
-        shutil.copy(world_dir + "blocks.gz", path)
-        shutil.copy(world_dir + "world.meta", path)
-        if id == None:
-            try:
-                backupname = str(int(backups[-1]) + 1)
-            except:
-                backupname = 0
-        else: backupname = id
-        if len(backups) + 1 > self.backup_max:
-            for i in range(0, ((len(backups) + 1) - self.backup_max)):
-                shutil.rmtree(os.path.join(world_dir + "backup/", str(int(backups[i]))))
-        self.runHook("onBackup", {"world_id": world_id, "backupname": backupname, "fromloc": fromloc})
-        return (1, backupname)
+            backupname = str(store.next_number())
+        # Worlds with their blocks loaded are backed up from memory, the rest from disk
+        size = blocks = meta = None
+        saving = [] # BlockStores that may still be writing the world's files
+        if world_id in self.worlds:
+            world = self.worlds[world_id]
+            world.save_meta()
+            if not world.cold:
+                meta = read_meta(world_dir)
+                size, blocks = (world.x, world.y, world.z), world.snapshot()
+            saving.append(world.old_blockstore)
+            if world._blockstore is not None:
+                saving.append(world._blockstore.predecessor)
+        saving.append(self.stopping_blockstores.get(os.path.normpath(world_dir)))
+        saving = [blockstore for blockstore in saving if blockstore is not None]
+        def backup(size, blocks, meta):
+            if blocks is None:
+                # Let any save of the world finish before reading its files
+                for blockstore in saving:
+                    blockstore.join()
+                size, blocks, meta = read_world(world_dir)
+            new_chunks = store.backup(backupname, size, blocks, meta)
+            if id == None:
+                # Only numbered backups get thinned out; backup_max is missing if auto backups are off
+                store.prune(getattr(self, "backup_max", 50))
+            return new_chunks
+        def done(new_chunks):
+            self.logger.debug("Backup %s of '%s' needed %d new chunks." % (backupname, world_id, new_chunks))
+            self.runHook("onBackup", {"world_id": world_id, "backupname": backupname, "fromloc": fromloc})
+            return (1, backupname)
+        return threads.deferToThread(backup, size, blocks, meta).addCallback(done)
 
     def loadArchives(self):
         self.archives = {}
@@ -1313,15 +1410,21 @@ class ArcFactory(Factory):
         else:
             w = self.worlds[world]
         d = defer.Deferred()
+        # Store the whole changeset as one batch; only the client updates get spread out
+        if save:
+            try:
+                w.set_blocks(changeset.iteritems())
+            except AssertionError as e:
+                d.errback(e)
+                return d
         iter = changeset.iteritems()
         def doStep():
             try:
                 for x in range(secperloop):
                     key, value = iter.next()
                     x, y, z = key
-                    if save: w[x, y, z] = value
-                    self.queue.add((w, TASK_BLOCKSET, (x, y, z, value)))
-                    reactor.callLater(0.01, doStep)
+                    self.queue.put((w, TASK_BLOCKSET, (x, y, z, value)))
+                reactor.callLater(0.01, doStep)
             except StopIteration:
                 d.callback(True)
             except Exception as e:
@@ -0,0 +1,87 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from arc.constants import *
+
+SPONGE_RADIUS = 2 # Sponges keep fluids out of the cube this many blocks around them
+CHR_SPONGE = chr(BLOCK_SPONGE)
+
+class SpongeField(object):
+    """
+    For every block of a world, how many sponges are within SPONGE_RADIUS
+    of it, so asking if a fluid may flow somewhere is one lookup rather
+    than a search. It's built from the blocks once, then kept up to date
+    by the BlockStore as sponges come and go.
+    """
+
+    def __init__(self, blockstore):
+        self.x, self.y, self.z = blockstore.x, blockstore.y, blockstore.z
+        view = blockstore.block_view
+        if view is not None:
+            # Sum the sponges over a cube around each block, one axis at a time
+            counts = (view == BLOCK_SPONGE).astype(numpy.uint8)
+            for axis in range(3):
+                summed = counts.copy()
+                source = counts.swapaxes(0, axis)
+                target = summed.swapaxes(0, axis)
+                for distance in range(1, SPONGE_RADIUS + 1):
+                    target[distance:] += source[:-distance]
+                    target[:-distance] += source[distance:]
+                counts = summed
+            self.counts = counts
+            self.flat = counts.reshape(-1)
+        else:
+            self.counts = None
+            self.flat = array('B', [0]) * (self.x * self.y * self.z)
+            blocks = buffer(blockstore.raw_blocks)[:]
+            offset = blocks.find(CHR_SPONGE)
+            while offset != -1:
+                self.change(offset, 1)
+                offset = blocks.find(CHR_SPONGE, offset + 1)
+
+    def nbytes(self):
+        return self.x * self.y * self.z
+
+    def change(self, offset, delta):
+        "Adds delta to the count of every block around the given offset."
+        x = offset % self.x
+        z = (offset // self.x) % self.z
+        y = offset // (self.x * self.z)
+        x1, x2 = max(x - SPONGE_RADIUS, 0), min(x + SPONGE_RADIUS + 1, self.x)
+        y1, y2 = max(y - SPONGE_RADIUS, 0), min(y + SPONGE_RADIUS + 1, self.y)
+        z1, z2 = max(z - SPONGE_RADIUS, 0), min(z + SPONGE_RADIUS + 1, self.z)
+        if self.counts is not None:
+            if delta > 0:
+                self.counts[y1:y2, z1:z2, x1:x2] += delta
+            else:
+                self.counts[y1:y2, z1:z2, x1:x2] -= -delta
+        else:
+            flat = self.flat
+            for ny in xrange(y1, y2):
+                for nz in xrange(z1, z2):
+                    row = (ny * self.z + nz) * self.x
+                    for nx in xrange(row + x1, row + x2):
+                        flat[nx] += delta
+
+    def update(self, added, removed):
+        "Takes note of sponges placed at the offsets in added, and taken away from those in removed."
+        for offset in added:
+            self.change(int(offset), 1)
+        for offset in removed:
+            self.change(int(offset), -1)
+
+    def covered(self, offset):
+        "Says if there's a sponge near the block at offset."
+        return self.flat[offset] != 0
+
+    def covered_cells(self, ys, zs, xs):
+        "Like covered, for arrays of coordinates (which must be inside the world)."
+        return self.counts[ys, zs, xs] != 0
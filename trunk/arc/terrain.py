@@ -0,0 +1,257 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+Procedural terrain for new worlds: rolling hills from a heightmap, caves,
+ores, trees and water, all decided by a seed. The level is generated a band
+of layers at a time in the compression pool, and each band goes into the
+blocks file as a deflated segment as soon as the bands below it are done,
+so memory use doesn't grow with the size of the world.
+"""
+
+import os, struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from twisted.internet import defer, task
+
+from arc.compression import PoolJob, SEGMENT_BYTES
+from arc.constants import *
+from arc.gzipstream import *
+
+BANDS_IN_FLIGHT = 4 # Bands being generated at once; bounds how much we hold in memory
+
+_cache = {} # The last world's heightmap and such, so each band doesn't redo them
+
+def can_generate():
+    "Says if terrain can be generated here; it needs NumPy."
+    return numpy is not None
+
+class TerrainSettings(object):
+    "What a world should look like. Everything random comes from the seed."
+
+    def __init__(self, x, y, z, seed, water_level=None, hilliness=0.5, caves=True, ores=True, trees=True):
+        self.x, self.y, self.z = x, y, z
+        self.seed = seed & 0x7fffffff
+        self.ground_level = y // 2
+        self.water_level = (self.ground_level - 2) if water_level is None else water_level
+        self.hilliness = hilliness
+        self.caves = caves
+        self.ores = ores
+        self.trees = trees
+
+    def key(self):
+        return (self.x, self.y, self.z, self.seed, self.water_level, self.hilliness, self.caves, self.ores, self.trees)
+
+def _random(seed, salt):
+    return numpy.random.RandomState((seed * 7919 + salt * 104729) & 0x7fffffff)
+
+def _smooth(t):
+    return t * t * (3 - 2 * t)
+
+def _interpolate(lattice, sz, sx, scale):
+    "Scales a [z, x] lattice of random values up to sz by sx, smoothly."
+    z = numpy.arange(sz)
+    x = numpy.arange(sx)
+    zi, zt = z // scale, _smooth((z % scale) / float(scale))[:, None]
+    xi, xt = x // scale, _smooth((x % scale) / float(scale))[None, :]
+    near = lattice[zi][:, xi] + (lattice[zi][:, xi + 1] - lattice[zi][:, xi]) * xt
+    far = lattice[zi + 1][:, xi] + (lattice[zi + 1][:, xi + 1] - lattice[zi + 1][:, xi]) * xt
+    return near + (far - near) * zt
+
+def _noise_2d(seed, salt, sz, sx, scale):
+    "Value noise in [0, 1) over a [z, x] plane."
+    lattice = _random(seed, salt).random_sample((sz // scale + 2, sx // scale + 2))
+    return _interpolate(lattice, sz, sx, scale)
+
+def _noise_lattice_3d(settings, salt, scale):
+    "The random lattice for 3D value noise, indexed [y, z, x]."
+    shape = (settings.y // scale + 2, settings.z // scale + 2, settings.x // scale + 2)
+    return _random(settings.seed, salt).random_sample(shape)
+
+def _noise_slice(lattice, y, sz, sx, scale):
+    "One [z, x] layer of 3D value noise."
+    yi, yt = y // scale, _smooth((y % scale) / float(scale))
+    plane = lattice[yi] + (lattice[yi + 1] - lattice[yi]) * yt
+    return _interpolate(plane, sz, sx, scale)
+
+def heightmap(settings):
+    "Returns the height of the ground for each column, as a [z, x] array."
+    noise = numpy.zeros((settings.z, settings.x))
+    for salt, (scale, weight) in enumerate([(64, 0.5), (32, 0.25), (16, 0.15), (8, 0.1)]):
+        noise += _noise_2d(settings.seed, salt + 1, settings.z, settings.x, scale) * weight
+    amplitude = settings.y * settings.hilliness / 2.0
+    heights = settings.ground_level + (noise - 0.5) * amplitude * 2
+    return numpy.clip(heights, 1, settings.y - 10).astype(numpy.int32)
+
+def plant_trees(settings, heights):
+    "Picks where trees go. Returns a list of (x, z, ground height, trunk height)."
+    if not settings.trees:
+        return []
+    random = _random(settings.seed, 20)
+    chance = random.random_sample(heights.shape)
+    trunks = random.randint(4, 7, heights.shape)
+    # Not in the water or on the beach, and not hard up against the edge
+    planted = (chance < 0.004) & (heights > settings.water_level + 1)
+    planted[:2, :] = planted[-2:, :] = planted[:, :2] = planted[:, -2:] = False
+    trees = []
+    for z, x in zip(*numpy.nonzero(planted)):
+        trees.append((int(x), int(z), int(heights[z, x]), int(trunks[z, x])))
+    return trees
+
+def _prepare(settings):
+    "Works out (or fetches) what every band of this world needs."
+    key = settings.key()
+    if key not in _cache:
+        _cache.clear()
+        heights = heightmap(settings)
+        _cache[key] = {
+            "heights": heights,
+            "trees": plant_trees(settings, heights),
+            "caves": (_noise_lattice_3d(settings, 10, 16), _noise_lattice_3d(settings, 11, 8)) if settings.caves else None,
+        }
+    return _cache[key]
+
+def generate_layer(settings, prepared, y):
+    "Returns layer y of the world as a [z, x] uint8 array."
+    heights = prepared["heights"]
+    sz, sx = heights.shape
+    if y == 0:
+        layer = numpy.empty((sz, sx), numpy.uint8)
+        layer.fill(BLOCK_SOLID)
+        return layer
+    layer = numpy.zeros((sz, sx), numpy.uint8)
+    beach = heights <= settings.water_level + 1
+    # The ground: rock, a few blocks of dirt, then grass (or sand, by the water)
+    layer[y < heights - 3] = BLOCK_ROCK
+    topsoil = (y >= heights - 3) & (y < heights)
+    layer[topsoil & ~beach] = BLOCK_DIRT
+    layer[topsoil & beach] = BLOCK_SAND
+    layer[(y == heights) & ~beach] = BLOCK_GRASS
+    layer[(y == heights) & beach] = BLOCK_SAND
+    layer[(y > heights) & (y <= settings.water_level)] = BLOCK_STILL_WATER
+    if settings.ores:
+        rock = layer == BLOCK_ROCK
+        chance = _random(settings.seed, 1000 + y).random_sample((sz, sx))
+        layer[rock & (chance < 0.008)] = BLOCK_COAL_ORE
+        if y < settings.y * 0.4:
+            layer[rock & (chance >= 0.008) & (chance < 0.013)] = BLOCK_IRON_ORE
+        if y < settings.y * 0.2:
+            layer[rock & (chance >= 0.013) & (chance < 0.015)] = BLOCK_GOLD_ORE
+    if prepared["caves"] is not None:
+        coarse, fine = prepared["caves"]
+        noise = _noise_slice(coarse, y, sz, sx, 16) * 0.65 + _noise_slice(fine, y, sz, sx, 8) * 0.35
+        # Keep them under the topsoil, so lakes don't drain into them
+        layer[(noise > 0.7) & (y < heights - 4)] = BLOCK_AIR
+    for x, z, ground, trunk in prepared["trees"]:
+        top = ground + trunk
+        if y <= ground or y > top + 1:
+            continue
+        if y >= top - 2:
+            # Leaves, narrowing at the very top, but never over something solid
+            radius = 1 if y > top else 2
+            area = layer[z - radius:z + radius + 1, x - radius:x + radius + 1]
+            area[area == BLOCK_AIR] = BLOCK_LEAVES
+        if y <= top:
+            layer[z, x] = BLOCK_LOG
+    return layer
+
+def generate_band(job):
+    """
+    Generates layers first to last - 1 and deflates them. Runs in the pool;
+    returns a (segment, crc32, size) tuple like the compression jobs do.
+    """
+    settings, first, last = job
+    prepared = _prepare(settings)
+    data = "".join([generate_layer(settings, prepared, y).tostring() for y in xrange(first, last)])
+    return deflate_segment(data), crc32(data), len(data)
+
+def spawn_point(settings):
+    "Returns a good (x, y, z, h) spawn: the middle of the map, just above the ground."
+    x, z = settings.x // 2, settings.z // 2
+    ground = max(heightmap(settings)[z, x], settings.water_level)
+    return x, min(ground + 2, settings.y - 1), z, 0
+
+class TerrainBuild(object):
+    """
+    Writes a generated level to blocks_path, a band of layers per pool job.
+    start() returns a Deferred that fires once the file is complete, and
+    progress (if given) is called with the fraction done as bands finish.
+    """
+
+    def __init__(self, blocks_path, settings, progress=None):
+        self.blocks_path = blocks_path
+        self.settings = settings
+        self.progress = progress
+        layer = settings.x * settings.z
+        per_band = max(1, SEGMENT_BYTES * 4 // layer)
+        self.bands = [(y, min(y + per_band, settings.y)) for y in xrange(0, settings.y, per_band)]
+        self.running = [] # Jobs in flight, lowest band first
+        self.next_band = 0
+        self.written = 0
+        self.crc = 0
+        self.size = 0
+        self.fh = None
+        self.spawn_job = None
+        self.deferred = None
+        self.loop = task.LoopingCall(self.poll)
+
+    def start(self):
+        if numpy is None:
+            return defer.fail(RuntimeError("Generating terrain needs NumPy."))
+        self.deferred = defer.Deferred()
+        self.spawn_job = PoolJob(spawn_point, [self.settings])
+        self.fh = open(self.blocks_path + ".new", "wb")
+        self.fh.write(gzip_header())
+        # The level starts with its size, like every blocks file
+        header = struct.pack("!i", self.settings.x * self.settings.y * self.settings.z)
+        self.write_segment(deflate_segment(header), crc32(header), len(header))
+        self.loop.start(0.1)
+        return self.deferred
+
+    def write_segment(self, segment, crc, size):
+        self.fh.write(segment)
+        self.crc = crc32_combine(self.crc, crc, size)
+        self.size += size
+
+    def poll(self):
+        "Writes out finished bands, in order, and keeps the pool busy."
+        try:
+            while self.running and self.running[0].ready():
+                ((segment, crc, size),) = self.running.pop(0).result()
+                self.write_segment(segment, crc, size)
+                self.written += 1
+                if self.progress is not None:
+                    self.progress(self.written / float(len(self.bands)))
+            while len(self.running) < BANDS_IN_FLIGHT and self.next_band < len(self.bands):
+                first, last = self.bands[self.next_band]
+                job = PoolJob(generate_band, [(self.settings, first, last)])
+                self.running.append(job)
+                self.next_band += 1
+                if job.ready():
+                    break # No pool, so that was done right here; let the reactor breathe between bands
+            if self.written == len(self.bands) and self.spawn_job.ready():
+                self.finish()
+        except Exception:
+            self.fail()
+
+    def finish(self):
+        self.loop.stop()
+        self.fh.write(GZIP_FINAL_BLOCK)
+        self.fh.write(gzip_trailer(self.crc, self.size))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        os.rename(self.blocks_path + ".new", self.blocks_path)
+        self.deferred.callback(self.spawn_job.result()[0])
+
+    def fail(self):
+        if self.loop.running:
+            self.loop.stop()
+        self.fh.close()
+        os.remove(self.blocks_path + ".new")
+        self.deferred.errback()
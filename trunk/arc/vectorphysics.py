@@ -0,0 +1,256 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+A physics engine that works out a whole pass at once with NumPy. It follows
+the same rules as arc.physics (which see), but looks at every active block
+together through array masks instead of one offset at a time, and hands
+the blockstore the pass's changes as a single batch.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from arc.constants import *
+from arc.physics import BLOCK_LAVA_SPOUT, BLOCK_SAND_SPOUT, BLOCK_SPOUT, Physics, find_active
+
+FLUIDS = [BLOCK_WATER, BLOCK_STILLWATER, BLOCK_LAVA, BLOCK_SAND]
+SPOUTS = {BLOCK_SPOUT: BLOCK_WATER, BLOCK_LAVA_SPOUT: BLOCK_LAVA, BLOCK_SAND_SPOUT: BLOCK_SAND}
+# The blocks a pass has to look at; anything else never changes by itself
+ACTIVE = [BLOCK_DIRT, BLOCK_GRASS] + FLUIDS + SPOUTS.keys()
+OUTSIDE = 255 # What peek() says is past the edge of the world
+
+# Straight down-and-out moves of finite fluids, then the diagonals, as (dx, dz), in the same order as
+# arc.neighbours' BELOW_STRAIGHT and BELOW_DIAGONAL (each pass shuffles them; see Physics.choose_directions)
+STRAIGHTS = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+DIAGONALS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+HORIZONTALS = STRAIGHTS
+
+def can_vectorize():
+    "Says if the vector engine can run here; it needs NumPy."
+    return numpy is not None
+
+def _dilate(mask, radius):
+    "Grows a 3D boolean mask by radius cells in every direction (a cube, not a sphere)."
+    for axis in range(3):
+        grown = mask.copy()
+        source = mask.swapaxes(0, axis)
+        target = grown.swapaxes(0, axis)
+        for distance in range(1, radius + 1):
+            target[distance:] |= source[:-distance]
+            target[:-distance] |= source[distance:]
+        mask = grown
+    return mask
+
+class VectorPhysics(Physics):
+    """
+    The NumPy physics engine. Needs the blockstore's block_view, so only
+    use it when NumPy is around and numpy_blocks is on.
+    """
+
+    def __init__(self, blockstore):
+        Physics.__init__(self, blockstore)
+        self.changed = [] # Arrays of offsets changed since the last pass
+        self.sky_changed = [] # Lists of the tops of columns whose height moved
+
+    def handle_change(self, offset, block):
+        self.changed.append(numpy.array([offset], numpy.int64))
+        self.activity.touch(offset)
+
+    def handle_changes(self, offsets):
+        if isinstance(offsets, array):
+            offsets = numpy.frombuffer(offsets, "u%d" % offsets.itemsize)
+        self.changed.append(numpy.array(offsets, numpy.int64))
+        self.activity.touch_many(self.changed[-1])
+
+    def handle_sky_changes(self, offsets):
+        self.sky_changed.append(offsets)
+        self.activity.touch_many(offsets)
+
+    def tick(self, deadline):
+        "Does one whole pass. A pass is quick enough that it always finishes."
+        if not self.running:
+            return True
+        self.check_rules()
+        if self.blockstore.physics:
+            if self.blockstore.unflooding:
+                self.unflood()
+            else:
+                if not self.was_physics or self.was_unflooding or self.rescan:
+                    self.forget_changes()
+                    cells = numpy.frombuffer(find_active(self.blockstore, self.activity), numpy.uint32).astype(numpy.int64)
+                    self.rescan = False
+                    self.logger.debug("Queue everything in %d awake regions for '%s'." % (
+                        self.activity.awake_count(), self.blockstore.world_name))
+                else:
+                    cells = self.active_cells()
+                self.fluid_cells = self.fluid.take_active()
+                self.choose_directions()
+                self.step(cells)
+                self.activity.settle()
+        elif self.was_physics:
+            self.blockstore.unflooding = False
+            self.forget_changes()
+        self.was_physics = self.blockstore.physics
+        self.was_unflooding = self.blockstore.unflooding
+        return True
+
+    def emit(self, offsets, blocks):
+        "Sends changes to the blockstore as one task."
+        if len(offsets):
+            self.blockstore.in_queue.put([TASK_BLOCKSETS, array('I', offsets.astype(numpy.uint32).tostring()),
+                blocks.astype(numpy.uint8).tostring(), True])
+
+    def forget_changes(self):
+        self.changed = []
+        self.sky_changed = []
+
+    def active_cells(self):
+        """
+        Returns the offsets physics should look at this pass: everything
+        within two blocks of a change, plus the blocks that just gained or
+        lost the sky (dirt there might now see it, or grass lose it).
+        """
+        if not self.changed:
+            return numpy.zeros(0, numpy.int64)
+        offsets = numpy.unique(numpy.concatenate(self.changed))
+        sky_changed = numpy.array([top for tops in self.sky_changed for top in tops], numpy.int64)
+        self.forget_changes()
+        view = self.blockstore.block_view
+        sy, sz, sx = view.shape
+        ys, zs, xs = offsets // (sx * sz), (offsets // sx) % sz, offsets % sx
+        # Only dilate the box the changes are in, not the whole world
+        y1, z1, x1 = max(ys.min() - 2, 0), max(zs.min() - 2, 0), max(xs.min() - 2, 0)
+        y2, z2, x2 = min(ys.max() + 3, sy), min(zs.max() + 3, sz), min(xs.max() + 3, sx)
+        mask = numpy.zeros((y2 - y1, z2 - z1, x2 - x1), bool)
+        mask[ys - y1, zs - z1, xs - x1] = True
+        cy, cz, cx = numpy.nonzero(_dilate(mask, 2))
+        near = ((cy + y1) * sz + (cz + z1)) * sx + (cx + x1)
+        return numpy.union1d(near, sky_changed)
+
+    def blocked(self, ys, zs, xs):
+        "Says, for each cell, if there's anything solid above it (so it can't see the sun)."
+        return ys < self.blockstore.height_map.heights[zs, xs]
+
+    def sponged(self, ys, zs, xs):
+        "Says, for each cell, if there's a sponge within SPONGE_RADIUS of it."
+        if not len(ys):
+            return numpy.zeros(0, bool)
+        return self.blockstore.sponge_coverage().covered_cells(ys, zs, xs)
+
+    def step(self, cells):
+        "Works out and sends the changes for one pass over cells (offsets, or None for the whole world)."
+        view = self.blockstore.block_view
+        flat = view.reshape(-1)
+        sy, sz, sx = view.shape
+        if cells is None:
+            cells = numpy.flatnonzero(numpy.in1d(flat, ACTIVE))
+        else:
+            cells = cells[numpy.in1d(flat[cells], ACTIVE)]
+        self.logger.debug("Starting physics run for '%s' with %d checks." % (self.blockstore.world_name, len(cells)))
+        self.checks += len(cells)
+        blocks = flat[cells]
+        ys, zs, xs = cells // (sx * sz), (cells // sx) % sz, cells % sx
+        changes = [] # (offsets, blocks) arrays, applied in order
+
+        def peek(dx, dy, dz, which=None):
+            "The blocks next to each cell (or the cells in which), or OUTSIDE."
+            if which is None:
+                ny, nz, nx = ys + dy, zs + dz, xs + dx
+            else:
+                ny, nz, nx = ys[which] + dy, zs[which] + dz, xs[which] + dx
+            inside = (ny >= 0) & (ny < sy) & (nz >= 0) & (nz < sz) & (nx >= 0) & (nx < sx)
+            result = numpy.empty(len(ny), numpy.uint8)
+            result.fill(OUTSIDE)
+            result[inside] = view[ny[inside], nz[inside], nx[inside]]
+            return result
+
+        def offsets(which, dx=0, dy=0, dz=0):
+            return ((ys[which] + dy) * sz + (zs[which] + dz)) * sx + (xs[which] + dx)
+
+        def move(which, dx, dy, dz):
+            "The cells in which move to the given neighbour, leaving air behind."
+            changes.append((offsets(which, dx, dy, dz), blocks[which]))
+            changes.append((cells[which], numpy.zeros(which.sum(), numpy.uint8)))
+
+        def absorb(which):
+            changes.append((cells[which], numpy.zeros(which.sum(), numpy.uint8)))
+
+        # Dirt next to grass grows grass, if it can see the sun; grass that can't dies back
+        dirt = blocks == BLOCK_DIRT
+        if dirt.any():
+            grassy = numpy.zeros(len(cells), bool)
+            for dx, dz in HORIZONTALS:
+                grassy |= peek(dx, 0, dz) == BLOCK_GRASS
+            dirt &= grassy
+            dirt[dirt] = ~self.blocked(ys[dirt], zs[dirt], xs[dirt])
+            changes.append((cells[dirt], numpy.empty(dirt.sum(), numpy.uint8)))
+            changes[-1][1].fill(BLOCK_GRASS)
+        grass = blocks == BLOCK_GRASS
+        if grass.any():
+            grass[grass] = self.blocked(ys[grass], zs[grass], xs[grass])
+            changes.append((cells[grass], numpy.empty(grass.sum(), numpy.uint8)))
+            changes[-1][1].fill(BLOCK_DIRT)
+
+        below = peek(0, -1, 0)
+        fluid = numpy.in1d(blocks, FLUIDS)
+        if self.blockstore.finite_water:
+            # Water and its spouts go by fill levels, at the end of the pass
+            water = blocks == BLOCK_WATER
+            self.fluid_cells.update(cells[water].tolist())
+            self.fluid_spouts = set(cells[(blocks == BLOCK_SPOUT) & (ys > 0)].tolist())
+            fluid &= ~water
+            # Other spouts fill the space under them
+            for spout, produces in SPOUTS.items():
+                if spout == BLOCK_SPOUT:
+                    continue
+                spouting = (blocks == spout) & (below == BLOCK_AIR)
+                changes.append((offsets(spouting, dy=-1), numpy.empty(spouting.sum(), numpy.uint8)))
+                changes[-1][1].fill(produces)
+            # Fluids fall, or soak into a sponge below
+            falling = fluid & (below == BLOCK_AIR)
+            move(falling, 0, -1, 0)
+            soaked = fluid & (below == BLOCK_SPONGE)
+            absorb(soaked)
+            # The rest try to slide down and out, straight first, then diagonally
+            pending = fluid & ~falling & ~soaked
+            straights = [STRAIGHTS[i] for i in self.straight_order]
+            diagonals = [DIAGONALS[i] for i in self.diagonal_order]
+            for diagonal, directions in [(False, straights), (True, diagonals)]:
+                for dx, dz in directions:
+                    if not pending.any():
+                        break
+                    target = peek(dx, -1, dz)
+                    hit = pending & (peek(dx, 0, dz) == BLOCK_AIR) & ((target == BLOCK_AIR) | (target == BLOCK_SPONGE))
+                    if diagonal:
+                        hit &= (peek(0, 0, dz) == BLOCK_AIR) | (peek(dx, 0, 0) == BLOCK_AIR)
+                    move(hit & (target == BLOCK_AIR), dx, -1, dz)
+                    absorb(hit & (target == BLOCK_SPONGE))
+                    pending &= ~hit
+        else:
+            # Fluids fall, unless there's a sponge about
+            falling = fluid & (below == BLOCK_AIR)
+            falling[falling] = ~self.sponged(ys[falling] - 1, zs[falling], xs[falling])
+            move(falling, 0, -1, 0)
+            # Everything but sand then spreads sideways, again staying away from sponges
+            spreading = fluid & ~falling & (blocks != BLOCK_SAND)
+            for dx, dz in HORIZONTALS:
+                into = spreading & (peek(dx, 0, dz) == BLOCK_AIR)
+                into[into] = ~self.sponged(ys[into], zs[into] + dz, xs[into] + dx)
+                changes.append((offsets(into, dx, 0, dz), blocks[into]))
+        if self.blockstore.finite_water:
+            flowed = self.flow()
+            changes.append((numpy.array([offset for offset, block in flowed], numpy.int64),
+                numpy.array([block for offset, block in flowed], numpy.uint8)))
+
+        changes = [change for change in changes if len(change[0])]
+        if changes:
+            self.emit(numpy.concatenate([change[0] for change in changes]),
+                numpy.concatenate([change[1] for change in changes]))
+        self.logger.debug("Ended physics run for '%s' with %d updates." % (
+            self.blockstore.world_name, sum([len(change[0]) for change in changes])))
@@ -2,24 +2,43 @@
 # Arc is licensed under the BSD 2-Clause modified License.
 # To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
 
-import  os, shutil, sys, traceback
+import  os, shutil, struct, sys, time, traceback
+from array import array
+from collections import deque
 from ConfigParser import RawConfigParser as ConfigParser
+from cStringIO import StringIO
 from Queue import Empty
 
+from twisted.internet import defer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from arc.blockstore import BlockStore
 from arc.constants import *
 from arc.globals import *
 from arc.logger import ColouredLogger
+from arc.physicsprocess import can_launch
+from arc.physicsscheduler import PhysicsScheduler
+from arc.regions import RegionFile
+from arc.worldmeta import WorldMeta, pack_entity, unpack_entity
 
 debug = (True if "--debug" in sys.argv else False)
 
+# Block changes made through the World are sent to the BlockStore in batches of this size
+BLOCK_BATCH = 4096
+# What a block change costs to send a client (type byte, x, y, z and block)
+BLOCK_PACKET_BYTES = 1 + len(TYPE_FORMATS[TYPE_BLOCKSET])
+
 class World(object):
     """
     Represents... well, a World.
-    This is the new, efficient version, that uses the disk as the main backing
-    store. Any changes are stored in self.queued_blocks (and that is looked in
-    for specfic blook lookups first) until the level is flushed, at which point
-    the gzip on disk is updated with the new blocks.
+    The blocks live in memory in the BlockStore while the world is warm.
+    Changes are journalled, and the regions they touched are marked dirty
+    until the level is flushed, at which point the blocks file on disk is
+    rewritten from memory.
     """
 
     def __init__(self, basename, load=True, factory=None):
@@ -29,7 +48,8 @@ class World(object):
         if self.basename.split("/")[1].startswith("."):
             self.hidden = True
         self.blocks_path = os.path.join(basename, "blocks.gz")
-        self.meta_path = os.path.join(basename, "world.meta")
+        self.meta_path = os.path.join(basename, "world.meta") # Only read to migrate old worlds
+        self.meta_store = WorldMeta(basename)
         self.id = None
         self.factory = factory
         # Other settings
@@ -45,10 +65,15 @@ class World(object):
             "saving": False,
             "zoned": False,
             "physics": False,
-            "finite_water": True
+            "finite_water": True,
+            "physics_engine": "classic",
+            "physics_process": False,
         }
         self._physics = False
         self._finite_water = False
+        self._blockstore = None # Only created once something needs the blocks; see warm()
+        self.old_blockstore = None # A BlockStore that's still shutting down after cool()
+        self.last_used = time.time() # For the factory to pick which worlds to cool first
         self.portals = {}
         self.msgblocks = {}
         self.worldbans = set()
@@ -66,41 +91,153 @@ class World(object):
         self.status["last_access_count"] = 0
         # Dict of deferreds to call when a block is gotten.
         self.blockgets = {}
+        # Block changes not yet handed to the BlockStore
+        self.batch_offsets = array('I')
+        self.batch_blocks = []
+        # Every change the BlockStore hasn't applied yet (handed over or not) by offset, so reads can see them
+        self.batch_pending = {}
+        self.batch_number = 0 # Bumped for every batch handed to the BlockStore
+        self.pending_numbers = {} # Offset: number of the latest batch that changes it in batch_pending
+        self.unapplied = deque() # (number, offsets) of batches the BlockStore hasn't applied yet
         # Current deferred to call after a flush is complete
         self.flush_deferred = None
+        # Deferreds waiting on saves, by the token their TASK_SAVE was sent with
+        self.save_deferreds = {}
+        self.save_token = 0
+        self.last_saved = time.time() # When everything was last known to be on disk
+        # Deferred for the level stream everybody joining right now is waiting on
+        self.level_deferred = None
         self.factory.runHook("worldInstanceLoaded", {"world": self})
         if load:
-            assert os.path.isfile(self.blocks_path), "No blocks file: %s" % self.blocks_path
-            assert os.path.isfile(self.meta_path), "No meta file: %s" % self.blocks_path
+            assert os.path.isfile(self.blocks_path) or RegionFile.exists_for(self.blocks_path), "No blocks file: %s" % self.blocks_path
+            assert self.meta_store.exists() or os.path.isfile(self.meta_path), "No meta file: %s" % self.blocks_path
             self.load_meta()
 
     def start(self):
-        "Starts up this World; we spawn a BlockStore, and run it."
-        self.blockstore = BlockStore(self.blocks_path, self.x, self.y, self.z)
-        self.blockstore.start()
-        # If physics is on, turn it on
-        if self._physics:
-            self.blockstore.in_queue.put([TASK_PHYSICSON])
-        if self._finite_water:
-            self.blockstore.in_queue.put([TASK_FWATERON])
+        """
+        Starts up this World. It starts out cold: only the meta is loaded, and
+        the BlockStore (and its physics) is left until something
+        actually needs the blocks.
+        """
+        pass
+
+    def warm(self):
+        "Spawns the BlockStore and runs it, if we haven't yet. Returns it."
+        if self._blockstore is None:
+            self.logger.debug("Warming up world '%s'..." % self.id)
+            self.last_used = time.time()
+            physics_clock = PhysicsScheduler(self.factory.physics_interval / 1000.0,
+                self.factory.physics_budget / 1000.0, self.factory.physics_catchup)
+            self._blockstore = BlockStore(self.blocks_path, self.x, self.y, self.z,
+                journal_limit=self.factory.journal_limit * 1024, use_numpy=self.factory.numpy_blocks,
+                physics_clock=physics_clock, predecessor=self.old_blockstore)
+            # If we were cooled down a moment ago, the new store waits (in its worker) for that save to finish
+            self.old_blockstore = None
+            # Batches we've handed over already are on disk by the time it's loaded
+            self._blockstore.applied_batch = self.batch_number
+            self._blockstore.start()
+            # If physics is on, turn it on
+            if self._physics:
+                self._blockstore.in_queue.put([TASK_PHYSICSON])
+            if self._finite_water:
+                self._blockstore.in_queue.put([TASK_FWATERON])
+            if self.status["physics_engine"] != "classic":
+                self._blockstore.in_queue.put([TASK_PHYSICSENGINE, self.status["physics_engine"]])
+            if self.status["physics_process"]:
+                if can_launch():
+                    self._blockstore.in_queue.put([TASK_PHYSICSPROCESS, True])
+                else:
+                    # Don't try again every time we warm up
+                    self.logger.warn("Physics can't run in a process of its own here; '%s' will run it in the server." % self.id)
+                    self.status["physics_process"] = False
+                    self.status["modified"] = True
+        return self._blockstore
+
+    def cool(self):
+        """
+        Stops the BlockStore and lets go of the blocks, so the world is cold
+        again. Only do this to worlds nobody is in.
+        """
+        if self._blockstore is None:
+            return
+        self.logger.debug("Cooling down world '%s'..." % self.id)
+        self.send_block_changes()
+        self._blockstore.in_queue.put([TASK_STOP])
+        self.old_blockstore, self._blockstore = self._blockstore, None
+
+    def can_cool(self):
+        "Says if the world could be cooled down without anyone noticing."
+        return not (self._blockstore is None or getattr(self, "clients", None) or
+            self.level_deferred or self.flush_deferred or self.save_deferreds or self.blockgets)
+
+    def backlog(self):
+        "Says how many block changes haven't reached the disk yet."
+        if self._blockstore is None:
+            return len(self.batch_offsets)
+        return len(self.batch_offsets) + self._blockstore.unsynced_changes
+
+    def physics_stats(self):
+        "Returns the physics tick stats (see TickStats.summary), or None if the world is cold."
+        if self._blockstore is None:
+            return None
+        return self._blockstore.physics_stats()
+
+    def resident_bytes(self):
+        "Roughly how much memory this world's blocks take up; nothing if it's cold."
+        if self._blockstore is None:
+            return 0
+        return self._blockstore.resident_bytes()
+
+    @property
+    def cold(self):
+        "Says if this world's blocks haven't been loaded yet."
+        return self._blockstore is None
+
+    @property
+    def blockstore(self):
+        "The BlockStore, with its blocks loaded. Warms the world up if needed."
+        blockstore = self.warm()
+        blockstore.loaded.wait()
+        return blockstore
 
     def stop(self):
         "Signals the BlockStore to stop."
-        self.blockstore.in_queue.put([TASK_STOP])
+        if self._blockstore is not None:
+            self.send_block_changes()
+            self._blockstore.in_queue.put([TASK_STOP])
         self.save_meta()
         self.factory.runHook("worldInstanceStopped", {"world": self})
 
     def read_queue(self):
         "Reads messages from the BlockStore and acts on them."
+        # Send off the block changes made since last time first (warming up if there are any)
+        self.send_block_changes()
+        if self._blockstore is None:
+            return
+        if getattr(self, "clients", None):
+            self.last_used = time.time()
+        # Reads can go to the BlockStore's array for the changes it's applied
+        if self._blockstore.loaded.is_set():
+            self.forget_applied(self._blockstore.applied_batch)
         try:
             for i in range(1000):
-                task = self.blockstore.out_queue.get_nowait()
+                task = self._blockstore.out_queue.get_nowait()
                 try:
                     # We might have been told a flush is complete!
                     if task[0] is TASK_FLUSH:
                         if self.flush_deferred:
                             self.flush_deferred.callback(None)
                             self.flush_deferred = None
+                    # Or a save is done
+                    elif task[0] is TASK_SAVE:
+                        deferred = self.save_deferreds.pop(task[1], None)
+                        if deferred is not None:
+                            deferred.callback(None)
+                    # Or the gzipped level someone was waiting for
+                    elif task[0] is TASK_LEVELSTREAM:
+                        if self.level_deferred:
+                            level_deferred, self.level_deferred = self.level_deferred, None
+                            level_deferred.callback(task[1])
                     # Or got a response to a BLOCKGET
                     elif task[0] is TASK_BLOCKGET:
                         try:
@@ -111,6 +248,9 @@ class World(object):
                     # Or the physics changes a block
                     elif task[0] is TASK_BLOCKSET:
                         self.factory.queue.put((self, TASK_BLOCKSET, task[1]))
+                    # Or lots of them
+                    elif task[0] is TASK_BLOCKSETS:
+                        self.broadcast_blocks(task[1], task[2], len(task) > 3 and task[3])
                     # Or there's a world message
                     elif task[0] is TASK_MESSAGE:
                         self.factory.sendMessageToAll(task[1], "world", user="", fromloc="server")
@@ -122,16 +262,49 @@ class World(object):
         except Empty:
             pass
 
+    def broadcast_blocks(self, offsets, blocks, may_resend=False):
+        """
+        Sends clients a batch of block changes, packed up once for all of
+        them. If may_resend is set and the level is smaller than the changes,
+        they're sent the level again instead.
+        """
+        if may_resend and len(offsets) * BLOCK_PACKET_BYTES > self.level_size():
+            self.factory.queue.put((self, TASK_INSTANTRESPAWN, None))
+            return
+        if numpy is not None:
+            offset_array = numpy.frombuffer(offsets, "u%d" % offsets.itemsize) if isinstance(offsets, array) else numpy.asarray(offsets)
+            packets = numpy.empty(len(offset_array), [("type", "u1"), ("x", ">i2"), ("y", ">i2"), ("z", ">i2"), ("block", "u1")])
+            packets["type"] = TYPE_BLOCKSET
+            packets["x"] = offset_array % self.x
+            packets["z"] = (offset_array // self.x) % self.z
+            packets["y"] = offset_array // (self.x * self.z)
+            packets["block"] = numpy.frombuffer(blocks, numpy.uint8)
+            packets = packets.tostring()
+        else:
+            packets = "".join([chr(TYPE_BLOCKSET) + struct.pack("!hhhc", *(self.get_coords(offset) + (block,)))
+                for offset, block in zip(offsets, blocks)])
+        self.factory.queue.put((self, TASK_BLOCKSETS, packets))
+
+    def level_size(self):
+        "Roughly how many bytes sending clients the level takes."
+        level_cache = self._blockstore.level_cache if self._blockstore is not None else None
+        if level_cache:
+            return len(level_cache[1])
+        try:
+            return os.path.getsize(self.blocks_path)
+        except OSError:
+            return self.x * self.y * self.z
+
     def get_physics(self):
         return self._physics
 
     def set_physics(self, value):
         self._physics = value
-        if hasattr(self, "blockstore"):
-            if value:
-                self.blockstore.in_queue.put([TASK_PHYSICSON])
-            else:
-                self.blockstore.in_queue.put([TASK_PHYSICSOFF])
+        if value:
+            # Physics needs the blocks, so this warms the world up
+            self.warm().in_queue.put([TASK_PHYSICSON])
+        elif self._blockstore is not None:
+            self._blockstore.in_queue.put([TASK_PHYSICSOFF])
 
     physics = property(get_physics, set_physics)
 
@@ -140,18 +313,80 @@ class World(object):
 
     def set_finite_water(self, value):
         self._finite_water = value
-        if hasattr(self, "blockstore"):
+        if self._blockstore is not None:
             if value:
-                self.blockstore.in_queue.put([TASK_FWATERON])
+                self._blockstore.in_queue.put([TASK_FWATERON])
             else:
-                self.blockstore.in_queue.put([TASK_FWATEROFF])
+                self._blockstore.in_queue.put([TASK_FWATEROFF])
 
     finite_water = property(get_finite_water, set_finite_water)
 
+    def get_physics_engine(self):
+        return self.status["physics_engine"]
+
+    def set_physics_engine(self, name):
+        self.status["physics_engine"] = name
+        if self._blockstore is not None:
+            self._blockstore.in_queue.put([TASK_PHYSICSENGINE, name])
+
+    physics_engine = property(get_physics_engine, set_physics_engine)
+
+    def get_physics_process(self):
+        return self.status["physics_process"]
+
+    def set_physics_process(self, value):
+        self.status["physics_process"] = value
+        if self._blockstore is not None:
+            self._blockstore.in_queue.put([TASK_PHYSICSPROCESS, value])
+
+    physics_process = property(get_physics_process, set_physics_process)
+
+    def wake_physics(self):
+        "Has physics look the whole world over again, even the parts that have settled."
+        if self._blockstore is not None:
+            self._blockstore.in_queue.put([TASK_PHYSICSWAKE])
+
     def start_unflooding(self):
-        self.blockstore.in_queue.put([TASK_UNFLOOD])
+        self.send_block_changes()
+        self.warm().in_queue.put([TASK_UNFLOOD])
 
     def load_meta(self):
+        """
+        Loads the world's metadata, moving it over from an old world.meta
+        first if need be. The worldMetaLoaded hook then gets called once,
+        with "rows": the WorldMeta tables, as {table name: list of rows}.
+        (It used to get the world.meta ConfigParser, as "config".)
+        """
+        if not self.meta_store.exists():
+            self.load_meta_ini()
+            self.save_meta()
+            os.rename(self.meta_path, self.meta_path + ".old")
+            self.logger.info("Moved the metadata of %s over to %s." % (self.basename, self.meta_store.path))
+        rows = self.meta_store.load()
+        options = dict(rows["options"])
+        self.x, self.y, self.z = options["x"], options["y"], options["z"]
+        self.spawn = (options["spawn_x"], options["spawn_y"], options["spawn_z"], options["spawn_h"])
+        for key in ["autoshutdown", "all_build", "private", "zoned", "physics", "finite_water", "physics_process"]:
+            if key in options:
+                self.status[key] = bool(options[key])
+        self.status["owner"] = options.get("owner", "")
+        self.status["physics_engine"] = options.get("physics_engine", "classic")
+        self.ops = set([name for (name,) in rows["ops"]])
+        self.builders = set([name for (name,) in rows["builders"]])
+        self.worldbans = set([name for (name,) in rows["worldbans"]])
+        self.portals = dict([(offset, [world, x, y, z, h]) for offset, world, x, y, z, h in rows["portals"]])
+        self.msgblocks = dict(rows["msgblocks"])
+        self.cmdblocks = {}
+        for offset, position, command in rows["cmdblocks"]:
+            self.cmdblocks.setdefault(offset, []).append(command)
+        self.mines = [offset for (offset,) in rows["mines"]]
+        self.userzones = dict([(row[0], list(row[1:8]) + (row[8].split(",") if row[8] else [])) for row in rows["userzones"]])
+        self.rankzones = dict([(row[0], list(row[1:9])) for row in rows["rankzones"]])
+        self.entitylist = [unpack_entity(data) for position, data in rows["entities"]]
+        self.factory.runHook("worldMetaLoaded", {"world": self, "rows": rows})
+
+    def load_meta_ini(self):
+        "Loads the metadata from an old-style world.meta ini file."
         config = ConfigParser()
         config.read(self.meta_path)
         if config.has_section("cfginfo"):
@@ -275,7 +510,6 @@ class World(object):
                             elif entry[i] == "True":
                                 entry[i] = True
                     self.entitylist.append([entry[0], (entry[1], entry[2], entry[3])] + entry[4:])
-        self.factory.runHook("worldMetaLoaded", {"world": self, "config": config})
 
     @property
     def store_raw_blocks(self):
@@ -285,102 +519,93 @@ class World(object):
         self.factory.saving = False
 
     def flush(self):
-        self.blockstore.in_queue.put([TASK_FLUSH, self.saved])
+        """
+        Makes sure recent changes are on disk (through the journal, usually).
+        Returns a (Twisted) Deferred that fires once they are.
+        """
+        deferred = defer.Deferred()
+        if self._blockstore is not None:
+            self.send_block_changes()
+            self.save_token += 1
+            self.save_deferreds[self.save_token] = deferred
+            self._blockstore.in_queue.put([TASK_SAVE, self.save_token])
+            started = time.time()
+            def saved(result):
+                self.last_saved = max(self.last_saved, started)
+                return result
+            deferred.addCallback(saved)
+        else:
+            # Cold worlds were saved when they cooled down
+            self.last_saved = time.time()
+            deferred.callback(None)
         self.factory.runHook("worldFlushed", {"world": self})
+        return deferred
+
+    def meta_rows(self):
+        "Returns the world's metadata as rows for each of the WorldMeta tables."
+        options = {
+            "x": self.x, "y": self.y, "z": self.z,
+            "spawn_x": self.spawn[0], "spawn_y": self.spawn[1], "spawn_z": self.spawn[2], "spawn_h": self.spawn[3],
+            "owner": str(self.status["owner"]),
+            "physics_engine": str(self.status["physics_engine"]),
+            }
+        for key in ["autoshutdown", "all_build", "private", "zoned", "physics", "finite_water", "physics_process"]:
+            options[key] = bool(self.status[key])
+        entities = []
+        for entity in self.entitylist:
+            try:
+                entities.append((len(entities), pack_entity(entity)))
+            except ValueError:
+                self.logger.warn("Not saving entity %s in %s, it holds something unsaveable." % (entity[0], self.id))
+        return {
+            "options": sorted(options.items()),
+            "ops": [(name,) for name in sorted(self.ops)],
+            "builders": [(name,) for name in sorted(self.builders)],
+            "worldbans": [(name,) for name in sorted(self.worldbans)],
+            "portals": sorted([(offset, str(dest[0])) + tuple(dest[1:4]) + ((dest[4] if len(dest) > 4 else 0),)
+                for offset, dest in self.portals.items()]),
+            "msgblocks": sorted(self.msgblocks.items()),
+            "cmdblocks": sorted([(offset, position, command)
+                for offset, commands in self.cmdblocks.items() for position, command in enumerate(commands)]),
+            "mines": [(offset,) for offset in sorted(set(self.mines))],
+            "userzones": sorted([(id, zone[0]) + tuple(zone[1:7]) + (",".join(zone[7:]),) for id, zone in self.userzones.items()]),
+            "rankzones": sorted([(id, zone[0]) + tuple(zone[1:7]) + ((zone[7] if len(zone) > 7 else ""),) for id, zone in self.rankzones.items()]),
+            "entities": entities,
+            }
 
     def save_meta(self):
-        config = ConfigParser()
-        config.add_section("entitylist")
-        config.add_section("rankzones")
-        config.add_section("userzones")
-        config.add_section("mines")
-        config.add_section("cmdblocks")
-        config.add_section("msgblocks")
-        config.add_section("portals")
-        config.add_section("worldbans")
-        config.add_section("ops")
-        config.add_section("builders")
-        config.add_section("options")
-        config.add_section("spawn")
-        config.add_section("size")
-        config.add_section("cfginfo")
-        config.set("cfginfo", "version", str(self.status["cfgversion"]))
-        config.set("cfginfo", "name", "world.meta")
-        config.set("size", "z", str(self.z))
-        config.set("size", "y", str(self.y))
-        config.set("size", "x", str(self.x))
-        config.set("spawn", "h", str(self.spawn[3]))
-        config.set("spawn", "z", str(self.spawn[2]))
-        config.set("spawn", "y", str(self.spawn[1]))
-        config.set("spawn", "x", str(self.spawn[0]))
-        # Store display settings
-        config.set("options", "finite_water", str(self.status["finite_water"]))
-        config.set("options", "physics", str(self.status["physics"]))
-        # Store Autoshutdown
-        config.set("options", "autoshutdown", str(self.status["autoshutdown"]))
-        # Store permissions
-        config.set("options", "zoned", str(self.status["zoned"]))
-        config.set("options", "private", str(self.status["private"]))
-        config.set("options", "all_build", str(self.status["all_build"]))
-        # Store owner
-        config.set("options", "owner", str(self.status["owner"]))
-        # Store ops
-        for op in self.ops:
-            config.set("ops", op, "true")
-            # Store builders
-        for builder in self.builders:
-            config.set("builders", builder, "true")
-            # Store portals
-        for offset, dest in self.portals.items():
-            config.set("portals", str(offset), ", ".join(map(str, dest)))
-            # Store msgblocks
-        for offset, msg in self.msgblocks.items():
-            config.set("msgblocks", str(offset), msg)
-            # Store worldbans
-        for name in self.worldbans:
-            config.set("worldbans", str(name), "True")
-            # Store cmdblocks
-        for offset, cmd in self.cmdblocks.items():
-            cmdstr = ""
-            for x in cmd:
-                cmdstr = cmdstr + x + "&n"
-            config.set("cmdblocks", str(offset), cmdstr)
-            # Store mines
-        for offset in self.mines:
-            config.set("mines", str(offset), "True")
-            # Store user zones
-        for name, zone in self.userzones.items():
-            config.set("userzones", str(name), ", ".join(map(str, zone)))
-            # Store rank zones
-        for name, zone in self.rankzones.items():
-            config.set("rankzones", str(name), ", ".join(map(str, zone)))
-            # Store entitylist
-        for i in range(len(self.entitylist)):
-            entry = self.entitylist[i]
-            config.set("entitylist", str(i), str(entry))
-        self.factory.runHook("preWorldMetaSave", {"world": self, "config": config})
-        fp = open(self.meta_path, "w")
-        config.write(fp)
-        fp.flush()
-        os.fsync(fp.fileno())
-        fp.close()
-        self.factory.runHook("worldMetaSaved", {"world": self, "config": config})
+        """
+        Writes out whichever parts of the world's metadata changed since
+        they were last saved. The preWorldMetaSave hook gets "rows" (as
+        meta_rows returns them, which it may change), and worldMetaSaved
+        gets "changed", the names of the tables written. (Both used to get
+        the world.meta ConfigParser, as "config".)
+        """
+        rows = self.meta_rows()
+        self.factory.runHook("preWorldMetaSave", {"world": self, "rows": rows})
+        changed = self.meta_store.save(rows)
+        self.factory.runHook("worldMetaSaved", {"world": self, "changed": changed})
 
     @classmethod
-    def create(cls, basename, x, y, z, sx, sy, sz, sh, levels):
-        "Creates a new World file set"
+    def create(cls, basename, x, y, z, sx, sy, sz, sh, levels=None, factory=None):
+        """
+        Creates a new World file set. levels has a block type for each layer;
+        leave it out if the blocks file is already there (from arc.terrain).
+        """
         if not os.path.exists("worlds/"):
             os.mkdir("worlds/")
-        os.mkdir(basename)
-        world = cls(basename, load=False)
-        BlockStore.create_new(world.blocks_path, x, y, z, levels)
+        if not os.path.isdir(basename):
+            os.mkdir(basename)
+        world = cls(basename, load=False, factory=factory)
+        if levels is not None:
+            BlockStore.create_new(world.blocks_path, x, y, z, levels)
         world.x = x
         world.y = y
         world.z = z
         world.spawn = (sx, sy, sz, sh)
         world.save_meta()
         world.load_meta()
-        self.factory.runHook("worldCreated", {"world": self})
+        factory.runHook("worldCreated", {"world": world})
         return world
 
     # The following methods should be simplified into 1 method
@@ -485,18 +710,173 @@ class World(object):
         return name.lower() in self.worldbans
 
     def __getitem__(self, (x, y, z)):
-        "Gets the value of a block. Returns a Deferred."
-        self.blockstore.in_queue.put([TASK_BLOCKGET, (x, y, z)])
+        """
+        Gets the value of a block. Returns a Deferred.
+        DEPRECATED: this is only here for old plugins, use get_block instead.
+        """
+        if self.warm().loaded.is_set():
+            deferred = Deferred()
+            deferred.callback(self.get_block(x, y, z))
+            return deferred
+        # Still loading, so let the BlockStore answer once it's ready
+        self.send_block_changes()
+        self._blockstore.in_queue.put([TASK_BLOCKGET, (x, y, z)])
         if (x, y, z) not in self.blockgets:
             self.blockgets[x, y, z] = Deferred()
         return self.blockgets[x, y, z]
 
+    def get_block(self, x, y, z):
+        """
+        Returns the block at x, y, z straight out of the BlockStore's array,
+        with no trip through its queue. Changes the BlockStore hasn't applied
+        yet are taken into account. Returns None if the blocks aren't loaded
+        (they start loading); use world[x, y, z] to wait for them.
+        """
+        offset = self.get_offset(x, y, z)
+        try:
+            return self.batch_pending[offset]
+        except KeyError:
+            raw_blocks = self.get_raw_blocks()
+            if raw_blocks is None:
+                return None
+            return raw_blocks[offset]
+
+    def get_blocks(self, x1, y1, z1, x2, y2, z2):
+        """
+        Returns the blocks in the box between the two corners (inclusive) as
+        a string, in the same y, z, x order as the level data, or None if the
+        blocks aren't loaded yet.
+        """
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        z1, z2 = min(z1, z2), max(z1, z2)
+        # Both corners have to be inside the world
+        self.get_offset(x1, y1, z1)
+        self.get_offset(x2, y2, z2)
+        raw_blocks = self.get_raw_blocks()
+        if raw_blocks is None:
+            return None
+        width = x2 - x1 + 1
+        rows = []
+        for y in xrange(y1, y2 + 1):
+            for z in xrange(z1, z2 + 1):
+                offset = y * (self.x * self.z) + z * self.x + x1
+                rows.append(raw_blocks[offset:offset + width].tostring())
+        if not self.batch_pending:
+            return "".join(rows)
+        blocks = array('c', "".join(rows))
+        depth = z2 - z1 + 1
+        for offset, block in self.batch_pending.items():
+            x, y, z = self.get_coords(offset)
+            if x1 <= x <= x2 and y1 <= y <= y2 and z1 <= z <= z2:
+                blocks[((y - y1) * depth + (z - z1)) * width + (x - x1)] = block
+        return blocks.tostring()
+
+    def get_column(self, x, z):
+        "Returns the column of blocks at x, z as a string, bottom first, or None if the blocks aren't loaded yet."
+        start = self.get_offset(x, 0, z)
+        raw_blocks = self.get_raw_blocks()
+        if raw_blocks is None:
+            return None
+        blocks = raw_blocks[start::self.x * self.z]
+        for y in xrange(self.y):
+            offset = start + y * (self.x * self.z)
+            if offset in self.batch_pending:
+                blocks[y] = self.batch_pending[offset]
+        return blocks.tostring()
+
+    def get_height(self, x, z):
+        """
+        Returns the y of the highest block at x, z the sun can't shine
+        through (anything above it can see the sky), or -1 if there's none.
+        Changes still batched up in this World aren't counted yet.
+        """
+        self.get_offset(x, 0, z)
+        return self.blockstore.height_map.height(x, z)
+
+    def get_height_map(self):
+        "Returns a copy of every column's height (see get_height) as an array('h'), in z, x order."
+        height_map = self.blockstore.height_map
+        if height_map.heights is not None:
+            return array('h', height_map.flat.tostring())
+        return height_map.flat[:]
+
+    def snapshot(self):
+        "Returns a copy of every block in the world as one string, in offset order, or None if they aren't loaded yet."
+        raw_blocks = self.get_raw_blocks()
+        if raw_blocks is None:
+            return None
+        blocks = raw_blocks[:]
+        for offset, block in self.batch_pending.items():
+            blocks[offset] = block
+        return blocks.tostring()
+
+    def get_raw_blocks(self):
+        """
+        Returns the BlockStore's block array, or None if it isn't loaded yet;
+        it's loaded in the background, so the caller isn't held up.
+        """
+        blockstore = self.warm()
+        if not blockstore.loaded.is_set():
+            return None
+        return blockstore.raw_blocks
+
     def __setitem__(self, (x, y, z), block):
         "Sets the value of a block."
         assert isinstance(block, str) and len(block) == 1
-        # Make sure this is inside boundaries
-        self.get_offset(x, y, z)
-        self.blockstore.in_queue.put([TASK_BLOCKSET, (x, y, z), block])
+        # Make sure this is inside boundaries, then queue it up for the next batch
+        offset = self.get_offset(x, y, z)
+        self.batch_offsets.append(offset)
+        self.batch_blocks.append(block)
+        self.batch_pending[offset] = block
+        self.pending_numbers[offset] = self.batch_number + 1
+        if len(self.batch_offsets) >= BLOCK_BATCH:
+            self.send_block_changes()
+
+    def set_blocks(self, changes):
+        """
+        Sets lots of blocks at once; changes is an iterable of ((x, y, z), block).
+        They reach the BlockStore as a single task.
+        """
+        offsets = array('I')
+        blocks = []
+        for (x, y, z), block in changes:
+            assert isinstance(block, str) and len(block) == 1
+            offsets.append(self.get_offset(x, y, z))
+            blocks.append(block)
+        self.send_block_changes()
+        if offsets:
+            self.send_batch(offsets, "".join(blocks))
+
+    def send_block_changes(self):
+        "Hands block changes made with world[x, y, z] = block to the BlockStore."
+        if self.batch_offsets:
+            self.last_used = time.time()
+            # They're in batch_pending already
+            self.send_batch(self.batch_offsets, "".join(self.batch_blocks), pending=True)
+            self.batch_offsets = array('I')
+            self.batch_blocks = []
+
+    def send_batch(self, offsets, blocks, broadcast=False, pending=False):
+        """
+        Hands a batch of changes to the BlockStore, numbered so reads can keep
+        seeing them in batch_pending until it's applied them.
+        """
+        self.batch_number += 1
+        if not pending:
+            self.batch_pending.update(zip(offsets, blocks))
+            self.pending_numbers.update(dict.fromkeys(offsets, self.batch_number))
+        self.unapplied.append((self.batch_number, offsets))
+        self.warm().in_queue.put([TASK_BLOCKSETS, offsets, blocks, broadcast, False, self.batch_number])
+
+    def forget_applied(self, number):
+        "Drops the changes the BlockStore has applied (every batch up to number) from batch_pending."
+        while self.unapplied and self.unapplied[0][0] <= number:
+            batch, offsets = self.unapplied.popleft()
+            for offset in offsets:
+                if self.pending_numbers.get(offset) == batch:
+                    del self.pending_numbers[offset]
+                    del self.batch_pending[offset]
 
     def get_offset(self, x, y, z):
         "Turns block coordinates into a data offset"
@@ -512,27 +892,120 @@ class World(object):
         y = offset // (self.x * self.z)
         return x, y, z
 
+    @property
+    def vectorized(self):
+        """
+        Says if the region methods (fill_box, replace_box, count_blocks,
+        get_volume and paste_volume) can be used, which needs NumPy.
+        """
+        return numpy is not None and self.factory.numpy_blocks
+
+    def get_box(self, x1, y1, z1, x2, y2, z2):
+        "Puts a box's corners in order, making sure both are inside the world."
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        z1, z2 = min(z1, z2), max(z1, z2)
+        self.get_offset(x1, y1, z1)
+        self.get_offset(x2, y2, z2)
+        return x1, y1, z1, x2, y2, z2
+
+    def get_volume(self, x1, y1, z1, x2, y2, z2):
+        """
+        Returns a copy of the blocks in the box between the two corners
+        (inclusive), as a NumPy uint8 array indexed [y, z, x].
+        """
+        x1, y1, z1, x2, y2, z2 = self.get_box(x1, y1, z1, x2, y2, z2)
+        volume = self.blockstore.block_view[y1:y2 + 1, z1:z2 + 1, x1:x2 + 1].copy()
+        for offset, block in self.batch_pending.items():
+            x, y, z = self.get_coords(offset)
+            if x1 <= x <= x2 and y1 <= y <= y2 and z1 <= z <= z2:
+                volume[y - y1, z - z1, x - x1] = ord(block)
+        return volume
+
+    def paste_volume(self, x, y, z, volume, skip=None, broadcast=True):
+        """
+        Writes a [y, z, x] uint8 volume (as from get_volume) into the world
+        with its lowest corner at x, y, z. Cells of the volume holding the
+        block skip are left alone. Returns how many blocks changed.
+        """
+        height, depth, width = volume.shape
+        current = self.get_volume(x, y, z, x + width - 1, y + height - 1, z + depth - 1)
+        changed = current != volume
+        if skip is not None:
+            changed &= volume != ord(skip)
+        return self.send_volume_changes(x, y, z, changed, volume, broadcast)
+
+    def fill_box(self, x1, y1, z1, x2, y2, z2, block, keep=(), broadcast=True):
+        """
+        Sets every block in the box to block, apart from ones whose type is in
+        keep. Returns how many blocks changed.
+        """
+        x1, y1, z1, x2, y2, z2 = self.get_box(x1, y1, z1, x2, y2, z2)
+        current = self.get_volume(x1, y1, z1, x2, y2, z2)
+        changed = current != ord(block)
+        for kept in keep:
+            changed &= current != ord(kept)
+        return self.send_volume_changes(x1, y1, z1, changed, numpy.uint8(ord(block)), broadcast)
+
+    def replace_box(self, x1, y1, z1, x2, y2, z2, old, new, broadcast=True):
+        "Turns every old block in the box into new. Returns how many blocks changed."
+        x1, y1, z1, x2, y2, z2 = self.get_box(x1, y1, z1, x2, y2, z2)
+        if old == new:
+            return 0
+        changed = self.get_volume(x1, y1, z1, x2, y2, z2) == ord(old)
+        return self.send_volume_changes(x1, y1, z1, changed, numpy.uint8(ord(new)), broadcast)
+
+    def count_blocks(self, x1, y1, z1, x2, y2, z2):
+        "Counts the blocks in the box by type. Returns a dict of block: count."
+        counts = numpy.bincount(self.get_volume(x1, y1, z1, x2, y2, z2).ravel(), minlength=256)
+        return dict([(chr(block), int(counts[block])) for block in numpy.nonzero(counts)[0]])
+
+    def send_volume_changes(self, x, y, z, changed, blocks, broadcast):
+        """
+        Hands the cells of a box that changed to the BlockStore as one batch.
+        changed is a [y, z, x] mask with its lowest corner at x, y, z, and
+        blocks either a volume of the same shape or a single block value.
+        """
+        ys, zs, xs = numpy.nonzero(changed)
+        if not len(xs):
+            return 0
+        offsets = (ys + y) * (self.x * self.z) + (zs + z) * self.x + (xs + x)
+        if numpy.ndim(blocks):
+            values = blocks[changed].tostring()
+        else:
+            values = chr(blocks) * len(xs)
+        self.send_block_changes()
+        self.last_used = time.time()
+        self.send_batch(array('I', offsets.astype(numpy.uint32).tostring()), values, broadcast)
+        return len(xs)
+
+    def get_level_stream(self):
+        """
+        Returns a Deferred that will eventually yield this world's level, as
+        the gzipped string clients are sent. Everybody asking at the same time
+        shares one request, and the BlockStore only rebuilds the string if
+        blocks changed since it was last made.
+        """
+        self.send_block_changes()
+        self.last_used = time.time()
+        if not self.level_deferred:
+            self.level_deferred = Deferred()
+            self.warm().in_queue.put([TASK_LEVELSTREAM])
+        stream_deferred = Deferred()
+        self.level_deferred.addCallback(stream_deferred.callback)
+        self.factory.runHook("worldGzipHandleRequestReceived", {"world": self})
+        return stream_deferred
+
     def get_gzip_handle(self):
         """
-        Returns a Deferred that will eventually yield a handle to this world's
-        gzip blocks file (gzipped, not the contents).
+        Returns a Deferred that will eventually yield a (file-like handle, size)
+        pair for this world's gzipped level. Kept for plugins; new code should
+        use get_level_stream.
         """
-        # First, queue it
-        self.blockstore.in_queue.put([TASK_FLUSH, self.saved])
-        # Now, make the flush deferred if we haven't.
-        if not self.flush_deferred:
-            self.flush_deferred = Deferred()
-        # Next, make a deferred for us to return
         handle_deferred = Deferred()
-        # Now, make a function that will call that on the first one
-        def on_flush(result):
-            handle_deferred.callback((
-                open(self.blocks_path, "rb"),
-                os.stat(self.blocks_path).st_size,
-                ))
-
-        self.flush_deferred.addCallback(on_flush)
-        self.factory.runHook("worldGzipHandleRequestReceived", {"world": self})
+        def on_stream(stream):
+            handle_deferred.callback((StringIO(stream), len(stream)))
+        self.get_level_stream().addCallback(on_stream)
         return handle_deferred
 
     def backup(self, id=None):
@@ -0,0 +1,144 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+"""
+World metadata (size, spawn, options, portals, zones, entities and so on),
+kept in a small SQLite database per world, world.db, with a table for each
+collection. Saving only rewrites the tables whose contents changed since
+they were last written. Worlds that still have an old world.meta ini file
+are moved over the first time they're loaded.
+"""
+
+import marshal, os, sqlite3
+from ConfigParser import RawConfigParser as ConfigParser
+
+META_DB = "world.db"
+META_INI = "world.meta"
+META_VERSION = 1
+SQLITE_MAGIC = "SQLite format 3\x00"
+
+# Every table but entities and options has a column per field, so nothing has to be parsed on load
+TABLES = [
+    ("options", "key TEXT PRIMARY KEY, value"),
+    ("ops", "name TEXT PRIMARY KEY"),
+    ("builders", "name TEXT PRIMARY KEY"),
+    ("worldbans", "name TEXT PRIMARY KEY"),
+    ("portals", "offset INTEGER PRIMARY KEY, world TEXT, x INTEGER, y INTEGER, z INTEGER, h INTEGER"),
+    ("msgblocks", "offset INTEGER PRIMARY KEY, message TEXT"),
+    ("cmdblocks", "offset INTEGER, position INTEGER, command TEXT, PRIMARY KEY (offset, position)"),
+    ("mines", "offset INTEGER PRIMARY KEY"),
+    ("userzones", "id INTEGER PRIMARY KEY, name TEXT, x1 INTEGER, y1 INTEGER, z1 INTEGER, x2 INTEGER, y2 INTEGER, z2 INTEGER, users TEXT"),
+    ("rankzones", "id INTEGER PRIMARY KEY, name TEXT, x1 INTEGER, y1 INTEGER, z1 INTEGER, x2 INTEGER, y2 INTEGER, z2 INTEGER, rank TEXT"),
+    ("entities", "position INTEGER PRIMARY KEY, data BLOB"),
+]
+
+class WorldMeta(object):
+    """
+    The metadata store of one world. load() returns the rows of every
+    table; save() takes rows in the same shape and writes the tables that
+    differ from what's on disk.
+    """
+
+    def __init__(self, world_dir):
+        self.path = os.path.join(world_dir, META_DB)
+        self.saved_rows = {} # Table name: the rows it holds on disk, as far as we know
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.text_factory = str
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            for name, columns in TABLES:
+                connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (name, columns))
+            connection.execute("PRAGMA user_version = %d" % META_VERSION)
+            connection.commit()
+        elif version != META_VERSION:
+            connection.close()
+            raise IOError("%s is a version %d world database, not %d" % (self.path, version, META_VERSION))
+        return connection
+
+    def load(self):
+        "Returns {table name: list of row tuples} for every table, in key order."
+        connection = self.connect()
+        try:
+            rows = {}
+            for name, columns in TABLES:
+                rows[name] = connection.execute("SELECT * FROM %s ORDER BY 1" % name).fetchall()
+        finally:
+            connection.close()
+        self.saved_rows = dict(rows)
+        return rows
+
+    def save(self, rows):
+        """
+        Writes out the tables in rows ({table name: list of row tuples})
+        that changed since we last saved or loaded. Returns their names.
+        """
+        changed = [name for name, columns in TABLES if name in rows and rows[name] != self.saved_rows.get(name)]
+        if not changed:
+            return []
+        connection = self.connect()
+        try:
+            for name in changed:
+                connection.execute("DELETE FROM %s" % name)
+                if rows[name]:
+                    marks = ", ".join(["?"] * len(rows[name][0]))
+                    connection.executemany("INSERT INTO %s VALUES (%s)" % (name, marks), rows[name])
+            connection.commit()
+        finally:
+            connection.close()
+        for name in changed:
+            self.saved_rows[name] = rows[name]
+        return changed
+
+def pack_entity(entity):
+    "Turns an entity list into bytes for the entities table."
+    return buffer(marshal.dumps(entity))
+
+def unpack_entity(data):
+    return marshal.loads(str(data))
+
+def read_size(world_dir):
+    "Returns the (x, y, z) size of a world from its metadata, whichever format that's in."
+    if os.path.isfile(os.path.join(world_dir, META_DB)):
+        connection = WorldMeta(world_dir).connect()
+        try:
+            options = dict(connection.execute("SELECT key, value FROM options WHERE key IN ('x', 'y', 'z')").fetchall())
+        finally:
+            connection.close()
+        return options["x"], options["y"], options["z"]
+    config = ConfigParser()
+    config.read(os.path.join(world_dir, META_INI))
+    return config.getint("size", "x"), config.getint("size", "y"), config.getint("size", "z")
+
+def read_meta(world_dir):
+    "Returns the raw bytes of a world's metadata file, for backups."
+    path = os.path.join(world_dir, META_DB)
+    if not os.path.isfile(path):
+        path = os.path.join(world_dir, META_INI)
+    fh = open(path, "rb")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+def write_meta(world_dir, meta):
+    "Puts metadata bytes from read_meta back, in whichever format they're in."
+    if meta.startswith(SQLITE_MAGIC):
+        filename, other = META_DB, META_INI
+    else:
+        filename, other = META_INI, META_DB
+    path = os.path.join(world_dir, filename)
+    fh = open(path + ".new", "wb")
+    fh.write(meta)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    os.rename(path + ".new", path)
+    # Don't leave the other format around to be read instead
+    if os.path.exists(os.path.join(world_dir, other)):
+        os.remove(os.path.join(world_dir, other))
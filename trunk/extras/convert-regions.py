@@ -0,0 +1,22 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from arc.compression import start_pool
+from arc.regions import RegionFile, convert_world
+
+if len(sys.argv) == 1:
+    print "Please provide one or more world folders."
+    sys.exit(1)
+start_pool()
+for world_dir in sys.argv[1:]:
+    blocks_path = os.path.join(world_dir, "blocks.gz")
+    if RegionFile.exists_for(blocks_path):
+        print "%s is already in the region format." % world_dir
+        continue
+    print "Converting %s..." % world_dir
+    regions = convert_world(blocks_path)
+    print "Done, %d regions written." % regions.region_count()
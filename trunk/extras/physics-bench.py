@@ -0,0 +1,37 @@
+# Arc is copyright 2009-2012 the Arc team and other contributors.
+# Arc is licensed under the BSD 2-Clause modified License.
+# To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
+
+import os, sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from arc.physicsbench import SCENARIOS, run_scenario
+
+parser = OptionParser(usage="%prog [options] [scenario ...]",
+    description="Runs physics scenarios (all of them, if none are named) and reports how they went.")
+parser.add_option("-e", "--engine", default="classic", help="physics engine to run: classic or vector [%default]")
+parser.add_option("-s", "--seed", type="int", default=0, help="seed for the engine's random choices [%default]")
+parser.add_option("-t", "--ticks", type="int", help="ticks to run, instead of the scenario's own")
+parser.add_option("-w", "--world", help="world folder to run the scenarios on, instead of their own")
+parser.add_option("--no-numpy", action="store_false", dest="use_numpy", default=True, help="don't use NumPy for the blocks")
+parser.add_option("-l", "--list", action="store_true", help="list the scenarios and stop")
+options, names = parser.parse_args()
+
+if options.list:
+    for name in sorted(SCENARIOS):
+        print "%s: %s" % (name, SCENARIOS[name].description)
+    sys.exit(0)
+for name in names:
+    if name not in SCENARIOS:
+        print "There's no scenario called '%s'; try --list." % name
+        sys.exit(1)
+failed = False
+for name in names or sorted(SCENARIOS):
+    scenario = SCENARIOS[name]
+    if options.world:
+        scenario.world = options.world
+    result = run_scenario(scenario, options.engine, options.seed, options.use_numpy, options.ticks)
+    print result.summary()
+    failed = failed or bool(result.problems)
+sys.exit(1 if failed else 0)
@@ -2,12 +2,14 @@
 # Arc is licensed under the BSD 2-Clause modified License.
 # To view more details, please see the "LICENSING" file in the "docs" folder of the Arc Package.
 
-import sys, gzip, os, colorsys
-from array import array
-from ConfigParser import SafeConfigParser as ConfigParser
+import sys, os, colorsys
 from PIL import Image
 from constants import *
 
+# Worlds may be in region format, with a journal, and their metadata in a database; let Arc read them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from arc.backups import read_world
+
 BLOCK_COLOURS = {
     BLOCK_ROCK: (0, 0, 60),
     BLOCK_GRASS: (133, 97, 51),
@@ -70,27 +72,11 @@ class Imager(object):
 
     def __init__(self, level):
         self.level = level
-        self.blocks_path = os.path.join(level, "blocks.gz")
-        self.meta_path = os.path.join(level, "world.meta")
-        assert os.path.exists(self.blocks_path)
-        assert os.path.exists(self.meta_path)
         self.load()
 
     def load(self):
-        "Load the world file into memory."
-        config = ConfigParser()
-        config.read(self.meta_path)
-        self.x = config.getint("size", "x")
-        self.y = config.getint("size", "y")
-        self.z = config.getint("size", "z")
-        self.blocks = array("c")
-        gzf = gzip.GzipFile(self.blocks_path)
-        gzf.read(4)
-        chunk = gzf.read(2048)
-        while chunk:
-            self.blocks.extend(chunk)
-            chunk = gzf.read(2048)
-        gzf.close()
+        "Load the world's blocks into memory, with its journal replayed over them."
+        (self.x, self.y, self.z), self.blocks, meta = read_world(self.level)
 
     def get_offset(self, x, y, z):
         "Turns block coordinates into a data offset"
@@ -12,6 +12,8 @@ from twisted.internet.error import CannotListenError
 
 from arc.controller import ControllerFactory
 from arc.constants import *
+from arc.executor import stop_executor
+from arc.physicsprocess import stop_launcher
 from arc.globals import *
 from arc.logger import ColouredLogger
 from arc.server import ArcFactory
@@ -98,6 +100,9 @@ def main():
             logger.info("Saving: %s" % world.basename)
             world.stop()
             world.save_meta()
+        # Their final saves run on the world workers
+        stop_executor()
+        stop_launcher()
         logger.info("Done flushing...")
         doExit()
 